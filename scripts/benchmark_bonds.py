@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Time bond perception (iMolpro.bonds.perceive_bonds, the cell list that
+BondActorCollection uses) against the loop over every pair of atoms that it
+replaced, on structures from 10 to 50,000 atoms made by stacking copies of the
+malonaldehyde sample geometry (malonaldehyde.molpro/malonaldehyde.xyz) on a
+lattice 6 angstrom apart, so that the density of atoms, and so the number of
+bonds per atom, stays the same as the structure grows. The time per atom
+should stay roughly constant for the cell list, while it grows linearly with
+size for the pair loop; where both run, their bonds are checked to be the same.
+
+The pair loop takes minutes on the largest structures, so it is only run up to
+--reference-limit atoms.
+
+Usage: benchmark_bonds.py [--repeat N] [--reference-limit N] [--sizes N ...]
+"""
+import argparse
+import itertools
+import math
+import pathlib
+import sys
+import time
+
+import numpy as np
+from ase.data import covalent_radii
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / 'src'))
+
+from iMolpro.bonds import perceive_bonds
+
+ANGSTROM = 1.8897161646321
+SPACING = 6.0 * ANGSTROM
+
+
+def malonaldehyde_atoms():
+    atoms = []
+    lines = (REPO_ROOT / 'malonaldehyde.molpro' / 'malonaldehyde.xyz').read_text().splitlines()
+    for line in lines[2:]:
+        fields = line.split()
+        if fields:
+            atomic_number = {'H': 1, 'C': 6, 'O': 8}[fields[0]]
+            atoms.append({'atomic_number': atomic_number, 'charge': float(atomic_number),
+                          'xyz': tuple(float(c) * ANGSTROM for c in fields[1:4])})
+    return atoms
+
+
+def lattice_atoms(size):
+    r"""The first `size` atoms of copies of malonaldehyde on a cubic lattice just big enough to hold them."""
+    molecule = malonaldehyde_atoms()
+    copies = math.ceil(size / len(molecule))
+    edge = math.ceil(copies ** (1 / 3))
+    atoms = []
+    for cell in itertools.islice(itertools.product(range(edge), repeat=3), copies):
+        shift = SPACING * np.array(cell)
+        atoms.extend(dict(atom, xyz=tuple(np.array(atom['xyz']) + shift)) for atom in molecule)
+    return atoms[:size]
+
+
+def all_pairs(atoms):
+    r"""The loop BondActorCollection.set_source() used to find bonds."""
+    pairs = []
+    for i, iatom in enumerate(atoms):
+        for j, jatom in enumerate(atoms[:i]):
+            distance = np.linalg.norm(np.array(iatom['xyz']) - np.array(jatom['xyz']))
+            if 0.9 * distance / ANGSTROM < covalent_radii[iatom['atomic_number']] + covalent_radii[
+                jatom['atomic_number']]:
+                pairs.append((i, j))
+    return pairs
+
+
+def best_time(function, atoms, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pairs = function(atoms)
+        times.append(time.perf_counter() - start)
+    return min(times), pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of this many timings')
+    parser.add_argument('--reference-limit', type=int, default=2000,
+                        help='only time the pair loop on structures of up to this many atoms')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 2000, 5000, 10000, 20000, 50000],
+                        help='numbers of atoms')
+    args = parser.parse_args()
+    print(f'{"atoms":>7} {"bonds":>7} {"cell list":>12} {"per atom":>10} {"pair loop":>12}')
+    for size in args.sizes:
+        atoms = lattice_atoms(size)
+        seconds, pairs = best_time(perceive_bonds, atoms, args.repeat)
+        line = f'{size:7d} {len(pairs):7d} {seconds * 1000:9.2f} ms {seconds * 1e6 / size:7.2f} us'
+        if size <= args.reference_limit:
+            reference_seconds, reference = best_time(all_pairs, atoms, 1)
+            if reference != pairs:
+                sys.exit(f'Bonds differ from the pair loop for {size} atoms')
+            line += f' {reference_seconds * 1000:9.1f} ms'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Time CubeData's bulk cube-file parser and streaming writer against the
+original line-by-line parser and string-concatenating writer they replaced,
+on a cube built over the malonaldehyde sample geometry
+(malonaldehyde.molpro/malonaldehyde.xyz, at the default 0.3 bohr
+grid_resolution) and on a synthetic 256^3 cube, checking that both parsers
+give identical arrays and both writers identical text.
+
+Generating the synthetic cube and running the references on it take a
+while; pass --skip-reference to time just the bulk parser and writer.
+
+The bulk parser is only 2.5 to 3 times as fast as the line-by-line one: most of
+the time goes on converting the text to floats, which both must do. This
+is also not a speedup that anyone sees while using iMolpro. The orbital and
+density display never reads a cube file: it draws grids evaluated in memory,
+as pymolpro.cube_data.CubeData objects built from a dict, or read back from
+the binary OrbitalCubeDiskCache. What is timed here is iMolpro's own
+CubeData, as used for cube files that are written out or read in by
+scripts.
+
+Usage: benchmark_cube_data.py [--size N] [--skip-reference] [--keep DIRECTORY]
+"""
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / 'src'))
+
+from iMolpro.cube_data import CubeData
+
+ANGSTROM = 1.8897161646321
+
+
+def malonaldehyde_atoms():
+    atoms = []
+    lines = (REPO_ROOT / 'malonaldehyde.molpro' / 'malonaldehyde.xyz').read_text().splitlines()
+    for line in lines[2:]:
+        fields = line.split()
+        if fields:
+            atomic_number = {'H': 1, 'C': 6, 'O': 8}[fields[0]]
+            atoms.append({'atomic_number': atomic_number, 'charge': float(atomic_number),
+                          'xyz': tuple(float(c) * ANGSTROM for c in fields[1:4])})
+    return atoms
+
+
+def write_cube(filename, atoms, origin, spacing, data):
+    r"""Write a single-orbital cube file in the usual 6-values-per-line layout; each (x, y) row starts a new line."""
+    nx, ny, nz = data.shape
+    with open(filename, 'w') as f:
+        f.write('benchmark\nsum of atom-centred gaussians\n')
+        f.write(f'{-len(atoms)} {origin[0]:.6f} {origin[1]:.6f} {origin[2]:.6f} 1\n')
+        for i, n in enumerate(data.shape):
+            f.write(f'{n} ' + ' '.join(f'{spacing if j == i else 0.0:.6f}' for j in range(3)) + '\n')
+        for atom in atoms:
+            f.write(f'{atom["atomic_number"]} {atom["charge"]} ' + ' '.join(f'{c:.6f}' for c in atom['xyz']) + '\n')
+        f.write('1 1\n')
+        full_lines, remainder = divmod(nz, 6)
+        row_format = (' %.5E' * 6 + '\n') * full_lines + (' %.5E' * remainder + '\n' if remainder else '')
+        for i in range(nx):
+            f.write(''.join(row_format % tuple(row) for row in data[i]))
+
+
+def gaussian_cube(filename, atoms, spacing=None, size=None, border=6.0):
+    xyz = np.array([atom['xyz'] for atom in atoms])
+    lower = xyz.min(axis=0) - border
+    upper = xyz.max(axis=0) + border
+    if size is not None:
+        spacing = float(np.max(upper - lower)) / (size - 1)
+        dimensions = [size] * 3
+    else:
+        dimensions = [int((upper[i] - lower[i]) / spacing) + 1 for i in range(3)]
+    axes = [lower[i] + spacing * np.arange(dimensions[i]) for i in range(3)]
+    data = np.zeros(dimensions)
+    for centre in xyz:
+        gx, gy, gz = (np.exp(-0.5 * (axes[i] - centre[i]) ** 2) for i in range(3))
+        data += gx[:, None, None] * gy[None, :, None] * gz[None, None, :]
+    write_cube(filename, atoms, lower, spacing, data)
+    return dimensions
+
+
+def load_line_by_line(filename, dimensions, header_lines):
+    r"""The parser CubeData.load_from_cube_file() used before the bulk reader."""
+    data = np.ndarray(shape=dimensions, dtype=np.float64)
+    with open(filename, 'r') as f:
+        for _ in range(header_lines):
+            f.readline()
+        for i in range(dimensions[0]):
+            for j in range(dimensions[1]):
+                k0 = 0
+                while True:
+                    line = f.readline().strip().split()
+                    for k, value in enumerate(line):
+                        data[i, j, k + k0] = float(line[k])
+                    k0 += len(line)
+                    if k0 >= dimensions[2]:
+                        break
+    return data
+
+
+def str_by_concatenation(cube):
+    r"""The text CubeData.__str__() built, value by value, before CubeData.write()."""
+    buffer = cube.title[0] + '\n' + cube.title[1] + '\n'
+    buffer += f'{cube.natoms * (-1 if cube.orbitals else 1)} {cube.origin[0]} {cube.origin[1]} {cube.origin[2]} 1\n'
+    for i in range(3):
+        buffer += f'{cube.dimensions[i]}'
+        for j in range(3):
+            buffer += f' {cube.cells[i, j]}'
+        buffer += '\n'
+    for atom in cube.atoms:
+        buffer += f'{atom["atomic_number"]} {atom["charge"]}'
+        for coord in atom["xyz"]:
+            buffer += f' {coord}'
+        buffer += '\n'
+    buffer += f'{len(cube.orbital_identifiers)}'
+    for identifier in cube.orbital_identifiers:
+        buffer += f' {identifier}'
+    buffer += '\n'
+    for i in range(cube.dimensions[0]):
+        for j in range(cube.dimensions[1]):
+            k0 = 0
+            while k0 < cube.dimensions[2]:
+                for k in range(min(6, cube.dimensions[2] - k0)):
+                    buffer += f' {cube.data[i, j, k0]:.5e}'.replace('e', 'E')
+                    k0 += 1
+                buffer += '\n'
+    return buffer
+
+
+def benchmark(label, filename, dimensions, natoms, skip_reference):
+    size_mb = pathlib.Path(filename).stat().st_size / 1e6
+    start = time.perf_counter()
+    cube = CubeData(str(filename))
+    bulk = time.perf_counter() - start
+    print(f'{label}: {"x".join(str(n) for n in dimensions)} grid, {size_mb:.1f} MB')
+    print(f'  bulk parser         {bulk:8.3f} s')
+    if not skip_reference:
+        start = time.perf_counter()
+        reference = load_line_by_line(filename, dimensions, 6 + natoms + 1)
+        line_by_line = time.perf_counter() - start
+        print(f'  line-by-line parser {line_by_line:8.3f} s')
+        print(f'  speedup             {line_by_line / bulk:8.1f}x, identical arrays: '
+              f'{np.array_equal(reference, cube.data)}')
+    copy = pathlib.Path(filename).with_suffix('.copy.cube')
+    start = time.perf_counter()
+    cube.write(str(copy))
+    streaming = time.perf_counter() - start
+    print(f'  streaming writer    {streaming:8.3f} s')
+    if not skip_reference:
+        start = time.perf_counter()
+        text = str_by_concatenation(cube)
+        concatenation = time.perf_counter() - start
+        print(f'  concatenating str() {concatenation:8.3f} s')
+        print(f'  speedup             {concatenation / streaming:8.1f}x, identical text: {text == copy.read_text()}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=256, help='edge length of the synthetic cube')
+    parser.add_argument('--skip-reference', action='store_true', help="don't time the line-by-line parser")
+    parser.add_argument('--keep', help='write the generated cube files here instead of a temporary directory')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = pathlib.Path(args.keep or temporary_directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        atoms = malonaldehyde_atoms()
+        filename = directory / 'malonaldehyde.cube'
+        dimensions = gaussian_cube(filename, atoms, spacing=0.3)
+        benchmark('malonaldehyde', filename, dimensions, len(atoms), args.skip_reference)
+        filename = directory / f'synthetic{args.size}.cube'
+        dimensions = gaussian_cube(filename, atoms, size=args.size)
+        benchmark(f'synthetic {args.size}^3', filename, dimensions, len(atoms), args.skip_reference)
+    print('(iMolpro.cube_data.CubeData only: the orbital display reads no cube files; see the description above)')
+
+
+if __name__ == '__main__':
+    main()
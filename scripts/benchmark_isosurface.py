@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Time each isosurface engine in iMolpro.isosurface (the choices for the
+isosurface_engine setting) on representative grids: an orbital and the total
+electron density of the TestProject that ships with pymolpro, evaluated at
+the default 0.3 bohr grid_resolution and at a finer spacing, and a synthetic
+density-like grid over the malonaldehyde sample geometry. For each engine the
+time to contour at the default contour value is reported with the number of
+triangles produced, so that engines can be checked against each other.
+flying_edges is timed on VTK's sequential SMP backend, as it runs unless
+flying_edges_smp has been used.
+
+Runs entirely offscreen -- nothing is rendered -- so it can be run on the
+headless machines that will do the rendering.
+
+Usage: benchmark_isosurface.py [--repeat N] [--threads N] [--size N] [--fine BOHR]
+"""
+import argparse
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pymolpro
+from pymolpro.cube_data import CubeData
+from vtkmodules.vtkCommonCore import vtkSMPTools
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / 'src'))
+
+from iMolpro import orbital_grid
+from iMolpro.isosurface import ISOSURFACE_ENGINES, contour, prepare_grid, use_smp_threads
+from iMolpro.vtk_molecule_widget import create_vtk_image_data
+
+CONTOUR_VALUE = 0.1
+ANGSTROM = 1.8897161646321
+
+
+def project_grids(resolution):
+    with tempfile.TemporaryDirectory() as directory:
+        project_path = pathlib.Path(directory) / 'TestProject.molpro'
+        shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+        orbitals = pymolpro.Project(str(project_path)).orbitals(instance=-1)
+        stacked = orbital_grid.orbitals_cube_data(orbitals, resolution=resolution, border=6)
+    data = stacked.data.reshape((len(orbitals),) + tuple(stacked.dimensions))
+    occupations = np.array([orbital.occupation for orbital in orbitals])
+    grids = []
+    for label, values in ((f'orbital {orbitals[-1].ID}', data[-1]),
+                          ('total density', np.einsum('i,ijkl->jkl', occupations, data * data))):
+        grids.append((f'{label} at {resolution} bohr', CubeData({
+            'title': [label, ''], 'atoms': stacked.atoms, 'natoms': len(stacked.atoms),
+            'origin': stacked.origin, 'cells': stacked.cells, 'dimensions': stacked.dimensions,
+            'orbitals': False, 'data': values})))
+    return grids
+
+
+def synthetic_grid(size):
+    lines = (REPO_ROOT / 'malonaldehyde.molpro' / 'malonaldehyde.xyz').read_text().splitlines()
+    xyz = np.array([[float(c) * ANGSTROM for c in line.split()[1:4]] for line in lines[2:] if line.split()])
+    lower, upper = xyz.min(axis=0) - 6, xyz.max(axis=0) + 6
+    spacing = float(np.max(upper - lower)) / (size - 1)
+    axes = [lower[i] + spacing * np.arange(size) for i in range(3)]
+    data = np.zeros((size, size, size))
+    for centre in xyz:
+        gx, gy, gz = (np.exp(-0.5 * (axes[i] - centre[i]) ** 2) for i in range(3))
+        data += gx[:, None, None] * gy[None, :, None] * gz[None, None, :]
+    return f'synthetic {size}^3 density', CubeData({
+        'title': ['synthetic', ''], 'atoms': [], 'natoms': 0, 'origin': tuple(lower),
+        'cells': np.diag([spacing] * 3), 'dimensions': [size] * 3, 'orbitals': False, 'data': data})
+
+
+def benchmark(label, cube_data, repeat, threads):
+    grid = prepare_grid(create_vtk_image_data(cube_data))
+    print(f'{label}: {"x".join(str(n) for n in cube_data.dimensions)} grid')
+    for engine in ISOSURFACE_ENGINES:
+        if engine == 'flying_edges_smp':
+            use_smp_threads(threads)
+        else:
+            # threaded SMP is for the whole process; time the other engines without it
+            vtkSMPTools.SetBackend('Sequential')
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            surface = contour(grid, CONTOUR_VALUE, engine=engine)
+            times.append(time.perf_counter() - start)
+        print(f'  {engine:18} {min(times) * 1000:9.1f} ms  {surface.GetNumberOfPolys():9d} triangles')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of this many timings')
+    parser.add_argument('--threads', type=int, default=0, help='threads for flying_edges_smp (0 for all cores)')
+    parser.add_argument('--size', type=int, default=200, help='edge length of the synthetic grid')
+    parser.add_argument('--fine', type=float, default=0.1, help='the finer grid spacing, in bohr')
+    args = parser.parse_args()
+    for label, cube_data in project_grids(0.3) + project_grids(args.fine) + [synthetic_grid(args.size)]:
+        benchmark(label, cube_data, args.repeat, args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Time the evaluation of orbital grids through pymolpro's Orbital.cube_data()
+against iMolpro.orbital_grid's blocked, distance-screened engine, for the
+orbitals of a Molpro project (by default a copy of the TestProject that ships
+with pymolpro), and report the largest difference between the two on the same
+grid points.
+
+Each orbital is evaluated both untrimmed (the whole atom box plus border) and
+trimmed to the threshold MoleculeDisplay.get_cube() uses for the default
+contour value.
+
+Usage: benchmark_orbital_grid.py [--project PROJECT.molpro] [--resolution BOHR] [--border BOHR] [--orbitals N]
+"""
+import argparse
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pymolpro
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / 'src'))
+
+from iMolpro import orbital_grid
+
+CONTOUR_VALUE = 0.1
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def benchmark(orbital, resolution, border):
+    print(f'orbital {orbital.ID}:')
+    for label, threshold in (('untrimmed', None), (f'threshold {CONTOUR_VALUE * .1:g}', CONTOUR_VALUE * .1)):
+        pymolpro_time, reference = timed(orbital.cube_data, resolution=resolution, border=border,
+                                         threshold=threshold)
+        screened_time, cube = timed(orbital_grid.cube_data, orbital, resolution=resolution, border=border,
+                                    threshold=threshold)
+        print(f'  {label:18} pymolpro {pymolpro_time:8.3f} s ({"x".join(map(str, reference.dimensions))}), '
+              f'screened {screened_time:8.3f} s ({"x".join(map(str, cube.dimensions))}), '
+              f'speedup {pymolpro_time / screened_time:6.1f}x')
+        if threshold is None:
+            print(f'  {"":18} largest difference {np.max(np.abs(reference.data - cube.data)):.2e}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--project', help='Molpro project to take the orbitals from')
+    parser.add_argument('--resolution', type=float, default=0.1, help='grid spacing in bohr')
+    parser.add_argument('--border', type=float, default=6.0, help='grid extent beyond the atoms in bohr')
+    parser.add_argument('--orbitals', type=int, default=3, help='how many of the highest orbitals to time')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        project = args.project
+        if project is None:
+            project = pathlib.Path(temporary_directory) / 'TestProject.molpro'
+            shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project)
+        orbitals = pymolpro.Project(str(project)).orbitals(instance=-1)
+        for orbital in orbitals[-args.orbitals:]:
+            benchmark(orbital, args.resolution, args.border)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Time what MoleculeDisplay does on the GUI thread before an orbital is first
+drawn, against the ~100 ms it should take: with progressive rendering, the
+PROGRESSIVE_COARSENING times coarser grid from PROGRESSIVE_BACKEND and its
+isosurface; without it, or for the grid the background evaluation delivers
+later, the full-resolution grid from the given backend and its isosurface;
+and, for an orbital whose grid is already in the run directory's disk cache,
+reading it back.
+
+The orbitals are those of a Molpro project (by default the TestProject that
+ships with pymolpro), copied to a temporary directory so that the disk cache
+starts empty and the project is left untouched.
+
+Usage: benchmark_progressive.py [--project PROJECT.molpro] [--resolution BOHR] [--backend NAME] [--orbitals N]
+"""
+import argparse
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+
+import pymolpro
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / 'src'))
+
+from iMolpro.cube_cache import ORBITAL_GRID_BACKENDS, orbital_cube_data, stored_orbital_cube_data
+from iMolpro.isosurface import isosurface, prepare_grid
+from iMolpro.vtk_molecule_widget import MoleculeDisplay, create_vtk_image_data
+
+CONTOUR_VALUE = 0.1
+TARGET = 0.1
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def first_draw(orbital, resolution, backend):
+    r"""The time to evaluate, or read back, the grid of `orbital` and contour it, and the grid's dimensions."""
+    threshold = CONTOUR_VALUE * .1
+    grid_time, cube = timed(orbital_cube_data, orbital, resolution=resolution, threshold=threshold, border=6,
+                            backend=backend)
+    surface_time, surface = timed(isosurface, prepare_grid(create_vtk_image_data(cube)), CONTOUR_VALUE)
+    return grid_time + surface_time, cube.dimensions
+
+
+def report(label, seconds, dimensions):
+    verdict = 'ok' if seconds <= TARGET else 'over target'
+    print(f'  {label:28} {1000 * seconds:8.1f} ms ({"x".join(map(str, dimensions))}) {verdict}')
+
+
+def benchmark(orbital, resolution, backend):
+    print(f'orbital {orbital.ID}:')
+    report(f'coarse ({MoleculeDisplay.PROGRESSIVE_BACKEND})',
+           *first_draw(orbital, resolution * MoleculeDisplay.PROGRESSIVE_COARSENING,
+                       MoleculeDisplay.PROGRESSIVE_BACKEND))
+    report(f'full resolution ({backend})', *first_draw(orbital, resolution, backend))
+    read_time, cube = timed(stored_orbital_cube_data, orbital, resolution=resolution, threshold=CONTOUR_VALUE * .1,
+                            border=6, backend=backend)
+    report('full resolution, from disk', read_time, cube.dimensions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--project', help='Molpro project to take the orbitals from')
+    parser.add_argument('--resolution', type=float, default=0.3, help='grid spacing in bohr')
+    parser.add_argument('--backend', choices=ORBITAL_GRID_BACKENDS, default='pymolpro',
+                        help='backend for the full-resolution grid, as the orbital_grid_backend setting')
+    parser.add_argument('--orbitals', type=int, default=3, help='how many of the highest orbitals to time')
+    args = parser.parse_args()
+    source = pathlib.Path(args.project or pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro')
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        project = pathlib.Path(temporary_directory) / source.name
+        shutil.copytree(source, project)
+        orbitals = pymolpro.Project(str(project)).orbitals(instance=-1)
+        for orbital in orbitals[-args.orbitals:]:
+            benchmark(orbital, args.resolution, args.backend)
+
+
+if __name__ == '__main__':
+    main()
@@ -58,7 +58,7 @@ from .utilities import EditFile, writable_directory
 from .backend import configure_backend, BackendConfigurationEditor
 from .settings import settings
 from .theme import apply_theme
-from .vtk_molecule_widget import MoleculeScene
+from .vtk_molecule_widget import MoleculeScene, MoleculeDisplay
 
 from .status_bar import StatusBar
 from .output_tabs import MyTabWidget, OutputTabWidget
@@ -746,6 +746,8 @@ class ProjectWindow(QMainWindow):
     def closeEvent(self, a0, QCloseEvent=None):
         for scene in self.findChildren(MoleculeScene):
             scene.Finalize()
+        for display in self.findChildren(MoleculeDisplay):
+            display.release_cubes()
         self.close_signal.emit(self)
 
     def new_action(self):
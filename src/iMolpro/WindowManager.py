@@ -1,3 +1,4 @@
+import logging
 import os
 import shutil
 
@@ -10,9 +11,12 @@ except ImportError:
         from PyQt5.QtWidgets import QWidget, QFileDialog, QMessageBox
 from .utilities import force_suffix
 from .settings import settings
+from .cube_cache import shared_cube_cache
 from . import cli_install
 from . import cli_install_ui
 
+logger = logging.getLogger(__name__)
+
 
 class WindowManager:
     def __init__(self):
@@ -21,6 +25,10 @@ class WindowManager:
         self.fullAction = None
         self.cli_install_action = None
         self.cli_install_action_owner = None
+        settings.add_default('cube_cache_megabytes', 1024)
+        # Orbital and density grids for every window, so that the same run opened twice is evaluated once;
+        # the budget is for the whole application.
+        self.cube_cache = shared_cube_cache(int(float(settings['cube_cache_megabytes']) * 1e6))
 
     def get_cli_install_action(self):
         """The single, shared 'Install command line tool...' QAction,
@@ -67,6 +75,7 @@ class WindowManager:
 
     def unregister(self, widget: QWidget):
         self.openWindows.remove(widget)
+        logger.debug(f'Window closed; shared cube cache {self.cube_cache.statistics}')
         if self.emptyAction and not self.openWindows:
             self.emptyAction()
 
@@ -0,0 +1,70 @@
+r"""
+Bond perception: which pairs of atoms are close enough, relative to their covalent radii, to be drawn bonded.
+
+Atoms are binned into a cell list, a grid of cubic cells whose edge is the longest bond length possible for the
+elements present, so that any bonded pair lies in the same or adjacent cells. For each of the 27 offsets to an
+adjacent cell, the candidate pairs for every atom at once are generated and tested with NumPy, so the cost grows
+linearly with the number of atoms rather than with the number of pairs.
+"""
+import itertools
+
+import numpy as np
+from ase.data import covalent_radii
+
+ANGSTROM = 1.8897161646321
+
+# Atoms are bonded when BOND_TOLERANCE times their distance is less than the sum of their covalent radii.
+BOND_TOLERANCE = 0.9
+
+_NEIGHBOUR_OFFSETS = np.array(list(itertools.product((-1, 0, 1), repeat=3)))
+
+
+def bonded_pairs(xyz, atomic_numbers) -> np.ndarray:
+    r"""
+    The bonded pairs among atoms at positions `xyz` (bohr) with `atomic_numbers`, as an (M, 2) array of indices
+    `(i, j)` with `i > j`, in ascending order of `i` and then `j`.
+    """
+    xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+    radii = covalent_radii[np.asarray(atomic_numbers, dtype=int)]
+    if len(xyz) < 2:
+        return np.empty((0, 2), dtype=int)
+    cutoff = 2 * radii.max() * ANGSTROM / BOND_TOLERANCE
+    # one empty cell of padding either side, so that the neighbours of every cell can be encoded
+    cells = np.floor((xyz - xyz.min(axis=0)) / cutoff).astype(np.int64) + 1
+    shape = cells.max(axis=0) + 2
+
+    def encode(cells_):
+        return (cells_[:, 0] * shape[1] + cells_[:, 1]) * shape[2] + cells_[:, 2]
+
+    keys = encode(cells)
+    order = np.argsort(keys, kind='stable')
+    cell_keys, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+    pairs = []
+    for offset in _NEIGHBOUR_OFFSETS:
+        neighbour_keys = encode(cells + offset)
+        positions = np.minimum(np.searchsorted(cell_keys, neighbour_keys), len(cell_keys) - 1)
+        occupied = np.flatnonzero(cell_keys[positions] == neighbour_keys)
+        if not len(occupied):
+            continue
+        sizes = counts[positions[occupied]]
+        i = np.repeat(occupied, sizes)
+        # the index of each candidate within its neighbour cell's run of atoms
+        within = np.arange(len(i)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        j = order[np.repeat(starts[positions[occupied]], sizes) + within]
+        candidates = i > j
+        i, j = i[candidates], j[candidates]
+        distances = np.linalg.norm(xyz[i] - xyz[j], axis=1)
+        bonded = BOND_TOLERANCE * distances / ANGSTROM < radii[i] + radii[j]
+        pairs.append(np.stack([i[bonded], j[bonded]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=int)
+    pairs = np.concatenate(pairs)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def perceive_bonds(atoms: list[dict]) -> list[tuple[int, int]]:
+    r"""bonded_pairs() for a list of atoms as dicts with keys atomic_number and xyz."""
+    if not atoms:
+        return []
+    return [(int(i), int(j)) for i, j in bonded_pairs([atom['xyz'] for atom in atoms],
+                                                      [atom['atomic_number'] for atom in atoms])]
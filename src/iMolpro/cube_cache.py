@@ -0,0 +1,609 @@
+import concurrent.futures
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from lxml import etree
+from pymolpro.cube_data import CubeData
+from pymolpro.grid import namespaces
+
+from . import orbital_grid
+
+logger = logging.getLogger(__name__)
+
+# Orbital grids are cached in this subdirectory of the run directory that holds the .xml file
+# they were evaluated from, in one subdirectory per XML content hash (see OrbitalCubeDiskCache).
+CACHE_DIRECTORY = '.cube_cache'
+
+# Binary grid file layout: MAGIC, then the byte offset of the data block as a little-endian
+# uint64, then a UTF-8 JSON header holding everything in CubeData except its data, padded with
+# spaces so that the data block -- the grid as raw little-endian float32 in C order -- starts
+# on a DATA_ALIGNMENT boundary and can be mapped straight into memory with np.memmap.
+MAGIC = b'iMolCube'
+DATA_ALIGNMENT = 64
+_OFFSET = struct.Struct('<Q')
+
+# How orbital_cube_data() evaluates a grid: 'pymolpro' through Orbital.cube_data(), 'screened' through
+# iMolpro.orbital_grid's blocked, distance-screened evaluation.
+ORBITAL_GRID_BACKENDS = ('pymolpro', 'screened')
+
+
+def write_cube_binary(filename: str, cube_data: CubeData):
+    r"""
+    Write `cube_data` to `filename` in the binary grid layout described above. The file is written
+    under a temporary name and renamed into place, so a reader never sees a partly-written grid.
+    """
+    header = json.dumps({
+        'title': list(cube_data.title),
+        'natoms': len(cube_data.atoms),
+        'atoms': [{'atomic_number': int(atom['atomic_number']),
+                   'charge': float(atom.get('charge', atom['atomic_number'])),
+                   'xyz': [float(c) for c in atom['xyz']]} for atom in cube_data.atoms],
+        'origin': [float(c) for c in cube_data.origin],
+        'cells': np.asarray(cube_data.cells, dtype=np.float64).tolist(),
+        'dimensions': [int(n) for n in cube_data.dimensions],
+        'orbitals': bool(cube_data.orbitals),
+        'orbital_identifiers': [str(identifier) for identifier in getattr(cube_data, 'orbital_identifiers', [])],
+    }).encode('utf-8')
+    offset = -(-(len(MAGIC) + _OFFSET.size + len(header)) // DATA_ALIGNMENT) * DATA_ALIGNMENT
+    header += b' ' * (offset - len(MAGIC) - _OFFSET.size - len(header))
+    temporary = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(MAGIC + _OFFSET.pack(offset) + header)
+            np.ascontiguousarray(cube_data.data, dtype='<f4').tofile(f)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def read_cube_binary(filename: str) -> CubeData:
+    r"""
+    Open a grid written by write_cube_binary(). Only the header is actually read; the returned
+    CubeData's data is a read-only float32 np.memmap of the file, paged in as it is used.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{filename} is not a cached cube grid')
+        offset, = _OFFSET.unpack(f.read(_OFFSET.size))
+        header = json.loads(f.read(offset - len(MAGIC) - _OFFSET.size).decode('utf-8'))
+    header['atoms'] = [dict(atom, xyz=tuple(atom['xyz'])) for atom in header['atoms']]
+    header['origin'] = tuple(header['origin'])
+    header['cells'] = np.array(header['cells'], dtype=np.float64)
+    header['data'] = np.memmap(filename, dtype='<f4', mode='r', offset=offset, shape=tuple(header['dimensions']))
+    return CubeData(header)
+
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(filename: str) -> str:
+    r"""SHA-256 of a file's contents, remembered for as long as its size and modification time stay the same."""
+    stat = os.stat(filename)
+    signature = stat.st_size, stat.st_mtime_ns
+    with _digests_lock:
+        if filename in _digests and _digests[filename][0] == signature:
+            return _digests[filename][1]
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    with _digests_lock:
+        _digests[filename] = signature, digest.hexdigest()
+    return digest.hexdigest()
+
+
+# The most bytes of grid files that each run directory's OrbitalCubeDiskCache keeps, until the owner passes
+# settings['cube_disk_cache_megabytes'] to OrbitalCubeDiskCache.set_budget().
+DISK_CACHE_BYTES = 1024 * 1000 * 1000
+
+
+class OrbitalCubeDiskCache:
+    r"""
+    Persistent cache of orbital grids for one run directory. Entries live in
+    `<run directory>/.cube_cache/<hash of the run's .xml>/`, so editing or regenerating the .xml
+    file moves the cache to a fresh subdirectory; subdirectories for any other hash are stale,
+    and are deleted when the cache is opened.
+    Each subdirectory holds at most `budget` bytes of grid files: once a put() takes it over, the least recently
+    used files, by modification time, which get() renews, are deleted. The budget is shared by every run, and,
+    like CubeCache's, is only changed by set_budget() on the GUI thread, as settings can't be read by the worker
+    threads that fill the cache.
+    """
+
+    budget = DISK_CACHE_BYTES
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, run_directory: str, xml_path: str):
+        self.xml_path = xml_path
+        self.digest = file_digest(xml_path)
+        cache_root = os.path.join(run_directory, CACHE_DIRECTORY)
+        self.directory = os.path.join(cache_root, self.digest[:32])
+        if os.path.isdir(cache_root):
+            for entry in os.listdir(cache_root):
+                if entry != os.path.basename(self.directory):
+                    shutil.rmtree(os.path.join(cache_root, entry), ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        self._evict_lock = threading.Lock()
+
+    @classmethod
+    def set_budget(cls, budget: int):
+        cls.budget = int(budget)
+
+    @staticmethod
+    def xml_filename(orbital) -> str | None:
+        r"""
+        The .xml file of the run that `orbital` came from, or None if that can't be determined. Orbitals made by
+        pymolpro's Project know the run directory they were read from, and its .xml is named after that directory.
+        """
+        run_directory = getattr(orbital, 'directory', None)
+        if not run_directory or not os.path.isdir(run_directory):
+            return None
+        return os.path.join(run_directory,
+                            os.path.splitext(os.path.basename(os.path.normpath(run_directory)))[0] + '.xml')
+
+    @classmethod
+    def for_orbital(cls, orbital):
+        r"""
+        The cache for the run that `orbital` came from, or None if that can't be determined or
+        the run directory isn't writable.
+        """
+        xml_path = cls.xml_filename(orbital)
+        if xml_path is None:
+            return None
+        run_directory = os.path.dirname(xml_path)
+        try:
+            digest = file_digest(xml_path)
+            key = os.path.abspath(run_directory), digest
+            with cls._instances_lock:
+                if key not in cls._instances:
+                    cls._instances[key] = cls(run_directory, xml_path)
+                return cls._instances[key]
+        except OSError:
+            return None
+
+    def filename(self, key: tuple) -> str:
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32] + '.grid')
+
+    def get(self, key: tuple) -> CubeData | None:
+        filename = self.filename(key)
+        try:
+            cube_data = read_cube_binary(filename)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return cube_data
+
+    def put(self, key: tuple, cube_data: CubeData):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_cube_binary(self.filename(key), cube_data)
+        except OSError:
+            return
+        self._evict(keep=self.filename(key))
+
+    def _evict(self, keep: str):
+        r"""Delete the least recently used grid files, other than `keep`, until the rest fit in the budget."""
+        with self._evict_lock:
+            files = []
+            try:
+                with os.scandir(self.directory) as entries:
+                    for entry in entries:
+                        if entry.name.endswith('.grid'):
+                            stat = entry.stat()
+                            files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            except OSError:
+                return
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.budget:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    # a grid still mapped into memory stays readable where the system allows it to be deleted,
+                    # and otherwise is left for a later put()
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+def orbital_set_path(orbital) -> str | None:
+    r"""
+    Where the orbital set of `orbital` is in its run's .xml, as an XPath, or None if it isn't known. Orbital IDs
+    repeat from one orbital set to the next, and from one molecule instance to the next, eg. the geometries of an
+    optimisation, so the ID alone doesn't identify an orbital of a run.
+    """
+    node = getattr(orbital, 'node', None)
+    if node is None:
+        return None
+    orbital_set = node.getparent()
+    return orbital_set.getroottree().getpath(orbital_set)
+
+
+def stored_orbital_cube_data(orbital, resolution: float, threshold: float, border: float,
+                             backend: str = 'pymolpro') -> CubeData | None:
+    r"""
+    The grid orbital_cube_data() would return, if it is already in the run directory's OrbitalCubeDiskCache,
+    otherwise None; nothing is evaluated, so this is quick enough to call on the GUI thread.
+    """
+    if backend not in ORBITAL_GRID_BACKENDS:
+        raise ValueError(f'unknown orbital grid backend {backend!r}; expected one of {ORBITAL_GRID_BACKENDS}')
+    cache = OrbitalCubeDiskCache.for_orbital(orbital)
+    key = orbital_set_path(orbital), orbital.ID, float(resolution), float(threshold), float(border), backend
+    return cache.get(key) if cache is not None else None
+
+
+def orbital_cube_data(orbital, resolution: float, threshold: float, border: float,
+                      backend: str = 'pymolpro') -> CubeData:
+    r"""
+    `orbital.cube_data(resolution=resolution, threshold=threshold, border=border)`, or its equivalent from
+    iMolpro.orbital_grid if `backend` is 'screened', read back from the run directory's OrbitalCubeDiskCache
+    if it has been evaluated before, and saved there otherwise.
+    """
+    if (cube_data := stored_orbital_cube_data(orbital, resolution, threshold, border, backend)) is not None:
+        return cube_data
+    cache = OrbitalCubeDiskCache.for_orbital(orbital)
+    key = orbital_set_path(orbital), orbital.ID, float(resolution), float(threshold), float(border), backend
+    if backend == 'screened':
+        cube_data = orbital_grid.cube_data(orbital, resolution=resolution, threshold=threshold, border=border)
+    else:
+        cube_data = orbital.cube_data(resolution=resolution, threshold=threshold, border=border)
+    if cache is not None:
+        cache.put(key, cube_data)
+    return cube_data
+
+
+def density_key(density: orbital_grid.Density) -> tuple:
+    r"""
+    What identifies a Density's grid in an OrbitalCubeDiskCache: for each term, the content hash of the .xml it came
+    from, the place of its orbital set in that file (orbital IDs repeat from one set to the next), the orbital IDs
+    and the weights.
+    """
+    key = ['density']
+    for orbitals, weights in density.terms:
+        xml_filename = OrbitalCubeDiskCache.xml_filename(orbitals[0])
+        try:
+            digest = file_digest(xml_filename) if xml_filename is not None else None
+        except OSError:
+            digest = None
+        key.append((digest, orbital_set_path(orbitals[0]),
+                    tuple(orbital.ID for orbital in orbitals), tuple(float(weight) for weight in weights)))
+    return tuple(key)
+
+
+def stored_density_cube_data(density: orbital_grid.Density, resolution: float, threshold: float,
+                             border: float) -> CubeData | None:
+    r"""The grid density_cube_data() would return, if it is already on disk, otherwise None."""
+    cache = OrbitalCubeDiskCache.for_orbital(density.terms[0][0][0])
+    key = density_key(density), float(resolution), float(threshold), float(border)
+    return cache.get(key) if cache is not None else None
+
+
+def density_cube_data(density: orbital_grid.Density, resolution: float, threshold: float,
+                      border: float) -> CubeData:
+    r"""
+    `density.cube_data(resolution=resolution, threshold=threshold, border=border)`, kept in the
+    OrbitalCubeDiskCache of the run of the density's first orbital just as orbital_cube_data() keeps orbitals.
+    """
+    if (cube_data := stored_density_cube_data(density, resolution, threshold, border)) is not None:
+        return cube_data
+    cache = OrbitalCubeDiskCache.for_orbital(density.terms[0][0][0])
+    key = density_key(density), float(resolution), float(threshold), float(border)
+    cube_data = density.cube_data(resolution=resolution, threshold=threshold, border=border)
+    if cache is not None:
+        cache.put(key, cube_data)
+    return cube_data
+
+
+class CubeCache:
+    r"""
+    In-memory least-recently-used cache of grids, bounded by the total size of the values it holds
+    rather than by their number. `budget` is a byte count; to follow a setting that changes while the
+    cache is alive, the owner passes its new value to set_budget() on the GUI thread, as worker threads
+    mustn't read settings. The most recently stored value is always kept, even if on its own it exceeds
+    the budget. Safe to use from several threads, so that CubePrefetcher's workers can fill it.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = int(budget)
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None, accept=None):
+        r"""
+        The value stored for `key`, marking it most recently used, or `default` if there is none, or
+        if `accept` is given and returns False for the stored value. Counted as a hit or a miss accordingly.
+        """
+        with self._lock:
+            if key in self._entries and (accept is None or accept(self._entries[key][0])):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        r"""The value stored for `key`, or `default`, without counting a hit or miss or changing its recency."""
+        with self._lock:
+            return self._entries[key][0] if key in self._entries else default
+
+    def put(self, key, value, nbytes: int):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = value, int(nbytes)
+            self.nbytes += int(nbytes)
+            self._evict()
+
+    def set_budget(self, budget: int):
+        r"""Change the budget, evicting at once whatever no longer fits in it."""
+        with self._lock:
+            self.budget = int(budget)
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            while self.nbytes > self.budget and len(self._entries) > 1:
+                evicted_key, (evicted, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+                self.evicted_bytes += evicted_nbytes
+                logger.debug(f'CubeCache evicted {evicted_key}, {evicted_nbytes} bytes; {self.statistics}')
+
+    def discard(self, key):
+        r"""Forget the value stored for `key`, if there is one."""
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    @property
+    def statistics(self) -> dict:
+        return {'entries': len(self._entries), 'bytes': self.nbytes, 'budget': self.budget,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'evicted_bytes': self.evicted_bytes}
+
+
+@functools.lru_cache(maxsize=16)
+def _basis_digest(molecule) -> bytes:
+    r"""A hash of the orbital basis set of `molecule`, and how its orbitals use it, remembered per molecule."""
+    digest = hashlib.sha256()
+    for basis_set in molecule.xpath('molpro-output:basisSet[@id="ORBITAL"]', namespaces=namespaces):
+        digest.update(etree.tostring(basis_set))
+    for orbital_set in molecule.xpath('molpro-output:orbitals[1]', namespaces=namespaces):
+        digest.update(str(orbital_set.get('angular')).encode('utf-8'))
+    return digest.digest()
+
+
+def content_digest(orbital) -> str:
+    r"""
+    A hash of everything an orbital's grid depends on -- its coefficients, the geometry and the basis set -- so that
+    the same orbital read from the same run by different windows has the same digest; for a Density, of the digests
+    and weights of its orbitals.
+    """
+    digest = hashlib.sha256()
+    if isinstance(orbital, orbital_grid.Density):
+        for orbitals, weights in orbital.terms:
+            digest.update(json.dumps([content_digest(term) for term in orbitals]).encode('utf-8'))
+            digest.update(np.ascontiguousarray(weights, dtype='<f8').tobytes())
+        return digest.hexdigest()
+    digest.update(np.ascontiguousarray(orbital.coefficients, dtype='<f8').tobytes())
+    digest.update(json.dumps([[int(atom['atomic_number']), [float(c) for c in atom['xyz']]]
+                              for atom in orbital.atoms]).encode('utf-8'))
+    digest.update(_basis_digest(orbital_grid.molecule_node(orbital)))
+    return digest.hexdigest()
+
+
+class SharedCubeCache(CubeCache):
+    r"""
+    A CubeCache for the whole process, shared by every view of a grid, with reference-counted entries. Values are
+    stored and looked up on behalf of an `owner` -- one per view, see CubeCacheView -- and an entry is freed as
+    soon as the last owner that stored or looked it up releases it, as well as when the budget needs its space.
+    """
+
+    def __init__(self, budget: int):
+        super().__init__(budget)
+        self._owners = {}
+
+    def get(self, key, default=None, accept=None, owner=None):
+        with self._lock:
+            value = super().get(key, default, accept)
+            if owner is not None and key in self._entries:
+                self._owners.setdefault(key, set()).add(owner)
+            return value
+
+    def put(self, key, value, nbytes: int, owner=None):
+        with self._lock:
+            super().put(key, value, nbytes)
+            if owner is not None:
+                self._owners.setdefault(key, set()).add(owner)
+            for evicted in [key for key in self._owners if key not in self._entries]:
+                del self._owners[evicted]
+
+    def references(self, key) -> int:
+        r"""How many owners hold the entry for `key`."""
+        with self._lock:
+            return len(self._owners.get(key, ()))
+
+    def release(self, owner):
+        r"""Drop all of `owner`'s references, freeing every entry that no other owner holds."""
+        with self._lock:
+            for key, owners in list(self._owners.items()):
+                owners.discard(owner)
+                if not owners:
+                    del self._owners[key]
+                    self.discard(key)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._owners.clear()
+
+    def view(self, content_key):
+        return CubeCacheView(self, content_key)
+
+
+class CubeCacheView:
+    r"""
+    One view's window onto a SharedCubeCache, with the interface of CubeCache for MoleculeDisplay and CubePrefetcher.
+    The view's own keys are translated by `content_key` into the shared cache's, which are meant to depend only on
+    the content of a grid, so that identical grids in different views are computed once. close() releases the
+    view's references.
+    """
+
+    def __init__(self, shared: SharedCubeCache, content_key):
+        self.shared = shared
+        self.content_key = content_key
+
+    def get(self, key, default=None, accept=None):
+        return self.shared.get(self.content_key(key), default, accept, owner=self)
+
+    def peek(self, key, default=None):
+        return self.shared.peek(self.content_key(key), default)
+
+    def put(self, key, value, nbytes: int):
+        self.shared.put(self.content_key(key), value, nbytes, owner=self)
+
+    def __contains__(self, key):
+        return self.content_key(key) in self.shared
+
+    @property
+    def statistics(self) -> dict:
+        return self.shared.statistics
+
+    def close(self):
+        self.shared.release(self)
+
+
+_shared_cube_cache = None
+_shared_cube_cache_lock = threading.Lock()
+
+
+def shared_cube_cache(budget: int) -> SharedCubeCache:
+    r"""
+    The process-wide SharedCubeCache, created with `budget` (see CubeCache) by whoever first asks for it, and
+    given `budget` by everyone that asks after, so that it follows the setting that it comes from.
+    """
+    global _shared_cube_cache
+    with _shared_cube_cache_lock:
+        if _shared_cube_cache is None:
+            _shared_cube_cache = SharedCubeCache(budget)
+        else:
+            _shared_cube_cache.set_budget(budget)
+        return _shared_cube_cache
+
+
+# Worker threads shared by every CubePrefetcher. Grid evaluation is mostly NumPy, which releases
+# the GIL, so a couple of workers overlap usefully without starving the GUI thread.
+PREFETCH_WORKERS = 2
+_prefetch_executor = None
+_prefetch_executor_lock = threading.Lock()
+
+
+def prefetch_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _prefetch_executor
+    with _prefetch_executor_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_WORKERS,
+                                                                       thread_name_prefix='cube-prefetch')
+        return _prefetch_executor
+
+
+class CubePrefetcher:
+    r"""
+    Evaluates grids ahead of need on the shared prefetch worker pool, storing them in a CubeCache as
+    the `(threshold, grid)` pairs that MoleculeDisplay.get_cube() looks up, where `grid` is
+    `evaluate(key, threshold)`. schedule() replaces the whole set of wanted grids, so work queued
+    for grids no longer wanted is dropped whenever the selection moves on; work that has already
+    started runs to completion, and its result is still cached. If given, `on_ready(key)` is
+    called, on the worker thread, as each grid is stored.
+    """
+
+    def __init__(self, cache: CubeCache, evaluate, executor=None, on_ready=None):
+        self.cache = cache
+        self.evaluate = evaluate
+        self.executor = executor
+        self.on_ready = on_ready
+        self._pending = {}
+        # Reentrant: cancelling a future runs its done-callback, _finished(), synchronously.
+        self._lock = threading.RLock()
+
+    def _cached(self, key, threshold) -> bool:
+        cached = self.cache.peek(key)
+        return cached is not None and cached[0] <= threshold
+
+    def schedule(self, requests: list[tuple]):
+        r"""Prefetch each `(key, threshold)` in `requests` not already cached, cancelling any other queued work."""
+        wanted = dict(requests)
+        with self._lock:
+            for key, (threshold, future) in list(self._pending.items()):
+                if key not in wanted or wanted[key] < threshold:
+                    future.cancel()
+            for key, threshold in requests:
+                if key in self._pending or self._cached(key, threshold):
+                    continue
+                future = (self.executor or prefetch_executor()).submit(self._evaluate, key, threshold)
+                self._pending[key] = threshold, future
+                future.add_done_callback(lambda future, key=key: self._finished(key, future))
+
+    def _evaluate(self, key, threshold):
+        grid = self.evaluate(key, threshold)
+        self.cache.put(key, (threshold, grid), grid.data.nbytes)
+        if self.on_ready is not None:
+            self.on_ready(key)
+
+    def _finished(self, key, future):
+        with self._lock:
+            if key in self._pending and self._pending[key][1] is future:
+                del self._pending[key]
+        if not future.cancelled() and future.exception() is not None:
+            logger.debug(f'Prefetch of {key} failed: {future.exception()!r}')
+
+    def wait(self, key, threshold) -> bool:
+        r"""If a prefetch that would satisfy `(key, threshold)` is queued or running, wait for it and return True."""
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is None or pending[0] > threshold:
+            return False
+        concurrent.futures.wait([pending[1]])
+        return True
+
+    def cancel(self):
+        r"""Drop all queued prefetches. Ones already running finish in the background."""
+        with self._lock:
+            for threshold, future in list(self._pending.values()):
+                future.cancel()
+
+    @property
+    def pending(self) -> list:
+        with self._lock:
+            return list(self._pending)
@@ -1,13 +1,59 @@
+import io
+
 import numpy as np
 
+# Size of each text chunk read_values() tokenises in one go. Big enough that the per-chunk
+# Python overhead is negligible, small enough that a few-hundred-MB cube file never has to
+# be held in memory as one string alongside its parsed values.
+READ_CHUNK_BYTES = 1 << 24
+
+# Number of values CubeData.write() formats in one go, for the same reasons.
+WRITE_CHUNK_VALUES = 1 << 20
+
 
 class CubeData:
-    def __init__(self, source: str):
+    r"""
+    A volumetric grid as held in a Gaussian cube file, read from a .cube file or built from a dict of its attributes.
+
+    A grid holding several orbitals, or several values at each point, keeps them stacked as a
+    (N, nx, ny, nz) array, one orbital or value after another; a grid holding just one keeps the plain
+    (nx, ny, nz) array. select() picks out any one of them as a grid of its own.
+
+    This is for cube files read or written outside the display. The display itself reads no cube files: its grids
+    are pymolpro CubeData evaluated in memory, or read back from the binary files of cube_cache.
+    """
+
+    def __init__(self, source: str | dict):
         if type(source) == str and source.endswith('.cube'):
             self.load_from_cube_file(source)
+        elif isinstance(source, dict):
+            for attr in ['title', 'natoms', 'origin', 'orbitals', 'nval', 'dimensions', 'cells', 'atoms', 'data',
+                         'orbital_identifiers']:
+                if attr in source:
+                    setattr(self, attr, source[attr])
         else:
             raise ValueError('Invalid cube data source')
 
+    @property
+    def nvalues(self) -> int:
+        r"""The number of orbitals or values held at each grid point."""
+        return 1 if self.data.ndim == 3 else self.data.shape[0]
+
+    def select(self, index: int):
+        r"""A CubeData holding just the `index`th of the orbitals or values in this one, sharing its data."""
+        if self.nvalues == 1:
+            if index not in (0, -1):
+                raise IndexError(f'CubeData index {index} out of range')
+            return self
+        result = CubeData({attr: getattr(self, attr) for attr in
+                           ['title', 'natoms', 'origin', 'orbitals', 'dimensions', 'cells', 'atoms']
+                           if hasattr(self, attr)})
+        result.data = self.data[index]
+        result.nval = 1
+        if hasattr(self, 'orbital_identifiers'):
+            result.orbital_identifiers = [self.orbital_identifiers[index]]
+        return result
+
     def load_from_cube_file(self, filename: str):
         with open(filename, 'r') as f:
             self.title = [f.readline().strip() for i in range(2)]
@@ -16,10 +62,7 @@ class CubeData:
             self.origin = tuple([float(line[k + 1]) for k in range(3)])
             self.orbitals = self.natoms < 0
             self.natoms = abs(self.natoms)
-            if len(line) > 4:
-                self.nval = int(line[4])
-                if self.nval > 1:
-                    raise ValueError('Multiple values not supported')
+            self.nval = int(line[4]) if len(line) > 4 else 1
             self.dimensions = []
             self.cells = np.ndarray(shape=(3, 3), dtype=np.float64)
             for i in range(3):
@@ -32,47 +75,106 @@ class CubeData:
                 line = f.readline().strip().split()
                 self.atoms.append({'atomic_number': int(line[0]), 'charge': float(line[1]),
                                    'xyz': tuple([float(line[k + 2]) for k in range(3)])})
+            nvalues = self.nval
             if self.orbitals:
+                # the orbital count, then that many identifiers, which may run on over several lines
                 line = f.readline().strip().split()
+                while len(line) < int(line[0]) + 1:
+                    line += f.readline().strip().split()
                 self.orbital_identifiers = [int(line[k + 1]) for k in range(int(line[0]))]
-                if len(self.orbital_identifiers) > 1:
-                    raise ValueError('Multiple orbitals not supported')
-            self.data = np.ndarray(shape=(self.dimensions), dtype=np.float64)
-            for i in range(self.dimensions[0]):
-                for j in range(self.dimensions[1]):
-                    k0 = 0
-                    while True:
-                        line = f.readline().strip().split()
-                        for k, value in enumerate(line):
-                            self.data[i, j, k + k0] = float(line[k])
-                        k0 += len(line)
-                        if k0 >= self.dimensions[2]:
-                            break
+                nvalues = len(self.orbital_identifiers)
+            # all the orbitals or values at a point are consecutive in the file
+            data = read_values(f, self.dimensions[0] * self.dimensions[1] * self.dimensions[2] * nvalues)
+            if nvalues == 1:
+                self.data = data.reshape(self.dimensions)
+            else:
+                self.data = np.ascontiguousarray(np.moveaxis(data.reshape(self.dimensions + [nvalues]), -1, 0))
+
     def __str__(self):
-        buffer = self.title[0] + '\n' + self.title[1] + '\n'
-        buffer += f'{self.natoms * (-1 if self.orbitals else 1)} {self.origin[0]} {self.origin[1]} {self.origin[2]} 1\n'
+        stream = io.StringIO()
+        self.write(stream)
+        return stream.getvalue()
+
+    def write(self, path_or_stream, chunk_values: int = WRITE_CHUNK_VALUES):
+        r"""
+        Write the grid in cube file format to the text stream, or the file named, `path_or_stream`. The
+        values are formatted in bulk, a block of whole (x, y) rows of about `chunk_values` values at a time,
+        so that neither the text of the whole file nor more than a block of it is ever held in memory.
+        """
+        if not hasattr(path_or_stream, 'write'):
+            with open(path_or_stream, 'w') as f:
+                return self.write(f, chunk_values)
+        f = path_or_stream
+        nval = 1 if self.orbitals else self.nvalues
+        sign = -1 if self.orbitals else 1
+        f.write(self.title[0] + '\n' + self.title[1] + '\n')
+        f.write(f'{self.natoms * sign} {self.origin[0]} {self.origin[1]} {self.origin[2]} {nval}\n')
         for i in range(3):
-            buffer += f'{self.dimensions[i]}'
-            for j in range(3):
-                buffer += f' {self.cells[i, j]}'
-            buffer += '\n'
+            f.write(f'{self.dimensions[i]} {self.cells[i, 0]} {self.cells[i, 1]} {self.cells[i, 2]}\n')
         for atom in self.atoms:
-            buffer += f'{atom["atomic_number"]} {atom["charge"]}'
-            for coord in atom["xyz"]:
-                buffer += f' {coord}'
-            buffer += '\n'
+            f.write(f'{atom["atomic_number"]} {atom["charge"]} {atom["xyz"][0]} {atom["xyz"][1]} {atom["xyz"][2]}\n')
         if self.orbitals:
-            buffer += f'{len(self.orbital_identifiers)}'
-            for identifier in self.orbital_identifiers:
-                buffer += f' {identifier}'
-            buffer += '\n'
-            for i in range(self.dimensions[0]):
-                for j in range(self.dimensions[1]):
-                    k0 = 0
-                    while k0 < self.dimensions[2]:
-                        for k in range(min(6,self.dimensions[2] - k0)):
-                            buffer += f' {self.data[i, j, k0]:.5e}'.replace('e','E')
-                            k0 += 1
-                        buffer += '\n'
-
-        return buffer
+            indices = [cube_orbital_index(identifier) for identifier in self.orbital_identifiers]
+            f.write(' '.join(str(index) for index in [len(indices)] + indices) + '\n')
+        # Each (x, y) row holds the values at every z, each point's orbitals or values together, six to a line
+        # and starting a new line at the start of each row: np.savetxt() writes a row at a time with one format
+        # string covering all of its lines.
+        rows = (self.data if self.nvalues == 1 else np.moveaxis(self.data, 0, -1)).reshape(
+            self.dimensions[0] * self.dimensions[1], -1)
+        full_lines, remainder = divmod(rows.shape[1], 6)
+        row_format = ((' %.5E' * 6 + '\n') * full_lines + ' %.5E' * remainder).removesuffix('\n')
+        rows_per_chunk = max(1, chunk_values // max(1, rows.shape[1]))
+        for start in range(0, len(rows), rows_per_chunk):
+            np.savetxt(f, rows[start:start + rows_per_chunk], fmt=row_format)
+
+
+def cube_orbital_index(identifier) -> int:
+    r"""
+    The integer a cube file gives for the orbital `identifier`. An integer, or a string of one, as read from a
+    cube file, is kept as it is; a Molpro orbital ID 'number.symmetry', such as '1.1', becomes 10 * number +
+    symmetry, as pymolpro writes it. Anything else raises ValueError.
+    """
+    if isinstance(identifier, (int, np.integer)):
+        return int(identifier)
+    text = str(identifier).strip()
+    if text.lstrip('+-').isdigit():
+        return int(text)
+    number, dot, symmetry = text.partition('.')
+    if not (dot and number.isdigit() and symmetry.isdigit() and len(symmetry) == 1):
+        raise ValueError(f'Orbital identifier {identifier!r} cannot be written to a cube file')
+    return 10 * int(number) + int(symmetry)
+
+def read_values(f, count: int, chunk_bytes: int = READ_CHUNK_BYTES) -> np.ndarray:
+    r"""
+    Read the next `count` whitespace-separated floating-point values from the text stream `f` into a flat
+    float64 array. The volumetric block of a cube file is just the values in C (x outermost, z innermost)
+    order, with line breaks carrying no information, so rather than parsing line by line the text is read
+    in chunks of about `chunk_bytes`, cut back to the last whitespace so that no number straddles two chunks,
+    and each chunk is tokenised in bulk by NumPy and copied into its slot of the preallocated result.
+    """
+    result = np.empty(count, dtype=np.float64)
+    filled = 0
+    carry = ''
+    while filled < count:
+        chunk = f.read(chunk_bytes)
+        text = carry + chunk
+        if chunk:
+            cut = max(text.rfind(' '), text.rfind('\n'))
+            if cut < 0:
+                carry = text
+                continue
+            text, carry = text[:cut], text[cut:]
+        else:
+            carry = ''
+        # np.fromstring() misparses an all-whitespace string as a single garbage value
+        if text and not text.isspace():
+            values = np.fromstring(text, dtype=np.float64, sep=' ')
+            if filled + len(values) > count:
+                values = values[:count - filled]
+            result[filled:filled + len(values)] = values
+            filled += len(values)
+        if not chunk:
+            break
+    if filled < count:
+        raise ValueError(f'Cube file data block truncated: expected {count} values, found {filled}')
+    return result
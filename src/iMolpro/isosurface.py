@@ -0,0 +1,269 @@
+import concurrent.futures
+import itertools
+import logging
+import threading
+
+import numpy as np
+from vtkmodules.vtkCommonCore import vtkSMPTools
+from vtkmodules.vtkCommonDataModel import vtkPolyData, vtkImageData
+from vtkmodules.vtkFiltersCore import vtkContourFilter, vtkFlyingEdges3D, vtkMassProperties, vtkPolyDataNormals, \
+    vtkQuadricClustering, vtkWindowedSincPolyDataFilter
+
+from .cube_cache import CubeCache
+
+logger = logging.getLogger(__name__)
+
+# The algorithms contour() can use, selected by settings['isosurface_engine']:
+#   'contour'           vtkContourFilter, VTK's general-purpose contouring (marching cubes on image data)
+#   'flying_edges'      vtkFlyingEdges3D, on whichever vtkSMPTools backend is in use (by default, single-threaded)
+#   'flying_edges_smp'  vtkFlyingEdges3D, with vtkSMPTools on its threaded backend, which use_smp_threads() switches
+#                       to with the thread count of settings['isosurface_threads'] (0 for all cores); the backend is
+#                       global to the process, so it is switched on the GUI thread when the setting is read, never
+#                       by a contouring worker, and it also threads every other SMP-aware VTK filter
+#   'accelerated'       Viskores' (formerly VTK-m's) vtkmContour, where the VTK build includes it
+# Flying edges only works on vtkImageData, so grids with non-orthogonal cells are always contoured with
+# vtkContourFilter; an engine the VTK build lacks also falls back to vtkContourFilter.
+ISOSURFACE_ENGINES = ('contour', 'flying_edges', 'flying_edges_smp', 'accelerated')
+SMP_BACKEND = 'STDThread'
+
+_smp_threads = None
+_smp_lock = threading.Lock()
+
+
+def use_smp_threads(threads: int):
+    r"""Switch vtkSMPTools to SMP_BACKEND with `threads` threads (0 for one per core), if it isn't already."""
+    global _smp_threads
+    with _smp_lock:
+        if _smp_threads == threads and vtkSMPTools.GetBackend() == SMP_BACKEND:
+            return
+        if not vtkSMPTools.SetBackend(SMP_BACKEND):
+            logger.warning(f'VTK has no {SMP_BACKEND} SMP backend; contouring with {vtkSMPTools.GetBackend()}')
+        vtkSMPTools.Initialize(threads)
+        _smp_threads = threads
+
+
+def _accelerated_contour_filter():
+    try:
+        from vtkmodules.vtkAcceleratorsVTKmFilters import vtkmContour
+    except ImportError:
+        logger.warning('This VTK build has no accelerated contouring; using vtkContourFilter')
+        return vtkContourFilter()
+    return vtkmContour()
+
+
+def contour_filter(grid, engine: str = 'contour'):
+    r"""A contouring filter of the kind `engine` (one of ISOSURFACE_ENGINES) that can take `grid`."""
+    if engine not in ISOSURFACE_ENGINES:
+        raise ValueError(f'unknown isosurface engine {engine!r}; expected one of {ISOSURFACE_ENGINES}')
+    if engine == 'accelerated':
+        return _accelerated_contour_filter()
+    if engine == 'contour' or not isinstance(grid, vtkImageData):
+        return vtkContourFilter()
+    return vtkFlyingEdges3D()
+
+
+def contour(grid, value: float, engine: str = 'contour') -> vtkPolyData:
+    r"""
+    The isosurfaces of `grid` at `-value` and `value`, as a vtkPolyData of their own, with normals and the contour
+    values as point scalars whichever `engine` (see ISOSURFACE_ENGINES) computes them.
+    """
+    contour_filter_ = contour_filter(grid, engine)
+    contour_filter_.SetComputeNormals(True)
+    contour_filter_.SetComputeScalars(True)
+    contour_filter_.SetInputData(grid)
+    contour_filter_.GenerateValues(2, [-value, value])
+    contour_filter_.Update()
+    surface = vtkPolyData()
+    surface.ShallowCopy(contour_filter_.GetOutput())
+    return surface
+
+
+def surface_nbytes(surface: vtkPolyData) -> int:
+    return surface.GetActualMemorySize() * 1024
+
+
+def level_of_detail(surface: vtkPolyData, triangles: int, smoothing: int = 0) -> vtkPolyData:
+    r"""
+    A lighter version of `surface` to draw while the camera is moving: reduced to about `triangles` triangles and
+    then, if `smoothing` is a positive number of iterations, smoothed and given fresh normals.
+    vtkQuadricClustering merges the points in each bin of a regular lattice, which takes a fraction of the time of
+    vtkDecimatePro's edge collapses. The bins are sized so that the surface crosses about `triangles` / 2 of them,
+    making roughly two triangles in each, as marching cubes does in each cell it cuts; the count is only
+    approximate. Each bin keeps one of its own points, so the contour values stay exact as point scalars and the
+    two signs keep their colours. `surface` itself is returned if it is no bigger than that, or if `triangles` is 0.
+    """
+    polys = surface.GetNumberOfPolys()
+    if triangles <= 0 or polys <= triangles:
+        return surface
+    area = vtkMassProperties()
+    area.SetInputData(surface)
+    area.Update()
+    bounds = np.reshape(surface.GetBounds(), (3, 2))
+    bin_size = np.sqrt(2 * area.GetSurfaceArea() / triangles)
+    cluster = vtkQuadricClustering()
+    cluster.SetInputData(surface)
+    cluster.AutoAdjustNumberOfDivisionsOff()
+    cluster.SetNumberOfDivisions(*(max(1, int(np.ceil(extent / bin_size))) for extent in np.ptp(bounds, axis=1)))
+    cluster.UseInputPointsOn()
+    output = cluster
+    if smoothing > 0:
+        smoother = vtkWindowedSincPolyDataFilter()
+        smoother.SetInputConnection(cluster.GetOutputPort())
+        smoother.SetNumberOfIterations(smoothing)
+        smoother.NormalizeCoordinatesOn()
+        normals = vtkPolyDataNormals()
+        normals.SetInputConnection(smoother.GetOutputPort())
+        normals.SplittingOff()
+        output = normals
+    output.Update()
+    reduced = vtkPolyData()
+    reduced.ShallowCopy(output.GetOutput())
+    return reduced
+
+
+class Isosurface:
+    r"""
+    A surface from contour(), together with its `interactive` level of detail of about `triangles` triangles,
+    smoothed by `smoothing` iterations (see level_of_detail()), which is the surface itself when that is small
+    enough already. The level of detail is made only when first asked for, or by make_interactive(), so that a
+    surface can be shown before it exists; either may be called from any thread, and it is made only once.
+    """
+
+    def __init__(self, surface: vtkPolyData, triangles: int = 0, smoothing: int = 0):
+        self.surface = surface
+        self.detail = triangles, smoothing
+        self._interactive = None
+        self._lock = threading.Lock()
+
+    def make_interactive(self) -> vtkPolyData:
+        with self._lock:
+            if self._interactive is None:
+                self._interactive = level_of_detail(self.surface, *self.detail)
+            return self._interactive
+
+    @property
+    def interactive(self) -> vtkPolyData:
+        return self.make_interactive()
+
+    @property
+    def nbytes(self) -> int:
+        r"""
+        The size of the surface and of its level of detail, which, whether or not it has been made yet, is counted
+        as a share of the surface in proportion to its triangle count, so that the size doesn't change later.
+        """
+        triangles, smoothing = self.detail
+        polys = self.surface.GetNumberOfPolys()
+        if triangles <= 0 or polys <= triangles:
+            return surface_nbytes(self.surface)
+        return int(surface_nbytes(self.surface) * (1 + triangles / polys))
+
+
+def isosurface(grid, value: float, engine: str = 'contour', triangles: int = 0, smoothing: int = 0) -> Isosurface:
+    r"""
+    contour() `grid` at `value` with `engine`, to be reduced by level_of_detail() to `triangles` triangles, smoothed
+    by `smoothing` iterations, once the Isosurface is asked for its interactive level of detail.
+    """
+    return Isosurface(contour(grid, value, engine), triangles, smoothing)
+
+
+def prepare_grid(grid):
+    r"""
+    Fill in the lazily computed, cached parts of a VTK grid -- its bounds and scalar range -- so that contour()
+    can then run on it from several threads at once without any of them modifying it.
+    """
+    grid.GetBounds()
+    grid.GetPointData().GetScalars().GetRange()
+    return grid
+
+
+# Identities for grids in isosurface cache keys: VTK's Python data objects compare by value and can't be hashed.
+grid_identities = itertools.count()
+
+
+# Contouring is memory-bound, so a single worker: requests are then also served in the order they were made.
+ISOSURFACE_WORKERS = 1
+_isosurface_executor = None
+_isosurface_executor_lock = threading.Lock()
+
+
+def isosurface_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _isosurface_executor
+    with _isosurface_executor_lock:
+        if _isosurface_executor is None:
+            _isosurface_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ISOSURFACE_WORKERS,
+                                                                         thread_name_prefix='isosurface')
+        return _isosurface_executor
+
+
+class IsosurfaceBuilder:
+    r"""
+    Contours grids in the background, storing each Isosurface in a CubeCache under the key `(identity, value)`, where
+    `identity` is a number from grid_identities that the caller keeps with the grid, so that surfaces of a grid
+    since replaced are never mistaken for current ones.
+    Like CubePrefetcher, schedule() replaces the whole set of wanted surfaces, so that as a contour slider moves,
+    queued requests for values it has already passed are dropped and only the latest is computed. If given,
+    `on_ready(key)` is called, on the worker thread, as each surface is stored. `engine` is the contour() engine
+    to use, and `detail` the triangle target and smoothing for level_of_detail(), unless schedule() is given
+    others, which are carried with each request, so that the worker never reads settings. The worker makes the
+    level of detail of each surface after handing the surface over, so that it is ready for the camera's next move
+    without holding up the first draw; make_interactive() queues the same for a surface contoured elsewhere.
+    """
+
+    def __init__(self, cache: CubeCache, executor=None, on_ready=None, engine='contour', detail=(0, 0)):
+        self.cache = cache
+        self.engine = engine
+        self.detail = detail
+        self.executor = executor
+        self.on_ready = on_ready
+        self._pending = {}
+        # Reentrant: cancelling a future runs its done-callback, _finished(), synchronously.
+        self._lock = threading.RLock()
+
+    def schedule(self, grid, identity: int, values: list, engine: str = None, detail: tuple[int, int] = None):
+        r"""
+        Contour `grid`, whose identity is `identity`, at each of `values` not already cached, in that order, with
+        `engine` and `detail` if given, cancelling any other queued work. `grid` must have been through
+        prepare_grid().
+        """
+        engine = self.engine if engine is None else engine
+        detail = self.detail if detail is None else detail
+        wanted = [(identity, value) for value in values]
+        with self._lock:
+            for key, future in list(self._pending.items()):
+                if key not in wanted:
+                    future.cancel()
+            for key in wanted:
+                if key in self._pending or self.cache.peek(key) is not None:
+                    continue
+                future = (self.executor or isosurface_executor()).submit(self._build, key, grid, engine, detail)
+                self._pending[key] = future
+                future.add_done_callback(lambda future, key=key: self._finished(key, future))
+
+    def _build(self, key, grid, engine, detail):
+        surface = isosurface(grid, key[1], engine, *detail)
+        self.cache.put(key, surface, surface.nbytes)
+        if self.on_ready is not None:
+            self.on_ready(key)
+        surface.make_interactive()
+
+    def make_interactive(self, surface: Isosurface):
+        r"""Make the level of detail of `surface` on the worker, after any contouring already queued."""
+        (self.executor or isosurface_executor()).submit(surface.make_interactive)
+
+    def _finished(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+        if not future.cancelled() and future.exception() is not None:
+            logger.debug(f'Contouring at {key[1]} failed: {future.exception()!r}')
+
+    def cancel(self):
+        r"""Drop all queued contouring. Anything already running finishes in the background."""
+        with self._lock:
+            for future in list(self._pending.values()):
+                future.cancel()
+
+    @property
+    def pending(self) -> list:
+        with self._lock:
+            return list(self._pending)
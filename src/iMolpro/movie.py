@@ -0,0 +1,277 @@
+r"""
+Movies of normal modes: one period of a vibration drawn offscreen, frame by frame, and written as an animated GIF,
+an animated PNG, or a numbered sequence of PNG or TIFF images.
+
+Drawing and encoding overlap: the frames are drawn on the calling thread, which owns the OpenGL context, and handed
+through a queue of at most FRAME_QUEUE_LENGTH frames to a thread that encodes them. Animated PNGs and image sequences
+and GIFs are written as the frames arrive, so memory doesn't grow with the number of frames.
+"""
+import io
+import logging
+import math
+import os
+import queue
+import struct
+import threading
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from .offscreen import OffscreenScene
+from .vtk_molecule_widget import MolecularModel, VibrationAnimation, write_image
+
+logger = logging.getLogger(__name__)
+
+# The animated formats that export_vibration_movie() writes, by file extension; other filenames are patterns for a
+# sequence of images.
+MOVIE_FORMATS = {'.gif': 'GIF', '.png': 'APNG', '.apng': 'APNG'}
+
+# How many frames may be drawn ahead of the encoder before drawing waits for it.
+FRAME_QUEUE_LENGTH = 4
+
+# Atoms move at most this far (bohr) from equilibrium, as in MoleculeDisplay's animation.
+PEAK_DISPLACEMENT = 0.4
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class APNGWriter:
+    r"""
+    Writes an animated PNG of `frames` frames of 8-bit RGB or RGBA pixels, shown `fps` to the second and looping, a
+    frame at a time: each frame is filtered, compressed and written by write(), so nothing is kept from one frame to
+    the next. Viewers that don't know APNG show the first frame.
+    """
+
+    def __init__(self, filename: str, frames: int, fps: float):
+        self.file = open(filename, 'wb')
+        self.frames = frames
+        self.fps = fps
+        self.written = 0
+        self._sequence = 0
+        self._shape = None
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self.file.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+    def write(self, pixels: np.ndarray):
+        height, width, channels = pixels.shape
+        if self._shape is None:
+            self._shape = pixels.shape
+            self.file.write(_PNG_SIGNATURE)
+            # bit depth 8, colour type 6 (RGBA) or 2 (RGB), then default compression, filter and interlace
+            self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6 if channels == 4 else 2, 0, 0, 0))
+            self._chunk(b'acTL', struct.pack('>II', self.frames, 0))  # 0 plays: loop for ever
+        elif pixels.shape != self._shape:
+            raise ValueError(f'Frame of shape {pixels.shape} in an animation of {self._shape}')
+        # each frame covers the whole image, replacing the last (blend op 0), after 1/fps seconds
+        delay = round(1000 / self.fps)
+        self._chunk(b'fcTL', struct.pack('>IIIIIHHBB', self._sequence, width, height, 0, 0, delay, 1000, 0, 0))
+        self._sequence += 1
+        # filter type 2 on every row, the difference from the row above, which compresses smooth shading well
+        rows = pixels.reshape(height, width * channels)
+        filtered = np.empty((height, width * channels + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        filtered[:, 1:] = rows
+        filtered[1:, 1:] -= rows[:-1]
+        data = zlib.compress(filtered.tobytes(), 6)
+        if self.written == 0:
+            self._chunk(b'IDAT', data)
+        else:
+            self._chunk(b'fdAT', struct.pack('>I', self._sequence) + data)
+            self._sequence += 1
+        self.written += 1
+
+    def close(self):
+        if self._shape is not None:
+            if self.written != self.frames:
+                raise ValueError(f'{self.written} frames written to an animation of {self.frames}')
+            self._chunk(b'IEND', b'')
+        self.file.close()
+
+
+class GIFWriter:
+    r"""
+    Writes an animated GIF of `frames` frames shown `fps` to the second and looping, a frame at a time, like
+    APNGWriter: Pillow reduces each frame to a palette of its own and compresses it as a GIF of one image, which
+    write() copies into the animation with that palette as the image's local colour table, so nothing is kept from
+    one frame to the next.
+    """
+
+    def __init__(self, filename: str, frames: int, fps: float):
+        self.file = open(filename, 'wb')
+        self.fps = fps
+        self.written = 0
+        self._shape = None
+
+    def write(self, pixels: np.ndarray):
+        height, width = pixels.shape[:2]
+        if self._shape is None:
+            self._shape = pixels.shape
+            # the logical screen, with no global colour table, then the extension that loops for ever
+            self.file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0))
+            self.file.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', 0) + b'\x00')
+        elif pixels.shape != self._shape:
+            raise ValueError(f'Frame of shape {pixels.shape} in an animation of {self._shape}')
+        image = Image.fromarray(pixels)
+        transparency = None
+        if image.mode == 'RGBA':
+            # GIF has only fully transparent or opaque pixels
+            transparent = pixels[..., 3] < 128
+            image = image.convert('RGB').quantize(255)
+            indices = np.asarray(image).copy()
+            indices[transparent] = transparency = 255
+            palette = image.getpalette()
+            image = Image.fromarray(indices, mode='P')
+            image.putpalette(palette)
+        else:
+            image = image.quantize(256)
+        encoded = io.BytesIO()
+        # not optimized, so that the palette indices, and the transparent one, stay as they are
+        image.save(encoded, format='GIF', optimize=False)
+        # disposal 2: each frame is drawn on the background, not over the last
+        packed = 2 << 2 | (transparency is not None)
+        self.file.write(b'\x21\xf9\x04' + struct.pack('<BHB', packed, round(100 / self.fps), transparency or 0) +
+                        b'\x00')
+        self.file.write(_gif_image(encoded.getvalue()))
+        self.written += 1
+
+    def close(self):
+        if self._shape is not None:
+            self.file.write(b'\x3b')
+        self.file.close()
+
+
+def _gif_sub_blocks_end(gif: bytes, position: int) -> int:
+    r"""Where the run of GIF data sub-blocks starting at `position` ends, after its zero-length terminator."""
+    while gif[position]:
+        position += gif[position] + 1
+    return position + 1
+
+
+def _gif_image(gif: bytes) -> bytes:
+    r"""
+    The image descriptor and compressed data of the GIF of a single image `gif`, as a frame of an animation: the
+    file's global colour table, if it has one, becomes the image's local colour table.
+    """
+    flags = gif[10]
+    colour_table = gif[13:13 + 3 * 2 ** ((flags & 7) + 1)] if flags & 0x80 else b''
+    position = 13 + len(colour_table)
+    while gif[position] == 0x21:  # extensions, eg. Pillow's own graphic control
+        position = _gif_sub_blocks_end(gif, position + 2)
+    if gif[position] != 0x2c:
+        raise ValueError('No image in the GIF to copy into the animation')
+    descriptor = bytearray(gif[position:position + 10])
+    position += 10
+    # then the image's own colour table, if it has one, the LZW code size, and the compressed sub-blocks
+    data = position + (3 * 2 ** ((descriptor[9] & 7) + 1) if descriptor[9] & 0x80 else 0)
+    if not descriptor[9] & 0x80 and colour_table:
+        descriptor[9] |= 0x80 | (flags & 7)
+        descriptor += colour_table
+    end = _gif_sub_blocks_end(gif, data + 1)
+    return bytes(descriptor) + gif[position:end]
+
+
+class ImageSequenceWriter:
+    r"""Writes each frame to its own PNG or TIFF file, named by `pattern`, eg. `mode_{:03d}.png`, with its number."""
+
+    def __init__(self, pattern: str, frames: int, fps: float):
+        self.pattern = pattern
+        self.written = 0
+
+    def write(self, pixels: np.ndarray):
+        write_image(pixels, self.pattern.format(self.written))
+        self.written += 1
+
+    def close(self):
+        pass
+
+
+def movie_writer_class(filename: str):
+    r"""
+    The class of writer for `filename`: an animated GIF or PNG by its extension, otherwise a sequence of images if
+    it's a pattern for str.format() like `mode_{:03d}.png`. Nothing is opened, so it can check a filename up front.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if '{' in filename:
+        return ImageSequenceWriter
+    if MOVIE_FORMATS.get(extension) == 'GIF':
+        return GIFWriter
+    if MOVIE_FORMATS.get(extension) == 'APNG':
+        return APNGWriter
+    raise ValueError(f'Cannot write a movie to {filename}: it should end in one of {", ".join(MOVIE_FORMATS)}, '
+                     f'or be a pattern for numbered images, like mode_{{:03d}}.png')
+
+
+def movie_writer(filename: str, frames: int, fps: float):
+    r"""A writer, of the class movie_writer_class() picks, for `frames` frames, shown `fps` to the second."""
+    return movie_writer_class(filename)(filename, frames, fps)
+
+
+def _encode(frames: queue.Queue, writer, errors: list):
+    r"""
+    Pass what arrives on `frames` to `writer` until None does. After a failure, which goes in `errors`, frames are
+    still taken from the queue, so that drawing is never left waiting for space in it.
+    """
+    while (pixels := frames.get()) is not None:
+        if not errors:
+            try:
+                writer.write(pixels)
+            except Exception as error:
+                errors.append(error)
+    try:
+        writer.close()
+    except Exception as error:
+        errors.append(error)
+
+
+def export_vibration_movie(atoms: list[dict], mode: dict, filename: str, frames: int = 36, fps: float = 24,
+                           width: int = 800, height: int = 800, magnification: int = 1,
+                           background: tuple[float, float, float] = (1.0, 1.0, 1.0), transparent: bool = False,
+                           camera=None, peak_displacement: float = PEAK_DISPLACEMENT) -> str:
+    r"""
+    Draw one period of the normal `mode`, a dict with the displacement `vector` of `atoms`, such as an entry of
+    Structure.vibrations.modes, in `frames` frames of `width` by `height` times `magnification`, and write them to
+    `filename` by movie_writer(), returning it. If given, the vtkCamera `camera`, eg. that of the scene on screen,
+    sets the view; otherwise the molecule is framed as MoleculeWidget frames it.
+    """
+    if frames < 1:
+        raise ValueError(f'A movie needs at least one frame, not {frames}')
+    writer_class = movie_writer_class(filename)
+    # bonds as MoleculeWidget draws them on light or dark backgrounds
+    bond_colour = (0.6, 0.6, 0.6) if sum(background) > 1.5 else (0.8, 0.8, 0.8)
+    model = MolecularModel(atoms, bond_colour=bond_colour)
+    animation = VibrationAnimation(atoms, mode['vector'], peak_displacement)
+    model.geometry.set_animating(True)
+    model.geometry.share_points(animation.points)
+    # the output is only opened once there is something to draw it with, so that a scene that can't be made, eg. for
+    # want of EGL or OSMesa, leaves no empty file behind
+    scene = OffscreenScene(width, height, background)
+    try:
+        writer = writer_class(filename, frames, fps)
+    except Exception:
+        scene.close()
+        raise
+    pending = queue.Queue(maxsize=FRAME_QUEUE_LENGTH)
+    errors = []
+    encoder = threading.Thread(target=_encode, args=(pending, writer, errors), name='vibration movie encoder',
+                               daemon=True)
+    encoder.start()
+    try:
+        scene.show(model)
+        if camera is not None:
+            scene.renderer.GetActiveCamera().DeepCopy(camera)
+        for frame in range(frames):
+            if errors:
+                break
+            animation.frame(2 * math.pi * frame / frames)
+            model.geometry.update_positions(animation.positions)
+            pending.put(scene.image(magnification, transparent))
+    finally:
+        pending.put(None)
+        encoder.join()
+        scene.close()
+    if errors:
+        raise errors[0]
+    logger.debug(f'Wrote {frames} frames of a vibration to {filename}')
+    return filename
@@ -0,0 +1,309 @@
+r"""
+Drawing molecules and orbitals to images without a display, and the iMolpro-render command that does so for batches
+of Molpro projects, for example to make galleries of orbitals on a compute node.
+
+The scene is the MolecularModel that MoleculeWidget shows, lit in the same way, in a VTK render window that is never
+shown. Where there's no display, the window is an EGL one, which needs no X server, or failing that OSMesa's, which
+renders in software; see offscreen_window_class().
+"""
+import argparse
+import concurrent.futures
+import ctypes.util
+import dataclasses
+import functools
+import logging
+import multiprocessing
+import os
+import pathlib
+import sys
+
+import numpy as np
+import vtkmodules.vtkRenderingOpenGL2  # noqa: F401 -- provides the OpenGL render windows
+from vtkmodules.vtkRenderingCore import vtkRenderWindow, vtkRenderer
+
+from .cube_cache import OrbitalCubeDiskCache, orbital_cube_data
+from .project import Project
+from .settings import settings
+from .vtk_molecule_widget import MolecularModel, scene_renderer, add_to_renderer, frontier_orbitals, xyz_to_atoms, \
+    capture_image, write_image
+
+logger = logging.getLogger(__name__)
+
+# What VTK reads to decide which kind of OpenGL render window to create.
+WINDOW_CLASS_VARIABLE = 'VTK_DEFAULT_OPENGL_WINDOW'
+
+
+def _has_display() -> bool:
+    return not sys.platform.startswith('linux') or bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+@functools.lru_cache(maxsize=None)
+def offscreen_window_class(software: bool = False) -> str | None:
+    r"""
+    The VTK render window class to draw offscreen with, or None to leave the choice to VTK, as where there's a
+    display. Without one, vtkEGLRenderWindow if libEGL is installed, which renders on the GPU if its driver can,
+    otherwise vtkOSOpenGLRenderWindow if libOSMesa is, which renders in software. With `software`, OSMesa is
+    preferred, then EGL with Mesa told to use its software renderer. A class named in the environment by
+    VTK_DEFAULT_OPENGL_WINDOW always wins.
+    Raises RuntimeError if there's no display and neither library is installed, rather than letting VTK crash.
+    """
+    if os.environ.get(WINDOW_CLASS_VARIABLE):
+        return os.environ[WINDOW_CLASS_VARIABLE]
+    egl, osmesa = ctypes.util.find_library('EGL'), ctypes.util.find_library('OSMesa')
+    if _has_display() and not software:
+        return None
+    if software and osmesa:
+        return 'vtkOSOpenGLRenderWindow'
+    if egl:
+        return 'vtkEGLRenderWindow'
+    if osmesa:
+        return 'vtkOSOpenGLRenderWindow'
+    if _has_display():
+        return None
+    raise RuntimeError('There is no display to render to, and neither libEGL nor libOSMesa to render without one')
+
+
+def configure_offscreen_rendering(software: bool = False) -> str | None:
+    r"""
+    Have VTK create the render windows of offscreen_window_class(`software`) from now on, in this process and in
+    any it starts, returning the class.
+    """
+    window_class = offscreen_window_class(software)
+    if window_class is not None:
+        os.environ[WINDOW_CLASS_VARIABLE] = window_class
+        if software and window_class == 'vtkEGLRenderWindow':
+            os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+    return window_class
+
+
+class OffscreenScene:
+    r"""
+    A MoleculeScene that is never shown: show() puts a model in it, framed as MoleculeWidget frames it, and image()
+    and write_image() draw it, at any magnification, and with a transparent background if wanted.
+    """
+
+    def __init__(self, width: int = 800, height: int = 800, background: tuple[float, float, float] = (1.0, 1.0, 1.0)):
+        configure_offscreen_rendering()
+        self.window = vtkRenderWindow()
+        self.window.SetOffScreenRendering(True)
+        self.window.SetAlphaBitPlanes(True)
+        self.window.SetSize(width, height)
+        self.renderer = scene_renderer()
+        self.renderer.SetBackground(*background)
+        self.renderer.SetBackgroundAlpha(0.0)
+        self.window.AddRenderer(self.renderer)
+
+    def show(self, model):
+        r"""Draw `model`, an actor or collection of them, in place of whatever was shown before."""
+        self.renderer.RemoveAllViewProps()
+        add_to_renderer(self.renderer, model)
+        self.renderer.ResetCamera()
+
+    def show_view(self, renderer: vtkRenderer):
+        r"""Draw what `renderer` draws, from its camera, in place of whatever was shown before."""
+        self.renderer.RemoveAllViewProps()
+        for prop in renderer.GetViewProps():
+            self.renderer.AddViewProp(prop)
+        self.renderer.GetActiveCamera().DeepCopy(renderer.GetActiveCamera())
+
+    def image(self, magnification: int = 1, transparent: bool = False) -> np.ndarray:
+        r"""The scene drawn, as from capture_image(): RGB, or RGBA with a transparent background if `transparent`."""
+        return capture_image(self.window, magnification, transparent)
+
+    def write_image(self, filename: str, magnification: int = 1, transparent: bool = False):
+        r"""Write image() to `filename`, a PNG or TIFF file according to its extension."""
+        write_image(self.image(magnification, transparent), filename)
+
+    def close(self):
+        self.window.Finalize()
+
+
+@dataclasses.dataclass(frozen=True)
+class RenderJob:
+    r"""
+    An image, or a series of them, for render(): the geometry in `source`, an .xyz file or a Molpro project, and,
+    if `orbital` is given, that orbital at the project's geometry `geometry` -- the index of its molecule instance,
+    eg. a step of an optimisation, as for Project.orbitals() -- at each of `contour_values`, drawn to the same entry
+    of `filenames`, PNG or TIFF files, at `magnification` times `width` by `height`.
+    """
+    source: str
+    filenames: tuple[str, ...]
+    orbital: str | None = None
+    geometry: int = -1
+    contour_values: tuple[float, ...] = ()
+    resolution: float = 0.3
+    width: int = 800
+    height: int = 800
+    background: tuple[float, float, float] = (1.0, 1.0, 1.0)
+    magnification: int = 1
+    transparent: bool = False
+
+
+def _add_setting_defaults():
+    # MoleculeDisplay adds these in the GUI
+    settings.add_default('contour_value', .1)
+    settings.add_default('contour_opacity', .7)
+    settings.add_default('grid_resolution', .3)
+    settings.add_default('orbital_grid_backend', 'pymolpro')
+    settings.add_default('cube_disk_cache_megabytes', 1024)
+
+
+def render(job: RenderJob) -> list[str]:
+    r"""Draw the images of `job`, returning their filenames."""
+    if not os.path.exists(job.source):
+        # and a project mustn't be created by opening it
+        raise FileNotFoundError(f'{job.source} does not exist')
+    _add_setting_defaults()
+    OrbitalCubeDiskCache.set_budget(int(float(settings['cube_disk_cache_megabytes']) * 1e6))
+    # bonds as MoleculeWidget draws them on light or dark backgrounds
+    bond_colour = (0.6, 0.6, 0.6) if sum(job.background) > 1.5 else (0.8, 0.8, 0.8)
+    scene = OffscreenScene(job.width, job.height, job.background)
+    try:
+        if job.orbital is None:
+            scene.show(MolecularModel(xyz_to_atoms(job.source), bond_colour=bond_colour))
+            scene.write_image(job.filenames[0], job.magnification, job.transparent)
+            return list(job.filenames)
+        orbitals = Project(job.source).orbitals(instance=job.geometry)
+        orbital = next(orbital for orbital in orbitals if orbital.ID == job.orbital)
+        # as MoleculeDisplay.get_cube(): trimmed to where the orbital is non-negligible at the smallest contour
+        cube_data = orbital_cube_data(orbital, resolution=job.resolution, threshold=min(job.contour_values) * .1,
+                                      border=6, backend=settings['orbital_grid_backend'])
+        model = MolecularModel(cube_data, bond_colour=bond_colour)
+        scene.show(model)
+        for contour_value, filename in zip(job.contour_values, job.filenames):
+            model.contour_value = contour_value
+            scene.write_image(filename, job.magnification, job.transparent)
+        return list(job.filenames)
+    finally:
+        scene.close()
+
+
+# Which orbitals of each project iMolpro-render draws, unless they're named with --orbital: the HOMO and LUMO as far
+# as they're in the orbital set, or all the orbitals that the orbital selector offers.
+ORBITAL_SELECTIONS = ('frontier', 'all')
+
+
+def plan(sources: list[str], output: str, selection: str = 'frontier', orbital_ids: list[str] = (),
+         geometry: int = -1, contour_values: list[float] = (.1,), extension: str = '.png',
+         **options) -> list[RenderJob]:
+    r"""
+    The RenderJobs to draw `sources`, writing to the directory `output`: for an .xyz file, its structure, to
+    `<name>.png`; for a Molpro project, either the orbitals `orbital_ids` or the `selection` (one of
+    ORBITAL_SELECTIONS) of those at its geometry `geometry` (see RenderJob), at each of `contour_values`, to
+    `<project>_<orbital>_<contour value>.png`, or `extension` in place of .png. `options` are passed on to
+    RenderJob.
+    """
+    jobs = []
+    for source in sources:
+        name = pathlib.Path(source).stem
+        if not os.path.exists(source):
+            logger.warning(f'Skipping {source}, which does not exist')
+            continue
+        if not source.endswith('.molpro'):
+            jobs.append(RenderJob(source, (os.path.join(output, name + extension),), **options))
+            continue
+        try:
+            orbitals = Project(source).orbitals(instance=geometry)
+        except Exception as error:
+            logger.warning(f'Skipping {source}, which has no orbitals to draw: {error}')
+            continue
+        if orbital_ids:
+            chosen = [orbital for orbital in orbitals if orbital.ID in orbital_ids]
+        elif selection == 'frontier':
+            chosen = frontier_orbitals(orbitals)
+        else:
+            chosen = orbitals
+        for orbital in chosen:
+            filenames = tuple(os.path.join(output, f'{name}_{orbital.ID}_{value:g}{extension}')
+                              for value in contour_values)
+            jobs.append(RenderJob(source, filenames, orbital=orbital.ID, geometry=geometry,
+                                  contour_values=tuple(contour_values), **options))
+    return jobs
+
+
+def render_all(jobs: list[RenderJob], processes: int = 0, software: bool = False):
+    r"""
+    render() each of `jobs` in `processes` worker processes (0 for one per core), yielding the filenames of each job
+    as it finishes, or the exception it failed with.
+    """
+    configure_offscreen_rendering(software)
+    processes = processes or os.cpu_count() or 1
+    if processes == 1:
+        for job in jobs:
+            try:
+                yield job, render(job)
+            except Exception as error:
+                yield job, error
+        return
+    # spawned, not forked: a forked child would inherit the parent's OpenGL and VTK state
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(processes, len(jobs) or 1),
+                                                mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(render, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.exception() or future.result()
+
+
+def _size(value: str) -> tuple[int, int]:
+    width, _, height = value.partition('x')
+    return int(width), int(height or width)
+
+
+def _colour(value: str) -> tuple[float, float, float]:
+    colour = tuple(float(c) for c in value.split(','))
+    if len(colour) != 3:
+        raise argparse.ArgumentTypeError(f'expected R,G,B, each from 0 to 1, not {value!r}')
+    return colour
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(
+        prog='iMolpro-render',
+        description='Draw the structures in .xyz files and the orbitals of Molpro projects to PNG or TIFF images, '
+                    'in parallel and without needing a display.')
+    parser.add_argument('sources', nargs='+', metavar='SOURCE', help='a Molpro project (.molpro) or an .xyz file')
+    parser.add_argument('--output', '-o', default='.', help='directory for the images (default: %(default)s)')
+    parser.add_argument('--orbitals', choices=ORBITAL_SELECTIONS, default='frontier',
+                        help="each project's orbitals to draw (default: %(default)s, the HOMO and any LUMO)")
+    parser.add_argument('--orbital', action='append', default=[], metavar='ID',
+                        help='draw the orbital with this ID, eg 5.1, instead; may be repeated')
+    parser.add_argument('--geometry', type=int, default=-1, metavar='N',
+                        help="which of each project's geometries, eg. the steps of an optimisation, to draw the "
+                             "orbitals at (default: %(default)s, the last)")
+    parser.add_argument('--contour', type=float, nargs='+', default=None, metavar='VALUE',
+                        help="contour values to draw each orbital at (default: the contour_value setting)")
+    parser.add_argument('--resolution', type=float, default=None, metavar='BOHR',
+                        help='orbital grid spacing (default: the grid_resolution setting)')
+    parser.add_argument('--size', type=_size, default=(800, 800), metavar='WIDTHxHEIGHT',
+                        help='size of the view in pixels (default: 800x800)')
+    parser.add_argument('--magnification', '-m', type=int, default=1, metavar='N',
+                        help='draw the images at N times the size of the view, in N by N tiles (default: 1)')
+    parser.add_argument('--transparent', action='store_true', help='give the images a transparent background')
+    parser.add_argument('--format', choices=('png', 'tiff'), default='png', help='image format (default: png)')
+    parser.add_argument('--background', type=_colour, default=(1.0, 1.0, 1.0), metavar='R,G,B',
+                        help='background colour, each component from 0 to 1 (default: white)')
+    parser.add_argument('--jobs', '-j', type=int, default=0, metavar='N',
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--software', action='store_true', help='render with software OpenGL')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    _add_setting_defaults()
+    os.makedirs(args.output, exist_ok=True)
+    jobs = plan(args.sources, args.output, selection=args.orbitals, orbital_ids=args.orbital,
+                geometry=args.geometry,
+                contour_values=args.contour or [float(settings['contour_value'])],
+                resolution=float(settings['grid_resolution']) if args.resolution is None else args.resolution,
+                extension='.' + args.format, width=args.size[0], height=args.size[1], background=args.background,
+                magnification=args.magnification, transparent=args.transparent)
+    failures = 0
+    for job, result in render_all(jobs, processes=args.jobs, software=args.software):
+        if isinstance(result, Exception):
+            failures += 1
+            logger.error(f'Could not draw {job.orbital or "the structure"} of {job.source}: {result!r}')
+        else:
+            for filename in result:
+                print(filename)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
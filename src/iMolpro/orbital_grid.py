@@ -0,0 +1,441 @@
+r"""
+Evaluation of molecular orbitals on regular grids, as an alternative to pymolpro's Orbital.cube_data().
+
+pymolpro evaluates the basis set point by point through pymolpro.grid.evaluateBasis(), re-reading the basis
+set from the XML on every call and holding every basis function at every point in memory at once. Here the
+basis set is read once per molecule into a list of Shell objects, and a grid is evaluated in cubic blocks of
+points: each shell's Gaussians factorise into one-dimensional factors along the grid axes, so only
+O(block edge) exponentials are needed per primitive, and a shell is skipped altogether for any block lying
+beyond the distance at which its functions fall below SCREENING_THRESHOLD. Peak memory beyond the result
+itself is bounded by the block size.
+
+The basis functions, their order and their normalisation follow pymolpro.grid.evaluateBasis() exactly, so
+that the orbital coefficients in the XML can be used unchanged.
+"""
+import functools
+import math
+import re
+
+import numpy as np
+from pymolpro.cube_data import CubeData
+from pymolpro.grid import namespaces
+
+# pymolpro's CubeData holds a single grid; iMolpro's also holds a stack of them
+from .cube_data import CubeData as StackedCubeData
+
+# The conversion pymolpro.grid.evaluateBasis() uses for the nuclear coordinates of the basis function centres.
+ANGSTROM = 1.88972612462577
+
+# Grids are evaluated in blocks of at most BLOCK_SIZE points along each axis.
+BLOCK_SIZE = 32
+
+# A shell is skipped for a block when none of its basis functions, scaled by the largest orbital coefficient
+# multiplying them, can exceed this anywhere in the block.
+SCREENING_THRESHOLD = 1e-12
+
+# When trimming the grid to where the orbital exceeds a threshold, the region is first located on a grid this
+# many times coarser than the one requested.
+TRIM_COARSENING = 4
+
+# Cartesian components (powers of x, y and z) of each angular momentum, in Molpro's order, with the
+# normalisation divisor of each, as tabulated in pymolpro.grid.evaluateBasis().
+_CARTESIAN_COMPONENTS = [
+    [(0, 0, 0)],
+    [(1, 0, 0), (0, 1, 0), (0, 0, 1)],
+    [(2, 0, 0), (0, 2, 0), (0, 0, 2), (1, 1, 0), (1, 0, 1), (0, 1, 1)],
+    [(3, 0, 0), (0, 3, 0), (0, 0, 3), (2, 1, 0), (2, 0, 1), (1, 2, 0), (0, 2, 1), (1, 0, 2), (0, 1, 2), (1, 1, 1)],
+    [(4, 0, 0), (0, 4, 0), (0, 0, 4), (3, 1, 0), (3, 0, 1), (1, 3, 0), (0, 3, 1), (1, 0, 3), (0, 1, 3), (2, 2, 0),
+     (2, 0, 2), (0, 2, 2), (2, 1, 1), (1, 2, 1), (1, 1, 2)],
+    [(5, 0, 0), (4, 1, 0), (4, 0, 1), (3, 2, 0), (3, 1, 1), (3, 0, 2), (2, 3, 0), (2, 2, 1), (2, 1, 2), (2, 0, 3),
+     (1, 4, 0), (1, 3, 1), (1, 2, 2), (1, 1, 3), (1, 0, 4), (0, 5, 0), (0, 4, 1), (0, 3, 2), (0, 2, 3), (0, 1, 4),
+     (0, 0, 5)],
+]
+_CARTESIAN_NORMALISATION = [
+    [1],
+    [1, 1, 1],
+    [3, 3, 3, 1, 1, 1],
+    [15, 15, 15, 3, 3, 3, 3, 3, 3, 1],
+    [105, 105, 105, 15, 15, 15, 15, 15, 15, 9, 9, 9, 1, 1, 1],
+    [945, 105, 105, 45, 15, 45, 45, 9, 9, 45, 105, 15, 9, 15, 105, 945, 105, 45, 45, 105, 945],
+]
+# Cartesian-to-spherical transformations; as in pymolpro, only up to d functions.
+_SPHERICAL_TRANSFORMATIONS = [
+    np.array([[1.]]),
+    np.eye(3),
+    np.array([[-0.5, -0.5, 1, 0, 0, 0], [1, -1, 0, 0, 0, 0], [0, 0, 0, 0, 1, 0], [0, 0, 0, 1, 0, 0],
+              [0, 0, 0, 0, 0, 1]]),
+]
+
+
+def _floats(text: str) -> np.ndarray:
+    return np.array(text.split(), dtype=np.float64)
+
+
+def _referenced_ids(href: str, element: str) -> list:
+    r"""The ids selected by an xlink:href of the form "#xpointer(//molecule[...]//element[@id='1' or @id='2'])"."""
+    return re.findall(r"@id\s*=\s*'([^']*)'", href[href.find(element + '['):])
+
+
+class Shell:
+    r"""
+    The contracted basis functions of one angular momentum sharing a set of primitive exponents on one centre.
+    """
+
+    def __init__(self, centre, angular_momentum: int, exponents, contractions, spherical: bool):
+        if angular_momentum >= len(_CARTESIAN_COMPONENTS):
+            raise NotImplementedError(f'basis functions of angular momentum {angular_momentum} are not supported')
+        if spherical and angular_momentum >= len(_SPHERICAL_TRANSFORMATIONS):
+            raise NotImplementedError(
+                f'spherical basis functions of angular momentum {angular_momentum} are not supported')
+        self.centre = np.asarray(centre, dtype=np.float64)
+        self.angular_momentum = angular_momentum
+        self.exponents = np.asarray(exponents, dtype=np.float64)
+        # contraction coefficients times the radial normalisation of each primitive, (contractions, primitives)
+        self.weights = np.atleast_2d(contractions) * np.sqrt(
+            np.sqrt(2 * self.exponents / math.pi) ** 3 * (4 * self.exponents) ** angular_momentum)
+        self.components = _CARTESIAN_COMPONENTS[angular_momentum]
+        self.component_normalisation = 1 / np.sqrt(np.array(_CARTESIAN_NORMALISATION[angular_momentum], dtype=float))
+        self.transformation = _SPHERICAL_TRANSFORMATIONS[angular_momentum] if spherical else None
+        self.size = len(self.weights) * (
+            len(self.transformation) if spherical else len(self.components))
+
+    def extent(self, scale: float = 1.0, threshold: float = SCREENING_THRESHOLD) -> float:
+        r"""
+        A distance from the centre beyond which every basis function in the shell, multiplied by `scale`, is
+        smaller in magnitude than `threshold`.
+        """
+        if threshold <= 0:
+            return math.inf
+        amplitudes = scale * np.max(np.abs(self.weights), axis=0)
+        logarithms = np.log(np.maximum(amplitudes, np.finfo(float).tiny) / threshold)
+        # Solve a r^l exp(-alpha r^2) = threshold for the outer root by fixed-point iteration, starting outside
+        # the maximum of r^l exp(-alpha r^2); the cartesian components never exceed r^l.
+        radii = np.sqrt(np.maximum(logarithms, 0) / self.exponents + self.angular_momentum / (2 * self.exponents))
+        for _ in range(8):
+            radii = np.sqrt(np.maximum(logarithms + self.angular_momentum * np.log(radii), 0) / self.exponents)
+            radii = np.maximum(radii, np.sqrt(self.angular_momentum / (2 * self.exponents)))
+        return float(np.max(radii)) * 1.01
+
+    def evaluate(self, axes) -> np.ndarray:
+        r"""
+        The shell's basis functions on the outer-product grid of the three coordinate arrays `axes`, as a
+        (self.size, len(axes[0]) * len(axes[1]) * len(axes[2])) array, points in C order.
+        """
+        nx, ny, nz = (len(axis) for axis in axes)
+        displacements = [axis - self.centre[i] for i, axis in enumerate(axes)]
+        gaussians = [np.exp(-np.multiply.outer(self.exponents, d * d)) for d in displacements]
+        powers = [d ** np.arange(self.angular_momentum + 1)[:, np.newaxis] for d in displacements]
+        cartesian = np.empty((len(self.components), len(self.weights), nx * ny * nz))
+        for c, (kx, ky, kz) in enumerate(self.components):
+            x = (self.weights * self.component_normalisation[c])[:, :, np.newaxis] * (
+                    gaussians[0] * powers[0][kx])  # (contractions, primitives, nx)
+            xy = x[:, :, :, np.newaxis] * (gaussians[1] * powers[1][ky])[:, np.newaxis, :]
+            xy = xy.reshape(len(self.weights), len(self.exponents), nx * ny).transpose(0, 2, 1)
+            cartesian[c] = (xy @ (gaussians[2] * powers[2][kz])).reshape(len(self.weights), -1)
+        if self.transformation is not None:
+            cartesian = np.tensordot(self.transformation, cartesian, axes=(1, 0))
+        # functions ordered contraction by contraction, components within a contraction
+        return cartesian.transpose(1, 0, 2).reshape(self.size, -1)
+
+
+class BasisSet:
+    r"""
+    The orbital basis set of a molecule in a Molpro XML output, in the order the orbital coefficients use.
+    """
+
+    def __init__(self, shells: list):
+        self.shells = shells
+        self.offsets = np.cumsum([0] + [shell.size for shell in shells])
+        self.size = int(self.offsets[-1])
+
+    @classmethod
+    def from_molecule(cls, molecule):
+        r"""
+        Read the basis set from `molecule`, the lxml element of a molecule in a Molpro XML output.
+        """
+        basis_sets = molecule.xpath('molpro-output:basisSet[@id="ORBITAL"]', namespaces=namespaces)
+        if len(basis_sets) != 1:
+            raise ValueError('there should be just one orbital basisSet')
+        basis_set = basis_sets[0]
+        orbital_sets = molecule.xpath('molpro-output:orbitals', namespaces=namespaces)
+        spherical = bool(orbital_sets) and orbital_sets[0].get('angular') == 'spherical'
+        groups = {group.get('id'): group for group in
+                  basis_set.xpath('molpro-output:basisGroup', namespaces=namespaces)}
+        associations = {}
+        href = '{' + namespaces['xlink'] + '}href'
+        for association in basis_set.xpath('molpro-output:association', namespaces=namespaces):
+            bases = association.xpath('molpro-output:bases', namespaces=namespaces)
+            atoms = association.xpath('molpro-output:atoms', namespaces=namespaces)
+            if len(bases) != 1 or len(atoms) != 1:
+                raise ValueError('there should be one bases and one atoms node in a basis set association')
+            for atom_id in _referenced_ids(atoms[0].get(href), 'atom'):
+                if atom_id in associations:
+                    raise ValueError(f'atom {atom_id} is associated with more than one basis set')
+                associations[atom_id] = _referenced_ids(bases[0].get(href), 'basisGroup')
+        shells = []
+        for atom in molecule.xpath('cml:molecule/cml:atomArray/cml:atom', namespaces=namespaces):
+            centre = [float(atom.get(coordinate)) * ANGSTROM for coordinate in ('x3', 'y3', 'z3')]
+            if atom.get('id') not in associations:
+                raise ValueError(f'atom {atom.get("id")} is not associated with a basis set')
+            for group_id in associations[atom.get('id')]:
+                group = groups[group_id]
+                angular_momentum = int(group.get('minL'))
+                if angular_momentum != int(group.get('maxL')):
+                    raise NotImplementedError('basis groups of mixed angular momentum are not supported')
+                exponents = _floats(group.xpath('molpro-output:basisExponents', namespaces=namespaces)[0].text)
+                contractions = [_floats(contraction.text) for contraction in
+                                group.xpath('molpro-output:basisContraction', namespaces=namespaces)]
+                shells.append(Shell(centre, angular_momentum, exponents, contractions, spherical))
+        return cls(shells)
+
+    def evaluate_grid(self, coefficients, origin, resolution: float, dimensions, block: int = BLOCK_SIZE,
+                      threshold: float = SCREENING_THRESHOLD) -> np.ndarray:
+        r"""
+        Evaluate the orbitals whose coefficients are the columns of `coefficients` (or the single orbital whose
+        coefficients are the vector `coefficients`) on the regular grid of `dimensions` points spaced by
+        `resolution` from `origin`, returning an array of shape (orbitals,) + dimensions, or just dimensions for
+        a single orbital.
+
+        :param block: The grid is evaluated in blocks of at most this many points along each axis.
+        :param threshold: Contributions from a shell that cannot exceed this anywhere in a block are skipped.
+        """
+        coefficients = np.asarray(coefficients, dtype=np.float64)
+        single = coefficients.ndim == 1
+        coefficients = coefficients.reshape(self.size, -1)
+        dimensions = tuple(int(n) for n in dimensions)
+        result = np.empty((coefficients.shape[1],) + dimensions)
+        for block_slices, values in self._blocks(coefficients, origin, resolution, dimensions, block, threshold):
+            result[(slice(None),) + block_slices] = values
+        return result[0] if single else result
+
+    def evaluate_density(self, coefficients, weights, origin, resolution: float, dimensions,
+                         block: int = BLOCK_SIZE, threshold: float = SCREENING_THRESHOLD) -> np.ndarray:
+        r"""
+        The sum over the orbitals whose coefficients are the columns of `coefficients` of `weights` times the square
+        of each orbital, on the same grid as evaluate_grid() and with the same `block` and `threshold`. The orbitals
+        are only ever held a block at a time, so memory beyond the result does not grow with their number.
+        """
+        coefficients = np.asarray(coefficients, dtype=np.float64).reshape(self.size, -1)
+        weights = np.asarray(weights, dtype=np.float64)
+        dimensions = tuple(int(n) for n in dimensions)
+        result = np.empty(dimensions)
+        for block_slices, values in self._blocks(coefficients, origin, resolution, dimensions, block, threshold):
+            result[block_slices] = np.einsum('o,o...->...', weights, values * values)
+        return result
+
+    def _blocks(self, coefficients, origin, resolution: float, dimensions: tuple, block: int, threshold: float):
+        r"""
+        Yield, for each block of the grid, its slices of the grid and the values there, (orbitals,) + block shape,
+        of the orbitals whose coefficients are the columns of `coefficients`.
+        """
+        shells = []
+        for shell, first, last in zip(self.shells, self.offsets[:-1], self.offsets[1:]):
+            shell_coefficients = coefficients[first:last]
+            scale = float(np.max(np.abs(shell_coefficients)))
+            if scale > 0:
+                shells.append((shell, shell_coefficients.T, shell.extent(scale, threshold)))
+        axes = [origin[i] + resolution * np.arange(dimensions[i]) for i in range(3)]
+        for i in range(0, dimensions[0], block):
+            for j in range(0, dimensions[1], block):
+                for k in range(0, dimensions[2], block):
+                    block_axes = axes[0][i:i + block], axes[1][j:j + block], axes[2][k:k + block]
+                    lower = np.array([axis[0] for axis in block_axes])
+                    upper = np.array([axis[-1] for axis in block_axes])
+                    values = np.zeros((coefficients.shape[1],) + tuple(len(axis) for axis in block_axes))
+                    for shell, shell_coefficients, extent in shells:
+                        if np.linalg.norm(shell.centre - np.clip(shell.centre, lower, upper)) > extent:
+                            continue
+                        values += (shell_coefficients @ shell.evaluate(block_axes)).reshape(values.shape)
+                    yield (slice(i, i + block), slice(j, j + block), slice(k, k + block)), values
+
+
+@functools.lru_cache(maxsize=16)
+def basis_set(molecule) -> BasisSet:
+    r"""BasisSet.from_molecule(molecule), remembered for the most recently used molecules."""
+    return BasisSet.from_molecule(molecule)
+
+
+def molecule_node(orbital):
+    r"""The lxml element of the molecule holding a pymolpro Orbital."""
+    return orbital.node.xpath('./parent::*/parent::*')[-1]
+
+
+def _evaluate_box(evaluate, atoms, resolution: float, border: float, threshold: float):
+    r"""
+    Evaluate `evaluate(origin, resolution, dimensions)`, an array whose last three axes are the grid, over the
+    atoms' box with `border` to spare, trimmed if `threshold` is given to where any of its values reaches it in
+    magnitude (see cube_data()), returning the grid's origin, its dimensions and the values.
+    """
+    xyz = np.array([atom['xyz'] for atom in atoms])
+    origin = np.min(xyz, axis=0) - border
+    far_corner = np.max(xyz, axis=0) + border
+    if threshold is not None:
+        coarse_resolution = resolution * TRIM_COARSENING
+        coarse_dimensions = [int((far_corner[i] - origin[i]) / coarse_resolution + 1) for i in range(3)]
+        coarse = np.abs(evaluate(origin, coarse_resolution, coarse_dimensions))
+        significant = np.any(coarse.reshape((-1,) + coarse.shape[-3:]) >= threshold, axis=0)
+        if significant.any():
+            lower, upper = origin.copy(), far_corner.copy()
+            for i in range(3):
+                indices = np.flatnonzero(significant.any(axis=tuple(j for j in range(3) if j != i)))
+                lower[i] = max(origin[i], origin[i] + (indices[0] - 1) * coarse_resolution)
+                upper[i] = min(far_corner[i], origin[i] + (indices[-1] + 1) * coarse_resolution)
+            origin, far_corner = lower, upper
+    dimensions = [int((far_corner[i] - origin[i]) / resolution + 1) for i in range(3)]
+    return origin, dimensions, evaluate(origin, resolution, dimensions)
+
+
+def cube_data(orbital, resolution: float = .2, border: float = 4.25, threshold: float = None) -> CubeData:
+    r"""
+    The equivalent of pymolpro's `orbital.cube_data(resolution=resolution, border=border, threshold=threshold)`,
+    evaluated with BasisSet.evaluate_grid().
+
+    The grid spans the atoms with `border` bohr to spare in every direction, except that if `threshold` is given
+    it is trimmed to the region where the magnitude of the orbital reaches `threshold`, located on a grid
+    TRIM_COARSENING times coarser and then widened by one coarse step.
+    """
+    atoms = orbital.atoms
+    basis = basis_set(molecule_node(orbital))
+    origin, dimensions, data = _evaluate_box(
+        lambda *grid: basis.evaluate_grid(orbital.coefficients.reshape(-1, 1), *grid),
+        atoms, resolution, border, threshold)
+    return CubeData({
+        'atoms': atoms,
+        'natoms': len(atoms),
+        'origin': origin,
+        'cells': np.diag([resolution, resolution, resolution]),
+        'dimensions': dimensions,
+        'orbitals': True,
+        'data': data[0],
+        'title': [orbital.attribute('ID'), ''],
+        'orbital_identifiers': [orbital.attribute('ID')],
+    })
+
+
+def orbitals_cube_data(orbitals: list, resolution: float = .2, border: float = 4.25,
+                       threshold: float = None) -> StackedCubeData:
+    r"""
+    Like cube_data(), but for several orbitals of the same molecule on one grid, returned as an iMolpro CubeData
+    whose data is the (orbitals, nx, ny, nz) stack. The basis functions are evaluated once for all of the
+    orbitals, each shell's contribution to every orbital then being a single matrix product. With `threshold`,
+    the grid is trimmed to where any of the orbitals reaches it. Its orbital_identifiers are the Molpro IDs, as
+    in pymolpro's cube data, which CubeData.write() turns into the integer indices of a cube file.
+    """
+    nodes = [molecule_node(orbital) for orbital in orbitals]
+    if any(node is not nodes[0] for node in nodes):
+        raise ValueError('orbitals_cube_data() needs orbitals all belonging to the same molecule')
+    atoms = orbitals[0].atoms
+    basis = basis_set(nodes[0])
+    coefficients = np.stack([orbital.coefficients for orbital in orbitals], axis=1)
+    origin, dimensions, data = _evaluate_box(lambda *grid: basis.evaluate_grid(coefficients, *grid),
+                                             atoms, resolution, border, threshold)
+    return StackedCubeData({
+        'atoms': atoms,
+        'natoms': len(atoms),
+        'origin': tuple(origin),
+        'cells': np.diag([resolution, resolution, resolution]),
+        'dimensions': dimensions,
+        'orbitals': True,
+        'data': data if len(orbitals) > 1 else data[0],
+        'title': [' '.join(orbital.attribute('ID') for orbital in orbitals), ''],
+        'orbital_identifiers': [orbital.attribute('ID') for orbital in orbitals],
+    })
+
+
+def energy_window(orbitals: list, lowest: float = -math.inf, highest: float = math.inf) -> list:
+    r"""Those of `orbitals`, occupied or virtual, whose energies lie between `lowest` and `highest` hartree."""
+    return [orbital for orbital in orbitals if lowest <= orbital.energy <= highest]
+
+
+# Occupations within this of 1 mark the singly occupied orbitals that carry the spin density of a restricted
+# open-shell orbital set.
+SINGLE_OCCUPATION_TOLERANCE = 1e-6
+
+
+class Density:
+    r"""
+    An electron density built from orbitals: the sum, over one or more `terms`, each a list of orbitals of one
+    molecule with a weight for each, of the weights times the squares of the orbitals. Terms may come from
+    different molecules, or different runs, in which case the grid spans the atoms of all of them and the first
+    term's atoms are the ones drawn with it. `ID` is its label; with `atoms` and cube_data(), it can stand in for
+    an Orbital where only those are needed.
+    """
+
+    def __init__(self, ID: str, terms: list[tuple[list, list]]):
+        self.ID = ID
+        self.terms = [(list(orbitals), np.asarray(weights, dtype=np.float64)) for orbitals, weights in terms
+                      if len(orbitals) > 0]
+        if not self.terms:
+            raise ValueError(f'{ID} has no orbitals to build it from')
+        for orbitals, weights in self.terms:
+            if len(weights) != len(orbitals):
+                raise ValueError('a density needs one weight for each orbital')
+            if any(molecule_node(orbital) is not molecule_node(orbitals[0]) for orbital in orbitals):
+                raise ValueError('the orbitals of each term of a density must belong to the same molecule')
+
+    @property
+    def atoms(self) -> list[dict]:
+        return self.terms[0][0][0].atoms
+
+    def evaluate_grid(self, origin, resolution: float, dimensions) -> np.ndarray:
+        r"""The density on the grid of `dimensions` points spaced by `resolution` from `origin`."""
+        result = np.zeros(tuple(int(n) for n in dimensions))
+        for orbitals, weights in self.terms:
+            result += basis_set(molecule_node(orbitals[0])).evaluate_density(
+                np.stack([orbital.coefficients for orbital in orbitals], axis=1), weights, origin, resolution,
+                dimensions)
+        return result
+
+    def cube_data(self, resolution: float = .2, border: float = 4.25, threshold: float = None) -> CubeData:
+        r"""The density on a grid laid out as in cube_data(), trimmed with `threshold` to where it reaches it."""
+        box_atoms = [atom for orbitals, weights in self.terms for atom in orbitals[0].atoms]
+        origin, dimensions, data = _evaluate_box(self.evaluate_grid, box_atoms, resolution, border, threshold)
+        return CubeData({
+            'atoms': self.atoms,
+            'natoms': len(self.atoms),
+            'origin': origin,
+            'cells': np.diag([resolution, resolution, resolution]),
+            'dimensions': dimensions,
+            'orbitals': False,
+            'data': data,
+            'title': [self.ID, ''],
+        })
+
+
+def _occupations(orbitals: list) -> np.ndarray:
+    return np.array([float(getattr(orbital, 'occupation', 0.0)) for orbital in orbitals])
+
+
+def singly_occupied(orbitals: list) -> list:
+    r"""Those of `orbitals` whose occupation is 1, within SINGLE_OCCUPATION_TOLERANCE."""
+    return [orbital for orbital, occupation in zip(orbitals, _occupations(orbitals))
+            if abs(occupation - 1) < SINGLE_OCCUPATION_TOLERANCE]
+
+
+def orbital_set_spin(orbitals: list) -> str | None:
+    r"""'alpha' or 'beta' for the orbitals of one spin of an unrestricted calculation, otherwise None."""
+    spin = orbitals[0].node.getparent().get('spin') if orbitals else None
+    return spin if spin in ('alpha', 'beta') else None
+
+
+def total_density(orbitals: list, label: str = 'Total density') -> Density:
+    r"""The density of `orbitals` according to their occupations."""
+    return Density(label, [(orbitals, _occupations(orbitals))])
+
+
+def spin_density(orbitals: list, partner: list = None, label: str = 'Spin density') -> Density:
+    r"""
+    The alpha minus the beta electron density. For unrestricted orbitals, `orbitals` and `partner` are the sets of
+    the two spins, in either order; for a restricted open-shell set, `partner` is not needed, and the spin density
+    is that of the singly occupied orbitals, taken to be alpha as in a high-spin calculation.
+    """
+    if partner is None:
+        singles = singly_occupied(orbitals)
+        return Density(label, [(singles, np.ones(len(singles)))])
+    sign = -1 if orbital_set_spin(orbitals) == 'beta' else 1
+    return Density(label, [(orbitals, sign * _occupations(orbitals)), (partner, -sign * _occupations(partner))])
+
+
+def difference_density(orbitals: list, reference: list, label: str = 'Difference density') -> Density:
+    r"""The density of `orbitals` minus that of `reference`, which may come from a different molecule or run."""
+    return Density(label, [(orbitals, _occupations(orbitals)), (reference, -_occupations(reference))])
@@ -21,7 +21,7 @@ except:
 
 from .draggabletabwidget import DraggableTabWidget
 from .utilities import ViewFile, atoms_from_xyz
-from .vtk_molecule_widget import MoleculeDisplay
+from .vtk_molecule_widget import MoleculeDisplay, orbital_densities, orbital_sets, spin_partner
 
 
 class ViewProjectOutput(ViewFile):
@@ -93,6 +93,9 @@ class MyTabWidget(DraggableTabWidget):
         return -1
 
     def clear(self):
+        for i in range(self.count()):
+            if isinstance(self.widget(i), MoleculeDisplay):
+                self.widget(i).release_cubes()
         self.tab_names.clear()
         super().clear()
 
@@ -207,27 +210,30 @@ class OutputTabWidget(MyTabWidget):
                 pass
 
         if xml_exists and xml_changed:
-            labels = {}
+            previous = {}
             try:
-                for index in range(10000):  # get orbital sets
-                    orbitals = self.parent.project.orbitals(index)
-                    orbitals_node = orbitals[0].node.getparent()
-                    label = orbitals_node.attrib['method'] + '/' + orbitals_node.attrib['type'] + ' orbitals'
-                    if label in labels:
-                        labels[label] += 1
-                        label = label + ': ' + str(labels[label])
-                    else:
-                        labels[label] = 1
+                for label, orbitals in orbital_sets(self.parent.project).items():
                     # print('found','orbital set', label)
                     if label not in tab_names:
                         # print('new tab','orbital set', label)
                         self.addTab(MoleculeDisplay(orbitals, self,
-                                                    metadata=orbitals_node.attrib,
+                                                    metadata=orbitals[0].node.getparent().attrib,
+                                                    densities=orbital_densities(
+                                                        orbitals, partner=spin_partner(self.parent.project, orbitals),
+                                                        references=previous),
+                                                    reference_sets=lambda label=label: self.reference_sets(label),
                                                     ), label)
+                    # offer the difference from the orbital set before, not from every earlier one; any other set,
+                    # of this run or another, can be chosen as the reference in the display
+                    previous = {label: orbitals}
             except Exception as e:
                 if not isinstance(e, (IndexError)) and not isinstance(e, (AttributeError)):
                     print('Orbitals except', str(e) + ' ' + str(type(e)))
                 pass
 
+    def reference_sets(self, label):
+        r"""The orbital sets of this run other than the one labelled `label`, to take a density difference from."""
+        return {other: orbitals for other, orbitals in orbital_sets(self.parent.project).items() if other != label}
+
     def label(self, suffix: str) -> str:
         return os.path.basename(self.parent.project.filename(suffix, run=(self.parent.project.run_directory)))
@@ -1,4 +1,10 @@
+import itertools
+import logging
 import os
+import pathlib
+import platform
+import threading
+import weakref
 
 import pikepdf
 from pikepdf import PdfImage
@@ -7,27 +13,35 @@ import math
 import numpy as np
 from pymolpro import Orbital
 
-from .project import Structure
+from .bonds import perceive_bonds
+from .cube_cache import orbital_cube_data, density_cube_data, stored_orbital_cube_data, stored_density_cube_data, \
+    content_digest, shared_cube_cache, CubeCache, CubePrefetcher, OrbitalCubeDiskCache
+from .orbital_grid import Density, total_density, spin_density, difference_density, orbital_set_spin, \
+    singly_occupied
+from .isosurface import IsosurfaceBuilder, isosurface, grid_identities, prepare_grid, use_smp_threads
+from .project import Project, Structure
 from .theme import LIGHT_GREY_WINDOW, DARK_GREY_WINDOW, THEMES, theme_manager
 from .settings import settings
-from .utilities import displace_coordinate
 
 try:
     from PySide6.QtGui import QColor, QPalette
     from PySide6.QtWidgets import QFileDialog, QPushButton, QColorDialog, QWidget, QLabel, QGridLayout, QHBoxLayout, \
-        QVBoxLayout, QSlider, QSizePolicy, QComboBox, QLayout, QCheckBox, QToolButton
-    from PySide6.QtCore import Qt, QSize, QTimer, QElapsedTimer
+        QVBoxLayout, QSlider, QSizePolicy, QComboBox, QLayout, QCheckBox, QToolButton, QInputDialog, \
+        QMessageBox
+    from PySide6.QtCore import Qt, QSize, QTimer, QElapsedTimer, Signal as pyqtSignal
 except ImportError:
     try:
         from PyQt6.QtGui import QColor, QPalette
         from PyQt6.QtWidgets import QFileDialog, QPushButton, QColorDialog, QWidget, QLabel, QGridLayout, QHBoxLayout, \
-            QVBoxLayout, QSlider, QSizePolicy, QComboBox, QLayout, QCheckBox, QToolButton
-        from PyQt6.QtCore import Qt, QSize, QTimer, QElapsedTimer
+            QVBoxLayout, QSlider, QSizePolicy, QComboBox, QLayout, QCheckBox, QToolButton, QInputDialog, \
+            QMessageBox
+        from PyQt6.QtCore import Qt, QSize, QTimer, QElapsedTimer, pyqtSignal
     except ImportError:
         from PyQt5.QtGui import QColor, QPalette
         from PyQt5.QtWidgets import QFileDialog, QPushButton, QColorDialog, QWidget, QLabel, QGridLayout, QHBoxLayout, \
-            QVBoxLayout, QSlider, QSizePolicy, QComboBox, QLayout, QCheckBox, QToolButton
-        from PyQt5.QtCore import Qt, QSize, QTimer, QElapsedTimer
+            QVBoxLayout, QSlider, QSizePolicy, QComboBox, QLayout, QCheckBox, QToolButton, QInputDialog, \
+            QMessageBox
+        from PyQt5.QtCore import Qt, QSize, QTimer, QElapsedTimer, pyqtSignal
 
 try:
     ColorRole = QPalette.ColorRole
@@ -38,12 +52,13 @@ from pymolpro.cube_data import CubeData
 from ase.data import colors, covalent_radii, chemical_symbols
 from pymolpro.elements import periodic_table
 from vtkmodules.vtkCommonColor import vtkNamedColors
-from vtkmodules.vtkCommonCore import vtkStringArray, vtkIntArray, vtkPoints, vtkFloatArray, vtkMath, \
-    vtkMinimalStandardRandomSequence
-from vtkmodules.vtkCommonDataModel import vtkPolyData, vtkImageData
+from vtkmodules.vtkCommonCore import vtkStringArray, vtkIntArray, vtkPoints, vtkMath, \
+    vtkMinimalStandardRandomSequence, VTK_FLOAT
+from vtkmodules.vtkCommonDataModel import vtkPolyData, vtkImageData, vtkStructuredGrid
 from vtkmodules.vtkCommonMath import vtkMatrix4x4
 from vtkmodules.vtkCommonTransforms import vtkTransform
-from vtkmodules.vtkFiltersCore import vtkGlyph3D, vtkContourFilter
+from vtkmodules.vtkFiltersCore import vtkGlyph3D
+from vtkmodules.vtkFiltersGeneral import vtkTransformFilter
 from vtk import vtkActor
 from .QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 
@@ -54,14 +69,15 @@ from vtkmodules.vtkIOExportGL2PS import vtkGL2PSExporter
 from vtkmodules.vtkInteractionStyle import vtkInteractorStyleTrackballCamera
 from vtkmodules.vtkRenderingAnnotation import vtkCubeAxesActor
 from vtkmodules.vtkRenderingCore import vtkRenderer, vtkLightKit, vtkActor2D, vtkActorCollection, vtkPolyDataMapper, \
-    vtkColorTransferFunction, vtkTextProperty
+    vtkColorTransferFunction, vtkTextProperty, vtkGlyph3DMapper, vtkWindowToImageFilter
 from vtkmodules.vtkRenderingLabel import vtkPointSetToLabelHierarchy, vtkLabelPlacementMapper
+from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
 
 # On VTK builds where they're compiled in (e.g. the official PyPI wheels),
 # vtkContourFilter can be silently swapped at runtime for a Viskores
 # (formerly VTK-m) accelerated implementation via VTK's object factory.
 # That accelerated path logs an "INFO| Using flying edges" line to stderr
-# every time CubeActor's vtkContourFilter runs, which is harmless but
+# every time iMolpro.isosurface.contour() runs, which is harmless but
 # noisy. Explicitly disabling the override keeps vtkContourFilter on its
 # ordinary (non-Viskores) code path, which doesn't emit that message.
 # Older/minimal VTK builds don't ship this module at all, hence the guard.
@@ -73,6 +89,12 @@ except ImportError:
     pass
 
 
+logger = logging.getLogger(__name__)
+# Animation frame timings and the adjustments FramePacer makes, at debug level, on a channel of their own so that
+# they can be switched on without everything else.
+frame_logger = logging.getLogger(__name__ + '.frames')
+
+
 class ColourScheme(Enum):
     dark = DARK_GREY_WINDOW.red(), DARK_GREY_WINDOW.green(), DARK_GREY_WINDOW.blue(),
     light = LIGHT_GREY_WINDOW.red(), LIGHT_GREY_WINDOW.green(), LIGHT_GREY_WINDOW.blue(),
@@ -153,16 +175,44 @@ class ItemLayout(QGridLayout):
 
 
 class MoleculeDisplay(QWidget):
+    # Emitted, from a prefetch worker thread, with the (orbital, resolution) key of each grid that
+    # lands in self.cubes; delivered to _on_cube_ready() on the GUI thread.
+    cube_ready = pyqtSignal(object)
+    # In progressive mode (settings['progressive_orbital_rendering']), an orbital whose grid isn't
+    # cached yet is first drawn from a grid this many times coarser, then redrawn once the grid at
+    # the requested resolution has been evaluated in the background.
+    PROGRESSIVE_COARSENING = 4
+    # The coarse grid is evaluated on the GUI thread, so by the faster backend, whatever
+    # settings['orbital_grid_backend'] says; it is on screen only until the real grid arrives. For a basis set
+    # the faster backend can't evaluate, eg. with shells of mixed angular momentum, pymolpro is used instead.
+    PROGRESSIVE_BACKEND = 'screened'
+
     def __init__(self, source: Structure | str | list, parent=None, axes: bool = False,
                  background_colour: tuple | ColourScheme | None = None,
                  contour_value=None, contour_opacity=None,
                  resolution: float = None,
                  metadata: dict = {},
+                 densities: list[Density] = None,
+                 reference_sets=None,
                  ):
+        r"""
+        :param densities: For a list of orbitals, the densities that can be shown in place of an orbital; by
+            default, those of orbital_densities().
+        :param reference_sets: For a list of orbitals, a callable giving the orbital sets, by label, that
+            choose_difference_reference() offers, besides those of another run, to take a density difference from.
+        """
         settings.add_default('contour_value', .1)
         settings.add_default('contour_opacity', .7)
         settings.add_default('grid_resolution', .3)
         settings.add_default('vibrational_frequency_scaling', 1.0)
+        settings.add_default('adaptive_frame_pacing', 1)
+        settings.add_default('vibration_movie_frames', 36)
+        settings.add_default('vibration_movie_fps', 24)
+        settings.add_default('cube_cache_megabytes', 1024)
+        settings.add_default('cube_disk_cache_megabytes', 1024)
+        settings.add_default('orbital_prefetch_neighbours', 1)
+        settings.add_default('progressive_orbital_rendering', 1)
+        settings.add_default('orbital_grid_backend', 'pymolpro')
         if contour_value is None:
             contour_value = settings['contour_value']
             # print('MoleculeDisplay() sets contour_value',contour_value)
@@ -190,6 +240,7 @@ class MoleculeDisplay(QWidget):
         self.vibrational_mode = 0
         self.vibration_animating = False
         self._vibration_timer = None
+        self._frame_pacer = None
 
         if isinstance(source, list) and len(source) > 0 and isinstance(source[-1], dict):
             data = source
@@ -199,11 +250,22 @@ class MoleculeDisplay(QWidget):
                 metadata['vibrations'] = source.vibrations
                 self._equilibrium_atoms = source.atoms
         elif isinstance(source, list) and len(source) > 0 and isinstance(source[-1], Orbital):
-            self.cubes = {}
+            # Grids are kept in the process-wide cache, under the content of the orbital, so that another window
+            # or tab showing the same run finds them there; this display's share is given up in release_cubes().
+            self.cubes = cubes = shared_cube_cache(self._cube_cache_bytes()).view(self._content_key)
+            OrbitalCubeDiskCache.set_budget(self._disk_cache_bytes())
+            self._content_digests = {}
+            weakref.finalize(self, cubes.close)
+            self.destroyed.connect(lambda *args: cubes.close())
+            self.prefetcher = CubePrefetcher(self.cubes, self._evaluate_cube, on_ready=self.cube_ready.emit)
+            self._prefetch_cancelled = False
+            self.cube_ready.connect(self._on_cube_ready)
             self.orbitals = source
+            self.densities = orbital_densities(source) if densities is None else densities
+            self.reference_sets = reference_sets
             self.resolution = resolution
             self.orbital = source[-1]
-            data = self.get_cube(contour_value=contour_value)
+            data = self.get_progressive_cube(contour_value=contour_value)
         else:
             raise ValueError('source must be a list of Orbitals or a dict of atoms or an xyz filename')
 
@@ -215,25 +277,184 @@ class MoleculeDisplay(QWidget):
         self.right_panel = ControlPanel(self, metadata=metadata)
         layout.addWidget(self.right_panel)
 
-    def get_cube(self, contour_value=None):
-        # print('get_cube',self.orbital.ID,self.resolution,contour_value,'')
-        key = self.orbital, self.resolution, contour_value
-        if key not in self.cubes:
-            # print('get_cube',self.orbital.ID,self.resolution,contour_value,'creating')
-            self.cubes[key] = self.orbital.cube_data(resolution=self.resolution, threshold=contour_value * .1, border=6)
-        return self.cubes[key]
+        if hasattr(self, 'orbitals'):
+            self.prefetch_orbitals(frontier=True)
+
+    def get_cube(self, contour_value=None, resolution=None, backend=None):
+        # The threshold only trims the evaluated box to where the orbital is non-negligible, so a
+        # grid evaluated for a smaller threshold than needed covers the requested isosurface too;
+        # cache one grid per orbital and resolution, replacing it only when the contour drops
+        # below what it was trimmed for.
+        threshold = contour_value * .1
+        key = self._cube_key(self.orbital, self.resolution if resolution is None else resolution, backend)
+        cached = self.cubes.get(key, accept=lambda cached: cached[0] <= threshold)
+        if cached is None and self.prefetcher.wait(key, threshold):
+            cached = self.cubes.peek(key)
+        if cached is None or cached[0] > threshold:
+            cached = threshold, self._evaluate_cube(key, threshold)
+            self.cubes.put(key, cached, cached[1].data.nbytes)
+        return cached[1]
+
+    def get_progressive_cube(self, contour_value=None):
+        r"""
+        The grid for the current orbital to draw straight away: get_cube() itself if it's already in memory or on
+        disk (or progressive rendering is switched off), otherwise a PROGRESSIVE_COARSENING times coarser grid from
+        PROGRESSIVE_BACKEND, or pymolpro if that can't evaluate it, leaving prefetch_orbitals() to evaluate the
+        full-resolution one and _on_cube_ready() to swap it in.
+        """
+        threshold = contour_value * .1
+        key = self._cube_key(self.orbital, self.resolution)
+        cached = self.cubes.peek(key)
+        if cached is None or cached[0] > threshold:
+            if (stored := self._stored_cube(key, threshold)) is not None:
+                cached = threshold, stored
+                self.cubes.put(key, cached, stored.data.nbytes)
+        self._coarse_cube_shown = bool(int(settings['progressive_orbital_rendering'])) and (
+                cached is None or cached[0] > threshold)
+        if self._coarse_cube_shown:
+            resolution = self.resolution * self.PROGRESSIVE_COARSENING
+            try:
+                return self.get_cube(contour_value, resolution=resolution, backend=self.PROGRESSIVE_BACKEND)
+            except NotImplementedError as error:
+                logger.debug(f'Coarse grid from pymolpro instead of {self.PROGRESSIVE_BACKEND}: {error}')
+                return self.get_cube(contour_value, resolution=resolution, backend='pymolpro')
+        return self.get_cube(contour_value)
+
+    def _on_cube_ready(self, key):
+        if not self._coarse_cube_shown or key != self._cube_key(self.orbital, self.resolution):
+            return
+        cached = self.cubes.peek(key)
+        if cached is None:
+            return
+        if cached[0] > self.molecule_widget.model.contour_value * .1:
+            # the contour was lowered while the grid was being evaluated, and the grid is trimmed too tightly
+            # for it, so ask for one that isn't and keep the coarse one until that arrives
+            self.prefetch_orbitals()
+            return
+        self._coarse_cube_shown = False
+        self.molecule_widget.refresh_contour(cached[1])
+
+    @staticmethod
+    def _cube_cache_bytes() -> int:
+        return int(float(settings['cube_cache_megabytes']) * 1e6)
+
+    @staticmethod
+    def _disk_cache_bytes() -> int:
+        r"""The most bytes of grids each run directory keeps on disk; see OrbitalCubeDiskCache."""
+        return int(float(settings['cube_disk_cache_megabytes']) * 1e6)
+
+    @staticmethod
+    def _cube_key(orbital, resolution, backend=None) -> tuple:
+        r"""
+        The key of a grid in self.cubes, with the grid backend to evaluate it with, `backend` or else the one read
+        from the settings here, on the GUI thread, and so never by the prefetch workers, which get it from the key.
+        """
+        return orbital, resolution, str(settings['orbital_grid_backend']) if backend is None else backend
+
+    def _content_key(self, key):
+        orbital, resolution, backend = key
+        if orbital not in self._content_digests:
+            self._content_digests[orbital] = content_digest(orbital)
+        return self._content_digests[orbital], float(resolution), backend
+
+    def release_cubes(self):
+        r"""Give up this display's references to grids in the shared cache, freeing those no other view holds."""
+        if hasattr(self, 'prefetcher'):
+            self.prefetcher.cancel()
+            self.cubes.close()
+
+    @staticmethod
+    def _stored_cube(key, threshold):
+        orbital, resolution, backend = key
+        if isinstance(orbital, Density):
+            return stored_density_cube_data(orbital, resolution=resolution, threshold=threshold, border=6)
+        return stored_orbital_cube_data(orbital, resolution=resolution, threshold=threshold, border=6,
+                                        backend=backend)
+
+    @staticmethod
+    def _evaluate_cube(key, threshold):
+        orbital, resolution, backend = key
+        if isinstance(orbital, Density):
+            return density_cube_data(orbital, resolution=resolution, threshold=threshold, border=6)
+        return orbital_cube_data(orbital, resolution=resolution, threshold=threshold, border=6, backend=backend)
+
+    def prefetch_orbitals(self, frontier: bool = False):
+        r"""
+        Start evaluating, in the background, the grids of the orbitals either side of the current one in
+        self.orbitals (settings['orbital_prefetch_neighbours'] each way), and also of the HOMO and LUMO
+        if `frontier`, so that stepping through the orbital selector finds them already in self.cubes.
+        The current orbital's own grid goes first, if it is still only being shown coarse-grained.
+        Anything queued earlier for other orbitals is dropped.
+        """
+        self._prefetch_cancelled = False
+        self.cubes.shared.set_budget(self._cube_cache_bytes())
+        OrbitalCubeDiskCache.set_budget(self._disk_cache_bytes())
+        neighbours = int(settings['orbital_prefetch_neighbours'])
+        wanted = [self.orbital] + (frontier_orbitals(self.orbitals) if frontier else [])
+        if self.orbital in self.orbitals:
+            index = self.orbitals.index(self.orbital)
+            for distance in range(1, neighbours + 1):
+                wanted += [self.orbitals[i] for i in (index + distance, index - distance)
+                           if 0 <= i < len(self.orbitals)]
+        threshold = self.molecule_widget.model.contour_value * .1
+        self.prefetcher.schedule([(self._cube_key(orbital, self.resolution), threshold)
+                                  for orbital in dict.fromkeys(wanted)])
 
     def set_atom_labels(self, atom_labels: bool):
         self.molecule_widget.show_nucleus_labels(atom_labels)
 
     def set_orbital(self, orbital_id):
         # print('set_orbital', orbital_id)
-        self.orbital = self.orbitals[[orbital.ID for orbital in self.orbitals].index(orbital_id)]
-        cube_data = self.get_cube(self.molecule_widget.model.contour_value)
+        choices = self.orbitals + self.densities
+        self.orbital = choices[[orbital.ID for orbital in choices].index(orbital_id)]
+        cube_data = self.get_progressive_cube(self.molecule_widget.model.contour_value)
         # print(str(cube_data)[:100] + '...')
         self.right_panel.refresh()
         self.molecule_widget.refresh_model(cube_data)
-        pass
+        self.prefetch_orbitals()
+
+    def choose_difference_reference(self):
+        r"""
+        Ask for an orbital set, either one of reference_sets or one of another run, chosen by its project, and show
+        the density of this display's orbitals minus that of the chosen set.
+        """
+        another_run = 'Another run...'
+        candidates = self.reference_sets() if self.reference_sets is not None else {}
+        label, ok = QInputDialog.getItem(self, 'Difference density', 'Subtract the density of',
+                                         list(candidates) + [another_run], 0, False)
+        if not ok:
+            return
+        if label == another_run:
+            directory = settings['project_directory'] if 'project_directory' in settings else os.path.curdir
+            if platform.system() == 'Darwin':
+                filename, chosen_filter = QFileDialog.getOpenFileName(self, 'Choose a run', directory,
+                                                                      filter='Molpro projects (*.molpro)')
+            else:
+                filename = QFileDialog.getExistingDirectory(self, 'Choose a run', directory)
+            if not filename:
+                return
+            candidates = orbital_sets(Project(filename))
+            if not candidates:
+                QMessageBox.warning(self, 'Difference density', f'{filename} has no orbitals')
+                return
+            label, ok = QInputDialog.getItem(self, 'Difference density', 'Subtract the density of',
+                                             list(candidates), 0, False)
+            if not ok:
+                return
+            reference = candidates[label]
+            label = pathlib.Path(filename).stem + ': ' + label
+        else:
+            reference = candidates[label]
+        self.add_difference_density(reference, label)
+
+    def add_difference_density(self, reference: list[Orbital], label: str) -> Density:
+        r"""Offer, and show, the density of this display's orbitals minus that of `reference`, called `label`."""
+        density = difference_density(self.orbitals, reference, label=f'Density - {label}')
+        self.densities = [existing for existing in self.densities if existing.ID != density.ID] + [density]
+        self.set_orbital(density.ID)
+        self.right_panel.setup(metadata=self.metadata)
+        self.right_panel.refresh()
+        return density
 
     def set_vibration(self, mode_index):
         self.vibrational_mode = mode_index
@@ -276,6 +497,33 @@ class MoleculeDisplay(QWidget):
             self._vibration_t0 = self._vibration_clock.elapsed() / 1000.0
             self._vibration_omega = self._vibration_base_omega * scaling
 
+    def export_vibration_movie(self, filename: str = None):
+        r"""
+        Write one period of the selected normal mode, as it's viewed, to `filename` or one chosen in a dialog: an
+        animated PNG or GIF, or a pattern for numbered images; see movie.movie_writer().
+        """
+        vibrations = self.metadata.get('vibrations')
+        if not vibrations or not vibrations.modes or not hasattr(self, '_equilibrium_atoms'):
+            return
+        if filename is None:
+            filename, chosen_filter = QFileDialog.getSaveFileName(
+                self, 'Export movie', '', 'Animated PNG (*.png);;Animated GIF (*.gif);;PNG images (*.png)')
+            if filename is None or filename == '':
+                return
+            stem, extension = os.path.splitext(filename)
+            if chosen_filter.startswith('PNG images'):
+                filename = stem + '_{:03d}.png'
+            elif not extension:
+                filename += '.gif' if chosen_filter.startswith('Animated GIF') else '.png'
+        from .movie import export_vibration_movie
+        scene = self.molecule_widget.scene
+        export_vibration_movie(self._equilibrium_atoms, vibrations.modes[self.vibrational_mode], filename,
+                               frames=int(settings['vibration_movie_frames']),
+                               fps=float(settings['vibration_movie_fps']),
+                               width=scene.GetRenderWindow().GetSize()[0], height=scene.GetRenderWindow().GetSize()[1],
+                               background=scene.renderer.GetBackground(), camera=scene.renderer.GetActiveCamera(),
+                               peak_displacement=self.VIBRATION_PEAK_DISPLACEMENT)
+
     def _current_vibration_phase(self):
         t = self._vibration_clock.elapsed() / 1000.0
         return self._vibration_phase0 + self._vibration_omega * (t - self._vibration_t0)
@@ -285,14 +533,10 @@ class MoleculeDisplay(QWidget):
         if not vibrations or not vibrations.modes or not hasattr(self, '_equilibrium_atoms'):
             return
         mode = vibrations.modes[self.vibrational_mode]
-        vector = mode['vector']
-        n_atoms = len(vector) // 3
-        peak_norm = max(
-            (math.sqrt(sum(vector[3 * i + k] ** 2 for k in range(3))) for i in range(n_atoms)),
-            default=0.0,
-        )
-        self._vibration_vector = vector
-        self._vibration_amplitude = self.VIBRATION_PEAK_DISPLACEMENT / peak_norm if peak_norm > 1e-8 else 0.0
+        self._vibration = VibrationAnimation(self._equilibrium_atoms, mode['vector'], self.VIBRATION_PEAK_DISPLACEMENT)
+        self.molecule_widget.model.geometry.set_animating(True)
+        self.molecule_widget.model.geometry.share_points(self._vibration.points)
+        self.molecule_widget.nucleus_labels.share_points(self._vibration.points)
         # 1000 cm-1 <-> 1 oscillation/sec, i.e. frequency_Hz = wavenumber / 1000, further
         # scaled by the user-adjustable 'Speed' slider (settings['vibrational_frequency_scaling'])
         self._vibration_base_omega = 2 * math.pi * mode['wavenumber'] / 1000.0
@@ -301,21 +545,38 @@ class MoleculeDisplay(QWidget):
         self._vibration_t0 = 0.0
         self._vibration_clock = QElapsedTimer()
         self._vibration_clock.start()
-        self.molecule_widget.model.geometry.set_sphere_resolution(self.VIBRATION_ANIMATING_SPHERE_RESOLUTION)
+        self._log_frame_statistics()
+        self._frame_pacer = FramePacer(self.VIBRATION_FRAME_INTERVAL_MS, self.VIBRATION_ANIMATING_SPHERE_RESOLUTION,
+                                       adaptive=bool(int(settings['adaptive_frame_pacing'])))
+        self.molecule_widget.model.geometry.set_sphere_resolution(self._frame_pacer.resolution)
         if self._vibration_timer is None:
             self._vibration_timer = QTimer(self)
             self._vibration_timer.timeout.connect(self._advance_vibration_animation)
-        self._vibration_timer.start(self.VIBRATION_FRAME_INTERVAL_MS)
+        self._vibration_timer.start(round(self._frame_pacer.interval))
 
     def _advance_vibration_animation(self):
-        displacement = self._vibration_amplitude * math.sin(self._current_vibration_phase())
-        atoms = displace_coordinate(self._equilibrium_atoms, self._vibration_vector, displacement)
-        self.molecule_widget.update_geometry(atoms)
+        start = self._vibration_clock.nsecsElapsed() / 1e6
+        self._vibration.frame(self._current_vibration_phase())
+        self.molecule_widget.update_positions(self._vibration)
+        if self._frame_pacer.frame(start, self._vibration_clock.nsecsElapsed() / 1e6 - start):
+            self._vibration_timer.setInterval(round(self._frame_pacer.interval))
+            self.molecule_widget.model.geometry.set_sphere_resolution(self._frame_pacer.resolution)
+
+    def _log_frame_statistics(self):
+        if getattr(self, '_frame_pacer', None) is not None and self._frame_pacer.frames:
+            statistics = self._frame_pacer.statistics
+            frame_logger.debug(f'Vibration animation: {statistics["frames"]} frames, {statistics["late"]} late, '
+                               f'{statistics["dropped"]} dropped; drawing took {statistics["render_time"]:.1f} ms, '
+                               f'finishing at {statistics["interval"]:.0f} ms intervals and sphere resolution '
+                               f'{statistics["resolution"]}')
+        self._frame_pacer = None
 
     def _stop_vibration_animation(self):
         if self._vibration_timer is not None:
             self._vibration_timer.stop()
+        self._log_frame_statistics()
         if hasattr(self, '_equilibrium_atoms'):
+            self.molecule_widget.model.geometry.set_animating(False)
             self.molecule_widget.model.geometry.set_sphere_resolution(NucleiActor.STATIC_SPHERE_RESOLUTION)
             self.molecule_widget.update_geometry(self._equilibrium_atoms)
 
@@ -325,13 +586,20 @@ class MoleculeDisplay(QWidget):
         # doesn't delete the old widget) doesn't keep re-rendering forever.
         if self._vibration_timer is not None:
             self._vibration_timer.stop()
+        # Likewise, stop spending worker time on grids for a tab nobody is looking at.
+        if hasattr(self, 'prefetcher'):
+            self.prefetcher.cancel()
+            self._prefetch_cancelled = True
         super().hideEvent(event)
 
     def showEvent(self, event):
         super().showEvent(event)
-        if self.vibration_animating and self._vibration_timer is not None:
+        if hasattr(self, 'prefetcher') and self._prefetch_cancelled:
+            self.prefetch_orbitals()
+        if self.vibration_animating and self._vibration_timer is not None and self._frame_pacer is not None:
             self._vibration_clock.start()
-            self._vibration_timer.start(self.VIBRATION_FRAME_INTERVAL_MS)
+            self._frame_pacer.resume()
+            self._vibration_timer.start(round(self._frame_pacer.interval))
 
     def set_resolution(self, resolution):
         shift_factor = 0.8
@@ -347,7 +615,190 @@ class MoleculeDisplay(QWidget):
         self.set_orbital(self.orbital.ID)
 
 
+def orbital_densities(orbitals: list[Orbital], partner: list[Orbital] = None,
+                      references: dict[str, list[Orbital]] = {}) -> list[Density]:
+    r"""
+    The densities worth offering alongside `orbitals`: their total density; their spin density, if they are one
+    spin of an unrestricted calculation whose other spin is `partner`, or have singly occupied orbitals; and
+    their difference from each of the orbital sets in `references`, labelled by its key.
+    """
+    if not any(getattr(orbital, 'occupation', 0.0) > 0.0 for orbital in orbitals):
+        return []
+    densities = [total_density(orbitals)]
+    if orbital_set_spin(orbitals) is not None and partner:
+        densities.append(spin_density(orbitals, partner))
+    elif orbital_set_spin(orbitals) is None and singly_occupied(orbitals):
+        densities.append(spin_density(orbitals))
+    for label, reference in references.items():
+        densities.append(difference_density(orbitals, reference, label=f'Density - {label}'))
+    return densities
+
+
+def orbital_sets(project) -> dict[str, list[Orbital]]:
+    r"""
+    The orbital sets of `project`, in order, labelled by method and type, with a count after the first set of each
+    method and type.
+    """
+    sets = {}
+    counts = {}
+    for index in itertools.count():
+        try:
+            orbitals = project.orbitals(index)
+            attributes = orbitals[0].node.getparent().attrib
+        except (IndexError, AttributeError):
+            return sets
+        label = attributes['method'] + '/' + attributes['type'] + ' orbitals'
+        counts[label] = counts.get(label, 0) + 1
+        sets[label if counts[label] == 1 else label + ': ' + str(counts[label])] = orbitals
+
+
+def spin_partner(project, orbitals: list[Orbital]) -> list[Orbital] | None:
+    r"""
+    For the orbitals of one spin of an unrestricted calculation in `project`, those of the other spin from the same
+    method and molecule, if they are there. Of the orbital sets of the molecule with the other spin and the same
+    method, the nearest is taken, and, of two equally near, the one after an alpha set or before a beta one, as
+    Molpro writes them.
+    """
+    spin = orbital_set_spin(orbitals)
+    if spin is None:
+        return None
+    orbital_set = orbitals[0].node.getparent()
+    molecule = orbital_set.getparent()
+    sets = molecule.findall(orbital_set.tag)
+    position = next(index for index, other in enumerate(sets) if other is orbital_set)
+    partners = [index for index, other in enumerate(sets)
+                if other.get('spin') == {'alpha': 'beta', 'beta': 'alpha'}[spin]
+                and other.get('method') == orbital_set.get('method')]
+    if not partners:
+        return None
+    nearest = min(partners, key=lambda index: (abs(index - position),
+                                               index < position if spin == 'alpha' else index > position))
+    instance = next(index for index, other in enumerate(molecule.getroottree().iter(molecule.tag)) if other is molecule)
+    return project.orbitals(instance, orbital_instance=nearest)
+
+
+def frontier_orbitals(orbitals: list[Orbital]) -> list[Orbital]:
+    r"""The highest occupied and lowest unoccupied of `orbitals`, as far as they are present."""
+    occupied = [orbital for orbital in orbitals if getattr(orbital, 'occupation', 0.0) > 0.0]
+    unoccupied = [orbital for orbital in orbitals if getattr(orbital, 'occupation', 0.0) <= 0.0]
+    result = []
+    if occupied:
+        result.append(max(occupied, key=lambda orbital: getattr(orbital, 'energy', 0.0)))
+    if unoccupied:
+        result.append(min(unoccupied, key=lambda orbital: getattr(orbital, 'energy', 0.0)))
+    return result
+
+
+class FramePacer:
+    r"""
+    Keeps an animation within what the renderer can manage. frame() is told when each frame started and how long it
+    took to draw, on the clock of the animation's QElapsedTimer, and keeps counts of the frames drawn, of `late`
+    frames that took longer than the `interval` between them, and of `dropped` timer ticks that were never drawn
+    because the previous frame overran. When the smoothed drawing time goes over `OVERRUN` of the interval, the
+    sphere `resolution` is cut, down to `minimum_resolution`, and after that the interval is lengthened, up to
+    `maximum_interval`; when it comes back under `HEADROOM` of the interval, those are undone in the opposite order.
+    Each change is followed by `SETTLE_FRAMES` frames without another, so that the average can catch up with it.
+    """
+
+    OVERRUN = 0.8
+    HEADROOM = 0.4
+    SETTLE_FRAMES = 10
+    SMOOTHING = 0.2
+
+    def __init__(self, interval: float, resolution: int, minimum_resolution: int = 8,
+                 maximum_interval: float = 200.0, adaptive: bool = True):
+        self.target_interval = self.interval = interval
+        self.target_resolution = self.resolution = resolution
+        self.minimum_resolution = min(minimum_resolution, resolution)
+        self.maximum_interval = max(maximum_interval, interval)
+        self.adaptive = adaptive
+        self.frames = 0
+        self.late = 0
+        self.dropped = 0
+        self.render_time = None
+        self._previous_start = None
+        self._settling = 0
+
+    def frame(self, start: float, render_time: float) -> bool:
+        r"""
+        Account for a frame that started at `start` and took `render_time` to draw, both in milliseconds, returning
+        whether `interval` or `resolution` has been changed as a result.
+        """
+        self.frames += 1
+        if self._previous_start is not None:
+            self.dropped += max(0, round((start - self._previous_start) / self.interval) - 1)
+        self._previous_start = start
+        if render_time > self.interval:
+            self.late += 1
+        self.render_time = render_time if self.render_time is None else (
+                self.SMOOTHING * render_time + (1 - self.SMOOTHING) * self.render_time)
+        if not self.adaptive:
+            return False
+        if self._settling > 0:
+            self._settling -= 1
+            return False
+        interval, resolution = self.interval, self.resolution
+        if self.render_time > self.OVERRUN * self.interval:
+            if self.resolution > self.minimum_resolution:
+                self.resolution = max(self.minimum_resolution, self.resolution * 2 // 3)
+            else:
+                self.interval = min(self.maximum_interval, self.interval * 1.25)
+        elif self.render_time < self.HEADROOM * self.interval:
+            if self.interval > self.target_interval:
+                self.interval = max(self.target_interval, self.interval / 1.25)
+            elif self.resolution < self.target_resolution:
+                self.resolution = min(self.target_resolution, self.resolution * 3 // 2)
+        if (interval, resolution) == (self.interval, self.resolution):
+            return False
+        self._settling = self.SETTLE_FRAMES
+        frame_logger.debug(f'Drawing takes {self.render_time:.1f} ms: frame interval {interval:.0f} -> '
+                           f'{self.interval:.0f} ms, sphere resolution {resolution} -> {self.resolution}')
+        return True
+
+    def resume(self):
+        r"""Start timing afresh after a pause, which shouldn't count as dropped frames, on a restarted clock."""
+        self._previous_start = None
+
+    @property
+    def statistics(self) -> dict:
+        return {'frames': self.frames, 'late': self.late, 'dropped': self.dropped,
+                'render_time': self.render_time, 'interval': self.interval, 'resolution': self.resolution}
+
+
+class VibrationAnimation:
+    r"""
+    The motion of the atoms along a normal mode, held as NumPy arrays: the `equilibrium` positions and the
+    `displacements` at the peak of the oscillation, both (N, 3), with the mode `vector` scaled so that no atom moves
+    further than `peak_displacement`. frame() writes the positions at a phase of the oscillation into `positions`,
+    which is the buffer of the vtkPoints `points` itself, with two NumPy operations whatever the number of atoms.
+    """
+
+    def __init__(self, atoms: list[dict], vector: list[float], peak_displacement: float):
+        self.atomic_numbers = [atom['atomic_number'] for atom in atoms]
+        self.equilibrium = np.array([atom['xyz'] for atom in atoms], dtype=np.float64).reshape(-1, 3)
+        vector = np.asarray(vector, dtype=np.float64).reshape(-1, 3)
+        peak_norm = np.linalg.norm(vector, axis=1).max(initial=0.0)
+        self.displacements = vector * (peak_displacement / peak_norm) if peak_norm > 1e-8 else np.zeros_like(vector)
+        self.points = vtkPoints()
+        self.points.SetData(numpy_to_vtk(self.equilibrium, deep=True))
+        self.positions = vtk_to_numpy(self.points.GetData())
+
+    def frame(self, phase: float) -> np.ndarray:
+        np.multiply(self.displacements, math.sin(phase), out=self.positions)
+        self.positions += self.equilibrium
+        self.points.Modified()
+        return self.positions
+
+    def atoms(self) -> list[dict]:
+        r"""The current positions as a list of atoms, for what still needs one."""
+        return [{'atomic_number': atomic_number, 'xyz': tuple(xyz)}
+                for atomic_number, xyz in zip(self.atomic_numbers, self.positions.tolist())]
+
+
 class MoleculeWidget(StyledWidget):
+    # Carries the key of each isosurface contoured in the background over to the GUI thread.
+    isosurface_ready = pyqtSignal(object)
+
     def _on_theme_changed(self, theme_name):
         super()._on_theme_changed(theme_name)
         if self.follow_theme and theme_name in THEMES:
@@ -358,19 +809,47 @@ class MoleculeWidget(StyledWidget):
         # print('refresh_model', type(source))
         # print('self.model', type(self.model))
         self.scene.Remove(self.model.contour)
-        self.model = MolecularModel(source, )
+        self.model = MolecularModel(source, on_isosurface_ready=self.isosurface_ready.emit)
         self.scene.Add(self.model.contour)
+        self.precompute_contours()
+        self.scene.GetRenderWindow().GetInteractor().Render()
+
+    def refresh_contour(self, cube_data):
+        r"""Swap the grid behind the current model's isosurface, keeping its contour value, colours and opacity."""
+        self.model.contour.cube(cube_data)
+        self.precompute_contours()
         self.scene.GetRenderWindow().GetInteractor().Render()
 
+    def _on_isosurface_ready(self, key):
+        if hasattr(self.model, 'contour') and self.model.contour.show_isosurface(key):
+            self.scene.GetRenderWindow().GetInteractor().Render()
+
     def show_nucleus_labels(self, show: bool):
+        if show and self._nucleus_labels_stale:
+            # The nuclei moved while the labels were hidden; catch the labels up before they are drawn.
+            if self._hidden_label_atoms is not None:
+                self.nucleus_labels.update(self._hidden_label_atoms)
+            self.nucleus_labels.update_positions(self.model.geometry.positions)
+            self._hidden_label_atoms, self._nucleus_labels_stale = None, False
         self.nucleus_labels.SetVisibility(show)
         self.scene.GetRenderWindow().GetInteractor().Render()
 
     def update_geometry(self, atoms: list[dict]):
-        r"""Reposition the nuclei/bond actors (and, if shown, the atom-label actor) to a new set of atomic coordinates, without rebuilding the whole model. Used for vibrational-mode animation."""
+        r"""Reposition the nuclei/bond actors and, if shown, the atom-label actor to a new set of atomic coordinates, without rebuilding the whole model. Used for vibrational-mode animation."""
         self.model.geometry.update(atoms)
         if self.nucleus_labels.GetVisibility():
             self.nucleus_labels.update(atoms)
+        else:
+            self._hidden_label_atoms, self._nucleus_labels_stale = atoms, True
+        self.scene.GetRenderWindow().GetInteractor().Render()
+
+    def update_positions(self, animation: VibrationAnimation):
+        r"""update_geometry() to the current frame of `animation`, moving the actors straight from its arrays."""
+        self.model.geometry.update_positions(animation.positions)
+        if self.nucleus_labels.GetVisibility():
+            self.nucleus_labels.update_positions(animation.positions)
+        else:
+            self._nucleus_labels_stale = True
         self.scene.GetRenderWindow().GetInteractor().Render()
 
     def __init__(self, source, parent=None, axes: bool = False,
@@ -383,15 +862,21 @@ class MoleculeWidget(StyledWidget):
         layout = QVBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
         self.setLayout(layout)
+        settings.add_default('isosurface_precompute_neighbours', 2)
+        self.isosurface_ready.connect(self._on_isosurface_ready)
         self.scene = MoleculeScene(self)
+        self.scene.GetInteractorStyle().AddObserver('StartInteractionEvent', lambda *_: self.set_interacting(True))
+        self.scene.GetInteractorStyle().AddObserver('EndInteractionEvent', lambda *_: self.set_interacting(False))
         self.model = MolecularModel(source, contour_value=contour_value, contour_opacity=contour_opacity,
-                                    bond_colour=(0.8, 0.8, 0.8) if self.dark else (0.6, 0.6, 0.6))
+                                    bond_colour=(0.8, 0.8, 0.8) if self.dark else (0.6, 0.6, 0.6),
+                                    on_isosurface_ready=self.isosurface_ready.emit)
         self.scene.Add(self.model)
         if isinstance(source, Structure):
             source_ = source.atoms
         else:
             source_ = source
         self.nucleus_labels = NucleusLabelsActor(source_)
+        self._hidden_label_atoms, self._nucleus_labels_stale = None, False
         self.show_nucleus_labels(False)
         self.scene.Add(self.nucleus_labels)
         self.scene.SetBackground(*[c / 255.0 for c in self.background_colour])
@@ -428,6 +913,14 @@ class MoleculeWidget(StyledWidget):
     def contour_opacity(self):
         return self.model.contour.opacity
 
+    def set_interacting(self, interacting: bool):
+        r"""
+        Called as the camera starts and stops moving. The interactor style renders straight after both events, so
+        there is no need to render here.
+        """
+        if hasattr(self.model, 'contour'):
+            self.model.contour.set_interacting(interacting)
+
     def set_contour_opacity(self, value):
         self.model.set_contour_opacity(value * 0.01)
         settings['contour_opacity'] = self.model.contour.opacity
@@ -437,13 +930,32 @@ class MoleculeWidget(StyledWidget):
     def contour_value(self):
         return self.model.contour_value
 
+    def contour_slider_value(self, position: int) -> float:
+        r"""The contour value at `position` (0 to 100) on a contour slider, on a logarithmic scale."""
+        return self.contour_slider_minimum * math.exp(
+            position * 0.01 * math.log(self.contour_slider_maximum / self.contour_slider_minimum))
+
+    def nearby_contour_values(self, position: int) -> list[float]:
+        r"""
+        The contour values settings['isosurface_precompute_neighbours'] slider steps either side of `position`,
+        nearest first, for CubeActor to contour ahead of need.
+        """
+        neighbours = int(settings['isosurface_precompute_neighbours'])
+        return [self.contour_slider_value(p) for distance in range(1, neighbours + 1)
+                for p in (position + distance, position - distance) if 0 <= p <= 100]
+
     def set_contour_value(self, value):
-        contour_value = self.contour_slider_minimum * math.exp(
-            value * 0.01 * math.log(self.contour_slider_maximum / self.contour_slider_minimum))
-        self.model.set_contour_value(contour_value)
+        self.model.set_contour_value(self.contour_slider_value(value), self.nearby_contour_values(value))
         settings['contour_value'] = self.model.contour_value
         self.scene.GetRenderWindow().GetInteractor().Render()
 
+    def precompute_contours(self):
+        r"""Contour, in the background, the current grid at the slider steps around the current contour value."""
+        if hasattr(self.model, 'contour'):
+            position = round(100 * math.log(self.model.contour_value / self.contour_slider_minimum) / math.log(
+                self.contour_slider_maximum / self.contour_slider_minimum))
+            self.model.set_contour_value(self.model.contour_value, self.nearby_contour_values(position))
+
     def set_background_colour(self, colour: QColor | int | tuple[float, float, float], follow_theme: bool = False):
         # print('set_background_colour', colour,type(colour))
         if type(colour) is int:
@@ -552,10 +1064,19 @@ class ControlPanel(QWidget):
                                              self.parent.VIBRATION_SPEED_SLIDER_MINIMUM)))
             speed_slider.valueChanged.connect(self.parent.set_vibration_frequency_scaling)
             self.control_layout.add('Speed', speed_slider)
+
+            movie_button = QPushButton('Choose file')
+            self.control_layout.add('Export movie', movie_button)
+            movie_button.clicked.connect(lambda: self.parent.export_vibration_movie())
         if hasattr(self.parent, 'orbitals'):
             orbital_selector = QComboBox()
             for orbital in self.parent.orbitals[::-1]:
                 orbital_selector.addItem(str(orbital.ID))
+            if self.parent.densities:
+                orbital_selector.insertSeparator(orbital_selector.count())
+            for density in self.parent.densities:
+                orbital_selector.addItem(density.ID)
+            orbital_selector.setCurrentText(str(self.parent.orbital.ID))
             orbital_selector.currentTextChanged.connect(self.parent.set_orbital)
             # orbital_selector.setBackgroundColor(QColor(*self.background_colour))
             # palette = self.palette()
@@ -566,6 +1087,11 @@ class ControlPanel(QWidget):
             orbital_selector.setMinimumWidth(orbital_selector.minimumSizeHint().width())
             self.control_layout.add('Orbital', orbital_selector)
 
+            if self.parent.densities:
+                difference_button = QPushButton('Choose reference')
+                difference_button.clicked.connect(lambda: self.parent.choose_difference_reference())
+                self.control_layout.add('Difference density', difference_button)
+
             if hasattr(self.parent.orbital, 'occupation'):
                 row = self.control_layout.add('Occupation', QLabel(str(self.parent.orbital.occupation)))
                 self.occupation_widget = self.control_layout.itemAtPosition(row, 1).widget()
@@ -659,29 +1185,76 @@ class ControlPanel(QWidget):
         # self.control_layout.addStretch()
 
 
+def scene_renderer() -> vtkRenderer:
+    r"""A renderer lit as molecules are drawn, in a MoleculeScene or offscreen."""
+    renderer = vtkRenderer()
+    renderer.AutomaticLightCreationOff()
+    light_kit = vtkLightKit()
+    light_kit.AddLightsToRenderer(renderer)
+    light_kit.SetKeyLightWarmth(0.5)
+    light_kit.SetKeyLightIntensity(0.9)
+    # light_kit.SetKeyToFillRatio(2.0)
+    return renderer
+
+
+def add_to_renderer(renderer: vtkRenderer, source):
+    r"""Add the actor, 2D actor, or collection of them, `source`, to `renderer`."""
+    if isinstance(source, vtkActor2D):
+        renderer.AddViewProp(source)
+    elif isinstance(source, vtkActor):
+        renderer.AddActor(source)
+    elif isinstance(source, vtkActorCollection):
+        for actor in source:
+            add_to_renderer(renderer, actor)
+
+
+# The raster formats that export_image() writes, by file extension, as PIL names them. Both keep an alpha channel.
+RASTER_IMAGE_FORMATS = {'.png': 'PNG', '.tif': 'TIFF', '.tiff': 'TIFF'}
+
+
+def capture_image(window, magnification: int = 1, transparent: bool = False) -> np.ndarray:
+    r"""
+    What the render window `window` shows, drawn afresh at `magnification` times its size, as a (height, width, 3)
+    array of 8-bit RGB, top row first, or (height, width, 4) RGBA if `transparent`. Magnified images are drawn in
+    `magnification` by `magnification` tiles, each the size of the window, so they can be larger than the graphics
+    card could draw at once. For the background to be transparent, the window must have alpha bit planes, and the
+    renderers a background alpha of 0.
+    """
+    window.Render()
+    capture = vtkWindowToImageFilter()
+    capture.SetInput(window)
+    capture.SetScale(magnification)
+    if transparent:
+        capture.SetInputBufferTypeToRGBA()
+    else:
+        capture.SetInputBufferTypeToRGB()
+    capture.ReadFrontBufferOff()
+    capture.Update()
+    width, height, _ = capture.GetOutput().GetDimensions()
+    pixels = vtk_to_numpy(capture.GetOutput().GetPointData().GetScalars())
+    return pixels.reshape(height, width, -1)[::-1].copy()
+
+
+def write_image(pixels: np.ndarray, filename: str):
+    r"""Write `pixels`, as from capture_image(), to `filename`, as PNG or TIFF according to its extension."""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in RASTER_IMAGE_FORMATS:
+        raise ValueError(f'Cannot write {filename}: images can be written as {", ".join(RASTER_IMAGE_FORMATS)}')
+    PILImage.fromarray(pixels).save(filename, format=RASTER_IMAGE_FORMATS[extension])
+
+
 class MoleculeScene(QVTKRenderWindowInteractor):
 
     def __init__(self, parent=None):
         QVTKRenderWindowInteractor.__init__(self, parent)
-        self.renderer = vtkRenderer()
-        self.renderer.AutomaticLightCreationOff()
-        light_kit = vtkLightKit()
-        light_kit.AddLightsToRenderer(self.renderer)
-        light_kit.SetKeyLightWarmth(0.5)
-        light_kit.SetKeyLightIntensity(0.9)
-        # light_kit.SetKeyToFillRatio(2.0)
+        self.renderer = scene_renderer()
         self.GetRenderWindow().AddRenderer(self.renderer)
         self.SetInteractorStyle(vtkInteractorStyleTrackballCamera())
         self.Initialize()
+        settings.add_default('image_export_magnification', 4)
 
     def Add(self, source):
-        if isinstance(source, vtkActor2D):
-            self.renderer.AddActor2D(source)
-        elif isinstance(source, vtkActor):
-            self.renderer.AddActor(source)
-        elif isinstance(source, vtkActorCollection):
-            for actor in source:
-                self.Add(actor)
+        add_to_renderer(self.renderer, source)
 
     def Remove(self, source: vtkActor):
         self.renderer.RemoveActor(source)
@@ -695,13 +1268,26 @@ class MoleculeScene(QVTKRenderWindowInteractor):
         self.Start()
 
     def export_image(self, filename: str = None):
-        pdf_exporter = vtkGL2PSExporter()
-        pdf_exporter.SetRenderWindow(self.GetRenderWindow())
-        pdf_exporter.SetFileFormatToPDF()
+        r"""
+        Export the scene, to `filename` or one chosen in a dialog: as PNG or TIFF, by export_raster(), if that's its
+        extension, otherwise as PDF, `filename` being the name without the .pdf.
+        """
         if filename is None:
-            filename = os.path.splitext(QFileDialog.getSaveFileName(self, 'Export image', '', 'PDF (*.pdf)')[0])[0]
+            filename, chosen_filter = QFileDialog.getSaveFileName(self, 'Export image', '',
+                                                                  'PDF (*.pdf);;PNG (*.png);;TIFF (*.tif *.tiff)')
             if filename is None or filename == '':
                 return
+            extension = os.path.splitext(filename)[1].lower()
+            if extension == '.pdf' or (not extension and chosen_filter.startswith('PDF')):
+                filename = os.path.splitext(filename)[0]
+            elif not extension:
+                filename += '.png' if chosen_filter.startswith('PNG') else '.tif'
+        if os.path.splitext(filename)[1].lower() in RASTER_IMAGE_FORMATS:
+            self.export_raster(filename, int(settings['image_export_magnification']))
+            return
+        pdf_exporter = vtkGL2PSExporter()
+        pdf_exporter.SetRenderWindow(self.GetRenderWindow())
+        pdf_exporter.SetFileFormatToPDF()
         pdf_exporter.SetFilePrefix(filename)
         renderer = self.GetRenderWindow().GetRenderers().GetFirstRenderer()
         background_rgb = tuple(round(c * 255) for c in renderer.GetBackground())
@@ -720,6 +1306,24 @@ class MoleculeScene(QVTKRenderWindowInteractor):
         if os.path.isfile(pdf_path):
             _make_pdf_background_transparent(pdf_path, background_rgb)
 
+    def export_raster(self, filename: str, magnification: int = 1, transparent: bool = True):
+        r"""
+        Write the scene, as it's viewed, to the PNG or TIFF `filename`, at `magnification` times the size of the
+        window, with a transparent background if `transparent`. It's drawn in an OffscreenScene, which has the alpha
+        channel that the window may not have, and which keeps the tiles out of sight.
+        """
+        from .offscreen import OffscreenScene
+        window = self.GetRenderWindow()
+        scene = OffscreenScene(*window.GetSize(), background=self.renderer.GetBackground())
+        # the actors are drawn in the offscreen window's OpenGL context, then again in this one's
+        window.ReleaseGraphicsResources(window)
+        try:
+            scene.show_view(self.renderer)
+            scene.write_image(filename, magnification, transparent)
+        finally:
+            scene.close()
+            window.Render()
+
 
 def _make_pdf_background_transparent(pdf_path, background_rgb, tol=10):
     """Make a GL2PS-exported PDF's background transparent.
@@ -866,7 +1470,7 @@ class MolecularModel(vtkActorCollection):
                  bond_colour: tuple[float, float, float] = (1.0, 1.0, 1.0),
                  contour_value: float = .1,
                  contour_colours: list[tuple[float, float, float]] = [(1.0, 0.0, 0.0), (0.0, 0.0, 1.0)],
-                 contour_opacity: float = 0.7):
+                 contour_opacity: float = 0.7, on_isosurface_ready=None):
         """
 
         :param source:  Either a list of atoms represented as a dict with keys atomic_number, charge, xyz, the latter being a tuple of floats, or a CubeData object, or an xyz represented as a list of lines, or a string, or a path to an xyz file ending in .xyz.
@@ -875,6 +1479,7 @@ class MolecularModel(vtkActorCollection):
         :param contour_value:
         :param contour_colours:
         :param contour_opacity:
+        :param on_isosurface_ready: Passed on to CubeActor, to have contouring run in the background.
         """
         source_ = source
         if isinstance(source, str):
@@ -890,7 +1495,7 @@ class MolecularModel(vtkActorCollection):
             contour_value = settings['contour_value']
             contour_opacity = settings['contour_opacity']
             self.contour = CubeActor(source, contour_value=contour_value, colours=contour_colours,
-                                     opacity=contour_opacity)
+                                     opacity=contour_opacity, on_isosurface_ready=on_isosurface_ready)
             self.AddItem(self.contour)
 
     @property
@@ -912,8 +1517,53 @@ class MolecularModel(vtkActorCollection):
     def set_contour_opacity(self, opacity: float):
         self.contour.opacity = opacity
 
-    def set_contour_value(self, value: float):
-        self.contour.contour_value = value
+    def set_contour_value(self, value: float, nearby: list[float] = ()):
+        self.contour.request_contour_value(value, nearby)
+
+
+# The unit meshes that template_mesh() makes: a sphere of radius 1, and a cylinder of radius 1 and height 1 centred on
+# the origin with its axis along y (as vtkCylinderSource makes it) or along x.
+TEMPLATE_SHAPES = ('sphere', 'cylinder', 'cylinder_along_x')
+_template_meshes = {}
+_template_meshes_lock = threading.Lock()
+
+
+def _make_template_mesh(shape: str, resolution: int) -> vtkPolyData:
+    if shape == 'sphere':
+        source = vtkSphereSource(phi_resolution=resolution, theta_resolution=resolution)
+        source.SetRadius(1.0)
+    else:
+        source = vtkCylinderSource()
+        source.SetResolution(resolution)
+        source.SetRadius(1.0)
+        source.SetHeight(1.0)
+        if shape == 'cylinder_along_x':
+            along_x = vtkTransform()
+            along_x.RotateZ(-90.0)
+            cylinder = vtkTransformFilter()
+            cylinder.SetTransform(along_x)
+            cylinder.SetInputConnection(source.GetOutputPort())
+            source = cylinder
+    source.Update()
+    mesh = vtkPolyData()
+    mesh.ShallowCopy(source.GetOutput())
+    return mesh
+
+
+def template_mesh(shape: str, resolution: int) -> vtkPolyData:
+    r"""
+    The unit mesh of `shape` (one of TEMPLATE_SHAPES) at `resolution`, made once and then shared by every actor in
+    every window that draws scaled and placed copies of it, so that changing resolution swaps one mesh for another
+    rather than tessellating afresh, and so that VTK's per-window buffer cache can upload it to the GPU just once.
+    It must not be modified.
+    """
+    if shape not in TEMPLATE_SHAPES:
+        raise ValueError(f'unknown template shape {shape!r}; expected one of {TEMPLATE_SHAPES}')
+    key = (shape, int(resolution))
+    with _template_meshes_lock:
+        if key not in _template_meshes:
+            _template_meshes[key] = _make_template_mesh(*key)
+        return _template_meshes[key]
 
 
 class NucleiActor(vtkActor):
@@ -929,6 +1579,9 @@ class NucleiActor(vtkActor):
             return
         filtered_xyz = [atom['xyz'] for atom in source
                         if self.atomic_number is None or atom['atomic_number'] == self.atomic_number]
+        self.indices = np.array([i for i, atom in enumerate(source)
+                                 if self.atomic_number is None or atom['atomic_number'] == self.atomic_number],
+                                dtype=int)
         if hasattr(self, 'points') and self.points.GetNumberOfPoints() == len(filtered_xyz):
             # Same atom count for this element as before (the normal case during
             # vibrational-mode animation, where only positions change) -- move the
@@ -946,6 +1599,11 @@ class NucleiActor(vtkActor):
             self.glyph.SetInputData(polydata)
         self.glyph.Update()
 
+    def update_positions(self, xyz: np.ndarray):
+        r"""Move this element's points to their rows of the (N, 3) array `xyz` of all the atoms' positions."""
+        vtk_to_numpy(self.points.GetData())[:] = xyz[self.indices]
+        self.points.Modified()
+
     # Full resolution (~20000 triangles/sphere): used whenever not animating, including
     # for a static-structure image export, where quality matters and cost is paid once.
     STATIC_SPHERE_RESOLUTION = 100
@@ -959,13 +1617,12 @@ class NucleiActor(vtkActor):
         # element per frame at resolution 100, vs ~0.2-0.4ms at resolution 20). Kept
         # high here by default; set_sphere_resolution() below drops it while animating
         # and restores it afterwards (see MoleculeDisplay._start/_stop_vibration_animation).
-        self.sphere_source = vtkSphereSource(phi_resolution=self.STATIC_SPHERE_RESOLUTION,
-                                             theta_resolution=self.STATIC_SPHERE_RESOLUTION)
-        self.sphere_source.SetRadius(0.2)
-        if self.atomic_number is not None:
-            self.sphere_source.SetRadius(self.radius_scale * angstrom * covalent_radii[self.atomic_number])
+        # The unit sphere is the shared template_mesh(), scaled here to the nucleus.
         self.glyph = vtkGlyph3D()
-        self.glyph.SetSourceConnection(self.sphere_source.GetOutputPort())
+        self.glyph.SetScaleModeToDataScalingOff()
+        self.glyph.SetScaleFactor(0.2 if self.atomic_number is None else
+                                  self.radius_scale * angstrom * covalent_radii[self.atomic_number])
+        self.set_sphere_resolution(self.STATIC_SPHERE_RESOLUTION)
         mapper = vtkPolyDataMapper()
         self.update_data(source)
         mapper.SetInputConnection(self.glyph.GetOutputPort())
@@ -976,21 +1633,100 @@ class NucleiActor(vtkActor):
         self.SetOrigin(0.0, 0.0, 0.0)
 
     def set_sphere_resolution(self, resolution: int):
-        self.sphere_source.SetPhiResolution(resolution)
-        self.sphere_source.SetThetaResolution(resolution)
+        self.glyph.SetSourceData(template_mesh('sphere', resolution))
+
+
+class NucleiGlyphActor(vtkActor):
+    r"""
+    All the nuclei as a single actor. A vtkGlyph3DMapper draws one sphere per nucleus as an instance of a single unit
+    sphere, on the GPU, scaled by a per-point 'radius' array (the scaled covalent radius) and coloured by a per-point
+    'colour' array (the CPK colour), so that a molecule of any number of elements is one draw call, and moving the
+    nuclei only changes the positions of the points, with no glyph mesh to regenerate.
+    """
+
+    STATIC_SPHERE_RESOLUTION = 100
+
+    def __init__(self, source: list[dict] | CubeData, radius_scale=.5):
+        vtkActor.__init__(self)
+        self.radius_scale = radius_scale
+        self.atomic_numbers = None
+        mapper = vtkGlyph3DMapper()
+        mapper.SetSourceData(template_mesh('sphere', self.STATIC_SPHERE_RESOLUTION))
+        mapper.SetScaleArray('radius')
+        mapper.SetScaleModeToScaleByMagnitude()
+        mapper.SetScaleFactor(1.0)
+        mapper.SetScalarModeToUsePointFieldData()
+        mapper.SelectColorArray('colour')
+        mapper.SetColorModeToDirectScalars()
+        self.SetMapper(mapper)
+        self.update_data(source)
+        self.SetOrigin(0.0, 0.0, 0.0)
+
+    def update_data(self, source: list[dict] | CubeData):
+        if isinstance(source, CubeData):
+            self.update_data(source.atoms)
+            return
+        xyz = np.array([atom['xyz'] for atom in source], dtype=np.float64).reshape(-1, 3)
+        atomic_numbers = [int(atom['atomic_number']) for atom in source]
+        if atomic_numbers == self.atomic_numbers:
+            # only the positions have changed, as in vibrational-mode animation
+            vtk_to_numpy(self.points.GetData())[:] = xyz
+            self.points.Modified()
+            return
+        self.atomic_numbers = atomic_numbers
+        angstrom = 1.8897161646321
+        self.points = vtkPoints()
+        self.points.SetData(numpy_to_vtk(xyz, deep=True))
+        radii = numpy_to_vtk(self.radius_scale * angstrom * covalent_radii[atomic_numbers], deep=True,
+                             array_type=VTK_FLOAT)
+        radii.SetName('radius')
+        colours = numpy_to_vtk(np.round(255 * colors.cpk_colors[atomic_numbers]).astype(np.uint8).reshape(-1, 3),
+                               deep=True)
+        colours.SetName('colour')
+        self.polydata = vtkPolyData()
+        self.polydata.SetPoints(self.points)
+        self.polydata.GetPointData().AddArray(radii)
+        self.polydata.GetPointData().AddArray(colours)
+        self.GetMapper().SetInputData(self.polydata)
+
+    def share_points(self, points: vtkPoints):
+        r"""Draw the nuclei at `points`, one per atom, so that whatever writes to them moves the nuclei."""
+        self.points = points
+        self.polydata.SetPoints(points)
+
+    def update_positions(self, xyz: np.ndarray):
+        positions = vtk_to_numpy(self.points.GetData())
+        if not np.may_share_memory(positions, xyz):
+            positions[:] = xyz
+        self.points.Modified()
+
+    def set_sphere_resolution(self, resolution: int):
+        self.GetMapper().SetSourceData(template_mesh('sphere', resolution))
 
 
 class NucleusLabelsActor(vtkActor2D):
+    r"""
+    A label, of element symbol and number, on each nucleus. The labels and the pipeline placing them are built by
+    set_source() once for a set of atoms; update() with the same elements in the same order, as in an animation,
+    then only moves the points they are attached to.
+    """
+
     def __init__(self, source: list[dict] | CubeData, radius_scale=.5, bond_radius=.1):
         vtkActor2D.__init__(self)
         self.radius_scale = radius_scale
+        self.atomic_numbers = None
         self.set_source(source)
 
     def set_source(self, source: list[dict] | CubeData):
         if isinstance(source, CubeData):
             self.set_source(source.atoms)
             return
-        polydata = atoms_to_polydata(source)
+        self.atomic_numbers = [atom['atomic_number'] for atom in source]
+        self.points = vtkPoints()
+        self.points.SetData(numpy_to_vtk(
+            np.array([atom['xyz'] for atom in source], dtype=np.float64).reshape(-1, 3), deep=True))
+        polydata = self.polydata = vtkPolyData()
+        polydata.SetPoints(self.points)
         labels = vtkStringArray(name='labels')
         labels.SetNumberOfValues(len(source))
         for i, atom in enumerate(source):
@@ -1030,7 +1766,24 @@ class NucleusLabelsActor(vtkActor2D):
         self.SetMapper(mapper)
 
     def update(self, source: list[dict] | CubeData):
-        self.set_source(source)
+        if isinstance(source, CubeData):
+            self.update(source.atoms)
+            return
+        if [atom['atomic_number'] for atom in source] != self.atomic_numbers:
+            self.set_source(source)
+            return
+        self.update_positions(np.array([atom['xyz'] for atom in source], dtype=np.float64).reshape(-1, 3))
+
+    def share_points(self, points: vtkPoints):
+        r"""Attach the labels to `points`, one per atom, so that whatever writes to them moves the labels."""
+        self.points = points
+        self.polydata.SetPoints(points)
+
+    def update_positions(self, xyz: np.ndarray):
+        positions = vtk_to_numpy(self.points.GetData())
+        if not np.may_share_memory(positions, xyz):
+            positions[:] = xyz
+        self.points.Modified()
 
 
 def atoms_to_polydata(atoms: list[dict], atomic_number=None) -> vtkPolyData:
@@ -1044,8 +1797,24 @@ def atoms_to_polydata(atoms: list[dict], atomic_number=None) -> vtkPolyData:
     return polydata
 
 
+# How BondActorCollection draws the bonds, selected by settings['bond_rendering']:
+#   'per_bond'   a BondActor, with its own cylinder and transform, for each bond
+#   'instanced'  a single BondGlyphActor, drawing every bond as an instance of one cylinder
+BOND_RENDERING_MODES = ('per_bond', 'instanced')
+
+
 class BondActorCollection(vtkActorCollection):
-    def __init__(self, source: list[dict] | CubeData, bond_radius=.3, bond_colour=(1.0, 1.0, 1.0)):
+    def __init__(self, source: list[dict] | CubeData, bond_radius=.3, bond_colour=(1.0, 1.0, 1.0),
+                 bond_rendering: str = None):
+        r"""
+        :param bond_rendering: One of BOND_RENDERING_MODES; by default, settings['bond_rendering'].
+        """
+        settings.add_default('bond_rendering', 'per_bond')
+        if bond_rendering is None:
+            bond_rendering = str(settings['bond_rendering'])
+        if bond_rendering not in BOND_RENDERING_MODES:
+            raise ValueError(f'unknown bond rendering {bond_rendering!r}; expected one of {BOND_RENDERING_MODES}')
+        self.bond_rendering = bond_rendering
         self.bond_colour = bond_colour
         self.bond_radius = bond_radius
         self.set_source(source)
@@ -1059,45 +1828,151 @@ class BondActorCollection(vtkActorCollection):
         # -- eg an animation frame -- while keeping the connectivity computed here.
         self.bonds = []
         self.atoms = source
-        angstrom = 1.8897161646321
-        for i, iatom in enumerate(self.atoms):
-            for j, jatom in enumerate(self.atoms[:i]):
-                distance = np.linalg.norm(np.array(iatom['xyz']) - np.array(jatom['xyz']))
-                if 0.9 * distance / angstrom < covalent_radii[iatom['atomic_number']] + covalent_radii[
-                    jatom['atomic_number']]:
-                    actor = BondActor(iatom['xyz'], jatom['xyz'], radius=self.bond_radius, colour=self.bond_colour)
-                    self.AddItem(actor)
-                    self.bonds.append((i, j, actor))
+        pairs = perceive_bonds(self.atoms)
+        self.pairs = np.array(pairs, dtype=int).reshape(-1, 2)
+        if self.bond_rendering == 'instanced':
+            self.bond_glyphs = BondGlyphActor(self.atoms, pairs, radius=self.bond_radius, colour=self.bond_colour)
+            self.AddItem(self.bond_glyphs)
+            self.bonds = [(i, j, self.bond_glyphs) for i, j in pairs]
+            return
+        for i, j in pairs:
+            actor = BondActor(self.atoms[i]['xyz'], self.atoms[j]['xyz'], radius=self.bond_radius,
+                              colour=self.bond_colour)
+            self.AddItem(actor)
+            self.bonds.append((i, j, actor))
 
     def update(self, source: list[dict] | CubeData):
         if isinstance(source, CubeData):
             self.update(source.atoms)
             return
         self.atoms = source
+        if self.bond_rendering == 'instanced':
+            self.bond_glyphs.update(source)
+            return
         for i, j, actor in self.bonds:
             actor.update(source[i]['xyz'], source[j]['xyz'])
 
+    def update_positions(self, xyz: np.ndarray):
+        r"""update() for new positions `xyz`, an (N, 3) array, of the same atoms."""
+        if self.bond_rendering == 'instanced':
+            self.bond_glyphs.update_positions(xyz)
+            return
+        matrices = bond_matrices(xyz[self.pairs[:, 0]], xyz[self.pairs[:, 1]], self.bond_radius)
+        for (i, j, actor), matrix in zip(self.bonds, matrices.reshape(-1, 16).tolist()):
+            actor.user_transform.SetMatrix(matrix)
+
 
 class CubeActor(vtkActor):
+    r"""
+    The positive and negative isosurfaces of a grid. Surfaces are kept, per grid and contour value, in an
+    in-memory cache bounded by settings['isosurface_cache_megabytes']. If the actor is given `on_isosurface_ready`,
+    request_contour_value() contours in the background through an IsosurfaceBuilder, which calls it (on the worker
+    thread) with the key of each surface finished; the owner is then expected to call show_isosurface() with that
+    key on the GUI thread. Settings are only read on the GUI thread, as each contour value is asked for: the
+    settings file may be half-written by the GUI thread whenever a worker would read it.
+    Each surface comes with a level of detail of about settings['isosurface_interactive_triangles'] triangles
+    (0 for no limit), smoothed by settings['isosurface_interactive_smoothing'] iterations, that is drawn instead
+    while set_interacting() says the camera is moving. The full surface is drawn as soon as it is contoured; its
+    level of detail is made afterwards on the contouring worker, if there is one, or else when the camera first
+    moves.
+    """
+
     def __init__(self, cube_data: CubeData, contour_value: float = .05,
-                 colours: list[tuple[float, float, float]] = [(1.0, 0.0, 0.0), (0.0, 0.0, 1.0)], opacity: float = 0.7):
+                 colours: list[tuple[float, float, float]] = [(1.0, 0.0, 0.0), (0.0, 0.0, 1.0)], opacity: float = 0.7,
+                 on_isosurface_ready=None):
+        settings.add_default('isosurface_cache_megabytes', 256)
+        settings.add_default('isosurface_engine', 'contour')
+        settings.add_default('isosurface_threads', 0)
+        settings.add_default('isosurface_interactive_triangles', 200000)
+        settings.add_default('isosurface_interactive_smoothing', 0)
         vtkActor.__init__(self)
         self.SetMapper(vtkPolyDataMapper())
         self._contour_value = contour_value
+        self.interacting = False
+        self.isosurface = None
+        self.isosurfaces = CubeCache(self.isosurface_cache_bytes())
+        self.isosurface_builder = IsosurfaceBuilder(self.isosurfaces, on_ready=on_isosurface_ready) \
+            if on_isosurface_ready is not None else None
         self.cube(cube_data)
         self.colours = colours
         self.opacity = opacity
 
     def cube(self, cube_data: CubeData):
-        self.contour_filter = vtkContourFilter()
-        self.contour_filter.SetInputData(create_vtk_image_data(cube_data))
+        if self.isosurface_builder is not None:
+            self.isosurface_builder.cancel()
+        self.isosurfaces.clear()
+        self.grid = prepare_grid(create_vtk_image_data(cube_data))
+        self.grid_identity = next(grid_identities)
         self.update_contour_value()
         self.SetOrigin(0.0, 0.0, 0.0)
 
     def update_contour_value(self):
-        self.contour_filter.GenerateValues(2, [-self.contour_value, self.contour_value])
-        self.contour_filter.Update()
-        self.GetMapper().SetInputConnection(self.contour_filter.GetOutputPort())
+        key = self.grid_identity, self.contour_value
+        surface = self.isosurfaces.get(key)
+        if surface is None:
+            surface = isosurface(self.grid, self.contour_value, self.isosurface_engine(), *self.isosurface_detail())
+            self.isosurfaces.put(key, surface, surface.nbytes)
+            if self.isosurface_builder is not None:
+                self.isosurface_builder.make_interactive(surface)
+        self.show_surface(surface)
+
+    @staticmethod
+    def isosurface_cache_bytes() -> int:
+        return int(float(settings['isosurface_cache_megabytes']) * 1e6)
+
+    @staticmethod
+    def isosurface_engine() -> str:
+        r"""
+        The isosurface engine to contour with, from settings; see iMolpro.isosurface. For flying_edges_smp,
+        vtkSMPTools is first switched to the thread count of the settings, if it has changed.
+        """
+        engine = str(settings['isosurface_engine'])
+        if engine == 'flying_edges_smp':
+            use_smp_threads(int(settings['isosurface_threads']))
+        return engine
+
+    @staticmethod
+    def isosurface_detail() -> tuple[int, int]:
+        r"""The triangle target and smoothing iterations for the interactive level of detail, from settings."""
+        return int(settings['isosurface_interactive_triangles']), int(settings['isosurface_interactive_smoothing'])
+
+    def show_surface(self, surface):
+        r"""Draw the Isosurface `surface`, in whichever level of detail suits the camera at present."""
+        self.isosurface = surface
+        self.GetMapper().SetInputData(surface.interactive if self.interacting else surface.surface)
+
+    def set_interacting(self, interacting: bool):
+        r"""Switch to the lighter mesh while the camera is being moved (`interacting`) and back to the full one."""
+        self.interacting = interacting
+        if self.isosurface is not None:
+            self.show_surface(self.isosurface)
+
+    def request_contour_value(self, value: float, nearby: list[float] = ()):
+        r"""
+        Switch to contour value `value`, straight away if its surfaces are cached, otherwise once the background
+        contouring delivers them, the current surfaces staying on show until then. The surfaces for the values
+        `nearby` are then also contoured in the background, ready for small moves of a slider.
+        """
+        self._contour_value = value
+        self.isosurfaces.set_budget(self.isosurface_cache_bytes())
+        if self.isosurface_builder is None:
+            self.update_contour_value()
+            return
+        surface = self.isosurfaces.get((self.grid_identity, value))
+        if surface is not None:
+            self.show_surface(surface)
+        self.isosurface_builder.schedule(self.grid, self.grid_identity, [value] + list(nearby),
+                                         engine=self.isosurface_engine(), detail=self.isosurface_detail())
+
+    def show_isosurface(self, key) -> bool:
+        r"""Show the surface stored under `key` if it is the one now wanted, returning whether it was."""
+        if key != (self.grid_identity, self.contour_value):
+            return False
+        surface = self.isosurfaces.peek(key)
+        if surface is None:
+            return False
+        self.show_surface(surface)
+        return True
 
     @property
     def opacity(self, value: float = None):
@@ -1141,58 +2016,151 @@ class CubeActor(vtkActor):
         self.GetMapper().SetLookupTable(color_tf)
 
 
-def create_vtk_image_data(cube_data: CubeData) -> vtkImageData:
-    vtk_image_data = vtkImageData()
-    vtk_image_data.SetDimensions(*cube_data.dimensions)
-    if np.any(cube_data.cells != np.diagflat(np.diagonal(cube_data.cells))):
-        raise ValueError('Rotated or non-orthogonal cells not yet supported')
-    vtk_image_data.SetSpacing(*np.diagonal(cube_data.cells))
-    vtk_image_data.SetOrigin(*cube_data.origin)
-    scalars = vtkFloatArray()
+def create_vtk_image_data(cube_data: CubeData) -> vtkImageData | vtkStructuredGrid:
+    r"""
+    The grid of `cube_data` as a VTK dataset: a vtkImageData if its cell vectors lie along the axes, otherwise a
+    vtkStructuredGrid carrying the position of every point.
+    """
+    cells = np.asarray(cube_data.cells, dtype=np.float64)
+    if np.any(cells != np.diagflat(np.diagonal(cells))):
+        vtk_image_data = vtkStructuredGrid()
+        vtk_image_data.SetDimensions(*cube_data.dimensions)
+        # Point (i, j, k) sits at origin + i a + j b + k c for the cell vectors a, b, c (the rows of cells).
+        # Summed by broadcasting over a (nz, ny, nx, 3) array, the points come out x-fastest, the order
+        # vtkStructuredGrid numbers them in, so VTK uses the array in place just as it does the scalars.
+        nx, ny, nz = cube_data.dimensions
+        points = (np.asarray(cube_data.origin, dtype=np.float64)
+                  + np.arange(nx)[np.newaxis, np.newaxis, :, np.newaxis] * cells[0]
+                  + np.arange(ny)[np.newaxis, :, np.newaxis, np.newaxis] * cells[1]
+                  + np.arange(nz)[:, np.newaxis, np.newaxis, np.newaxis] * cells[2])
+        vtk_points = vtkPoints()
+        vtk_points.SetData(numpy_to_vtk(points.reshape(-1, 3), deep=False))
+        vtk_image_data.SetPoints(vtk_points)
+    else:
+        vtk_image_data = vtkImageData()
+        vtk_image_data.SetDimensions(*cube_data.dimensions)
+        vtk_image_data.SetSpacing(*np.diagonal(cells))
+        vtk_image_data.SetOrigin(*cube_data.origin)
+    # vtkImageData stores its points x-fastest, which is exactly the memory order of a Fortran-ordered
+    # (nx, ny, nz) array, so VTK can use a float32 copy of the grid in place rather than having every
+    # value pushed into a vtkFloatArray one SetValue() call at a time. numpy_to_vtk() attaches the
+    # NumPy array to the VTK array's buffer, keeping it alive for as long as the vtkImageData uses it.
+    data = np.asfortranarray(cube_data.data, dtype=np.float32)
+    scalars = numpy_to_vtk(data.ravel(order='F'), deep=False, array_type=VTK_FLOAT)
     scalars.SetName(cube_data.title[0])
-    data = np.asfortranarray(cube_data.data)
-    scalars.SetNumberOfValues(cube_data.data.size)
-    i = 0
-    for iz in range(cube_data.dimensions[2]):
-        for iy in range(cube_data.dimensions[1]):
-            for ix in range(cube_data.dimensions[0]):
-                scalars.SetValue(i, data[ix, iy, iz])
-                i += 1
-
-    # for i, val in enumerate(data.flatten()):
-    #     scalars.SetValue(i, val)
     vtk_image_data.GetPointData().SetScalars(scalars)
     return vtk_image_data
 
 
+# How GeometryActorCollection draws the nuclei, selected by settings['nuclei_rendering']:
+#   'per_element'  a NucleiActor, with its own sphere mesh built by vtkGlyph3D, for each element present
+#   'instanced'    a single NucleiGlyphActor, drawing every nucleus as an instance of one sphere
+NUCLEI_RENDERING_MODES = ('per_element', 'instanced')
+
+
 class GeometryActorCollection(vtkActorCollection):
     def __init__(self, source: dict | CubeData, atomic_number=None, radius_scale=.5, bond_radius=.1,
-                 bond_colour=(1.0, 1.0, 1.0)):
+                 bond_colour=(1.0, 1.0, 1.0), nuclei_rendering: str = None):
+        r"""
+        :param nuclei_rendering: One of NUCLEI_RENDERING_MODES; by default, settings['nuclei_rendering'].
+        """
         geom = source.atoms if isinstance(source, CubeData) else source
         assert isinstance(geom, list)
         vtkActorCollection.__init__(self)
-        for atomic_number in {d['atomic_number'] for d in geom}:
-            self.AddItem(NucleiActor(source, atomic_number=atomic_number, radius_scale=radius_scale))
+        settings.add_default('nuclei_rendering', 'per_element')
+        if nuclei_rendering is None:
+            nuclei_rendering = str(settings['nuclei_rendering'])
+        if nuclei_rendering not in NUCLEI_RENDERING_MODES:
+            raise ValueError(f'unknown nuclei rendering {nuclei_rendering!r}; expected one of {NUCLEI_RENDERING_MODES}')
+        if nuclei_rendering == 'instanced':
+            self.nuclei = [NucleiGlyphActor(source, radius_scale=radius_scale)]
+        else:
+            self.nuclei = [NucleiActor(source, atomic_number=atomic_number, radius_scale=radius_scale)
+                           for atomic_number in {d['atomic_number'] for d in geom}]
+        for actor in self.nuclei:
+            self.AddItem(actor)
         self.bond_actor_collection = BondActorCollection(source, bond_radius=bond_radius, bond_colour=bond_colour)
         for actor in self.bond_actor_collection:
             self.AddItem(actor)
+        # Moving per-element nuclei and per-bond cylinders takes Python work for each element and each bond, so
+        # instanced stand-ins for them, hidden until set_animating(), are drawn instead while animating.
+        self.nuclei_stand_in = self.bond_stand_in = None
+        if nuclei_rendering != 'instanced':
+            self.nuclei_stand_in = NucleiGlyphActor(source, radius_scale=radius_scale)
+        if self.bond_actor_collection.bond_rendering != 'instanced':
+            self.bond_stand_in = BondGlyphActor(self.bond_actor_collection.atoms,
+                                                self.bond_actor_collection.pairs.tolist(), radius=bond_radius,
+                                                colour=bond_colour)
+        for actor in (self.nuclei_stand_in, self.bond_stand_in):
+            if actor is not None:
+                actor.VisibilityOff()
+                self.AddItem(actor)
+        self.animating = False
+        self.positions = np.array([atom['xyz'] for atom in geom], dtype=np.float64).reshape(-1, 3)
+        self.shared_points = None
         if False:
             geom2 = [d for d in geom]
             for d in geom2:
                 d['xyz'] = [d['xyz'][i] * 1.5 for i in range(3)]
             self.update(geom2)
 
+    def _drawn(self) -> tuple:
+        r"""The nuclei actors, and the bond actor or actors, being drawn: the stand-ins, if any, while animating."""
+        if not self.animating:
+            return self.nuclei, self.bond_actor_collection
+        return ([self.nuclei_stand_in] if self.nuclei_stand_in is not None else self.nuclei,
+                self.bond_stand_in if self.bond_stand_in is not None else self.bond_actor_collection)
+
     def update(self, source: dict | CubeData):
+        r"""Move the actors being drawn to the atoms of `source`; hidden ones are moved when they are shown."""
         geom = source.atoms if isinstance(source, CubeData) else source
+        nuclei, bonds = self._drawn()
+        for item in nuclei:
+            item.update_data(geom)
+        bonds.update(geom)
+        self.positions = np.array([atom['xyz'] for atom in geom], dtype=np.float64).reshape(-1, 3)
+
+    def share_points(self, points: vtkPoints):
+        r"""
+        Have the actors that can draw straight from `points`, a vtkPoints of every atom's position, do so, so that
+        update_positions() with its buffer has nothing to copy for them.
+        """
+        self.shared_points = points
         for item in self:
-            if isinstance(item, NucleiActor):
-                item.update_data(geom)
-        if hasattr(self, 'bond_actor_collection'):
-            self.bond_actor_collection.update(geom)
+            if isinstance(item, NucleiGlyphActor):
+                item.share_points(points)
+
+    def update_positions(self, xyz: np.ndarray):
+        r"""
+        update() for new positions `xyz`, an (N, 3) array, of the same atoms: each actor moves with array
+        operations, so the Python work does not grow with the number of atoms. It does grow with the number of
+        elements and bonds for the per-element and per-bond modes, unless set_animating() has swapped in their
+        instanced stand-ins, which, like the instanced modes, move in a fixed number of steps.
+        """
+        nuclei, bonds = self._drawn()
+        for item in nuclei:
+            item.update_positions(xyz)
+        bonds.update_positions(xyz)
+        self.positions = xyz
+
+    def set_animating(self, animating: bool):
+        r"""
+        Draw the nuclei and bonds with instanced actors while `animating`, whichever rendering modes were chosen, so
+        that update_positions() does the same Python work per frame for any size of molecule; the actors of the
+        chosen modes are shown again, at the positions last given, when animation stops.
+        """
+        self.animating = animating
+        nuclei, bonds = self._drawn()
+        for item in nuclei:
+            item.update_positions(self.positions)
+        bonds.update_positions(self.positions)
+        drawn = {id(actor) for actor in nuclei + ([bonds] if isinstance(bonds, BondGlyphActor) else list(bonds))}
+        for item in self:
+            item.SetVisibility(id(item) in drawn)
 
     def set_sphere_resolution(self, resolution: int):
         for item in self:
-            if isinstance(item, NucleiActor):
+            if isinstance(item, (NucleiActor, NucleiGlyphActor)):
                 item.set_sphere_resolution(resolution)
 
 
@@ -1203,20 +2171,16 @@ class BondActor(vtkActor):
         self.GetProperty().SetColor(colour)
         self.radius = radius
         self.resolution = resolution
-        # A single unit cylinder (radius 1, height 1) is built once and reused for the
-        # actor's lifetime; update() repositions/resizes it purely via the actor's own
-        # vtkUserTransform, never touching the mesh. This matters for vibrational-mode
-        # animation, where update() runs every frame: the previous approach rebuilt the
-        # cylinder source, transform filter and mapper from scratch each call, forcing a
-        # full geometry re-upload to the GPU per bond per frame -- the dominant cause of
-        # animation jank. Moving the per-frame work to a small transform matrix update
-        # instead is orders of magnitude cheaper.
-        cylinder_source = vtkCylinderSource()
-        cylinder_source.SetResolution(resolution)
-        cylinder_source.SetRadius(1.0)
-        cylinder_source.SetHeight(1.0)
+        # A single unit cylinder (radius 1, height 1) -- the template_mesh() that every bond
+        # shares -- is drawn for the actor's lifetime; update() repositions/resizes it purely
+        # via the actor's own vtkUserTransform, never touching the mesh. This matters for
+        # vibrational-mode animation, where update() runs every frame: the previous approach
+        # rebuilt the cylinder source, transform filter and mapper from scratch each call,
+        # forcing a full geometry re-upload to the GPU per bond per frame -- the dominant
+        # cause of animation jank. Moving the per-frame work to a small transform matrix
+        # update instead is orders of magnitude cheaper.
         mapper = vtkPolyDataMapper()
-        mapper.SetInputConnection(cylinder_source.GetOutputPort())
+        mapper.SetInputData(template_mesh('cylinder', resolution))
         self.SetMapper(mapper)
         self.user_transform = vtkTransform()
         self.SetUserTransform(self.user_transform)
@@ -1226,6 +2190,54 @@ class BondActor(vtkActor):
         set_bond_transform(self.user_transform, startPoint, endPoint, radius=self.radius)
 
 
+class BondGlyphActor(vtkActor):
+    r"""
+    All the bonds as a single actor. A vtkGlyph3DMapper draws one instance of a unit cylinder per bond, placed at the
+    bond's midpoint, pointed along a per-point 'direction' array and stretched by a per-point 'scale' array to the
+    bond's length and radius. update() recomputes all of those for new atom positions in one NumPy pass, writing
+    straight into the arrays VTK draws from.
+    """
+
+    def __init__(self, atoms: list[dict], bonds: list[tuple[int, int]], radius: float = 1.0,
+                 resolution: int = 30, colour=(1.0, 1.0, 1.0)):
+        vtkActor.__init__(self)
+        self.GetProperty().SetColor(colour)
+        self.radius = radius
+        self.bonds = np.array(bonds, dtype=int).reshape(-1, 2)
+        # vtkGlyph3DMapper points a glyph's x axis along the orientation array
+        mapper = vtkGlyph3DMapper()
+        mapper.SetSourceData(template_mesh('cylinder_along_x', resolution))
+        mapper.SetOrientationArray('direction')
+        mapper.SetOrientationModeToDirection()
+        mapper.SetScaleArray('scale')
+        mapper.SetScaleModeToScaleByVectorComponents()
+        mapper.ScalarVisibilityOff()
+        self.SetMapper(mapper)
+        self.points = vtkPoints()
+        self.points.SetData(numpy_to_vtk(np.zeros((len(self.bonds), 3)), deep=True))
+        self.directions = numpy_to_vtk(np.zeros((len(self.bonds), 3)), deep=True)
+        self.directions.SetName('direction')
+        self.scales = numpy_to_vtk(np.full((len(self.bonds), 3), float(radius)), deep=True)
+        self.scales.SetName('scale')
+        polydata = vtkPolyData()
+        polydata.SetPoints(self.points)
+        polydata.GetPointData().AddArray(self.directions)
+        polydata.GetPointData().AddArray(self.scales)
+        mapper.SetInputData(polydata)
+        self.update(atoms)
+
+    def update(self, atoms: list[dict]):
+        self.update_positions(np.array([atom['xyz'] for atom in atoms], dtype=np.float64).reshape(-1, 3))
+
+    def update_positions(self, xyz: np.ndarray):
+        start, end = xyz[self.bonds[:, 0]], xyz[self.bonds[:, 1]]
+        vtk_to_numpy(self.points.GetData())[:] = 0.5 * (start + end)
+        vtk_to_numpy(self.directions)[:] = end - start
+        vtk_to_numpy(self.scales)[:, 0] = np.linalg.norm(end - start, axis=1)
+        for array in (self.points, self.directions, self.scales):
+            array.Modified()
+
+
 def set_bond_transform(transform: vtkTransform, startPoint: list[int], endPoint: list[int], radius: float = 1.0):
     """
     Set `transform` (mutated in place) to place a unit cylinder (radius 1, height 1,
@@ -1275,6 +2287,41 @@ def set_bond_transform(transform: vtkTransform, startPoint: list[int], endPoint:
     transform.Translate(0, .5, 0)  # translate to start of cylinder
 
 
+def _bond_transform_arbitrary_vector() -> np.ndarray:
+    rng = vtkMinimalStandardRandomSequence()
+    rng.SetSeed(8775070)
+    arbitrary = []
+    for i in range(0, 3):
+        rng.Next()
+        arbitrary.append(rng.GetRangeValue(-10, 10))
+    return np.array(arbitrary)
+
+
+BOND_TRANSFORM_ARBITRARY_VECTOR = _bond_transform_arbitrary_vector()
+
+
+def bond_matrices(start: np.ndarray, end: np.ndarray, radius: float = 1.0) -> np.ndarray:
+    r"""
+    The matrices of set_bond_transform() for bonds from each row of `start` to the same row of `end`, both (M, 3),
+    computed together as an (M, 4, 4) array.
+    """
+    x = end - start
+    length = np.linalg.norm(x, axis=1, keepdims=True)
+    x = np.divide(x, length, out=np.zeros_like(x), where=length > 0)
+    z = np.cross(x, BOND_TRANSFORM_ARBITRARY_VECTOR)
+    z_norm = np.linalg.norm(z, axis=1, keepdims=True)
+    z = np.divide(z, z_norm, out=np.zeros_like(z), where=z_norm > 0)
+    y = np.cross(z, x)
+    matrices = np.zeros((len(x), 4, 4))
+    # the unit cylinder's y axis, scaled to the bond, runs along x; it is centred on the bond's midpoint
+    matrices[:, :3, 0] = -radius * y
+    matrices[:, :3, 1] = length * x
+    matrices[:, :3, 2] = radius * z
+    matrices[:, :3, 3] = 0.5 * (start + end)
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+
 def xyz_to_atoms(xyz: str | list[str]):
     angstrom = 1.8897161646321
     if isinstance(xyz, str) and xyz.endswith('.xyz'):
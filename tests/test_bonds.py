@@ -0,0 +1,33 @@
+import numpy as np
+from ase.data import covalent_radii
+
+from iMolpro.bonds import bonded_pairs, perceive_bonds, ANGSTROM
+
+
+def all_pairs(xyz, atomic_numbers):
+    r"""The nested loop over every pair that bonded_pairs() replaced."""
+    pairs = []
+    for i in range(len(xyz)):
+        for j in range(i):
+            distance = np.linalg.norm(np.array(xyz[i]) - np.array(xyz[j]))
+            if 0.9 * distance / ANGSTROM < covalent_radii[atomic_numbers[i]] + covalent_radii[atomic_numbers[j]]:
+                pairs.append((i, j))
+    return pairs
+
+
+def test_matches_all_pairs_for_mixed_elements():
+    rng = np.random.default_rng(3)
+    xyz = rng.uniform(-12, 12, (400, 3))
+    atomic_numbers = rng.choice([1, 6, 8, 16, 35], 400)
+    pairs = bonded_pairs(xyz, atomic_numbers)
+    assert len(pairs) > 100
+    assert [tuple(pair) for pair in pairs] == all_pairs(xyz, atomic_numbers)
+
+
+def test_spread_out_and_degenerate_structures():
+    assert perceive_bonds([]) == []
+    assert perceive_bonds([{'atomic_number': 1, 'xyz': (0, 0, 0)}]) == []
+    atoms = [{'atomic_number': 1, 'xyz': (0.0, 0.0, 0.0)}, {'atomic_number': 1, 'xyz': (0.0, 0.0, 1.2)},
+             {'atomic_number': 6, 'xyz': (1e4, -1e4, 0.0)}, {'atomic_number': 1, 'xyz': (1e4, -1e4, 2.0)}]
+    assert perceive_bonds(atoms) == [(1, 0), (3, 2)]
+    assert perceive_bonds([dict(atom, xyz=(0.0, 0.0, 0.0)) for atom in atoms[:3]]) == [(1, 0), (2, 0), (2, 1)]
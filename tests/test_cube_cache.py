@@ -0,0 +1,329 @@
+import concurrent.futures
+import copy
+import os
+import pathlib
+import shutil
+import threading
+
+import numpy as np
+import pymolpro
+import pytest
+from lxml import etree
+from pymolpro.cube_data import CubeData
+
+from iMolpro.cube_cache import OrbitalCubeDiskCache, orbital_cube_data, read_cube_binary, write_cube_binary, \
+    CubeCache, CubePrefetcher, CACHE_DIRECTORY, density_cube_data, density_key, SharedCubeCache, content_digest
+from iMolpro.orbital_grid import Density, total_density
+
+
+def make_cube(dimensions=(4, 5, 6), seed=1):
+    return CubeData({
+        'title': ['1.1', ''],
+        'natoms': 1,
+        'atoms': [{'atomic_number': 8, 'charge': 8.0, 'xyz': (0.0, 0.5, -0.25)}],
+        'origin': np.array([-1.0, -2.0, -3.0]),
+        'cells': np.diag([0.2, 0.3, 0.4]),
+        'dimensions': list(dimensions),
+        'orbitals': True,
+        'orbital_identifiers': ['1.1'],
+        'data': np.random.default_rng(seed).standard_normal(dimensions),
+    })
+
+
+class FakeOrbital:
+    def __init__(self, directory, ID='1.1'):
+        self.directory = directory
+        self.ID = ID
+        self.evaluations = 0
+
+    def cube_data(self, resolution, threshold, border):
+        self.evaluations += 1
+        return make_cube(seed=self.evaluations)
+
+
+@pytest.fixture
+def run_directory(tmp_path):
+    directory = tmp_path / 'run' / '1.molpro'
+    directory.mkdir(parents=True)
+    (directory / '1.xml').write_text('<molpro/>')
+    return str(directory)
+
+
+def test_binary_round_trip(tmp_path):
+    cube = make_cube()
+    filename = str(tmp_path / 'test.grid')
+    write_cube_binary(filename, cube)
+    loaded = read_cube_binary(filename)
+    assert isinstance(loaded.data, np.memmap)
+    assert loaded.data.dtype == np.float32
+    assert np.array_equal(loaded.data, cube.data.astype(np.float32))
+    assert loaded.dimensions == cube.dimensions
+    assert np.array_equal(loaded.cells, cube.cells)
+    assert loaded.origin == tuple(cube.origin)
+    assert loaded.atoms == cube.atoms
+    assert loaded.orbitals and loaded.orbital_identifiers == ['1.1']
+    assert loaded.title == cube.title
+
+
+def test_read_rejects_other_files(tmp_path):
+    filename = tmp_path / 'other.grid'
+    filename.write_bytes(b'not a grid at all')
+    with pytest.raises(ValueError):
+        read_cube_binary(str(filename))
+
+
+def test_second_evaluation_is_read_from_disk(run_directory):
+    orbital = FakeOrbital(run_directory)
+    first = orbital_cube_data(orbital, resolution=.3, threshold=.01, border=6)
+    second = orbital_cube_data(FakeOrbital(run_directory), resolution=.3, threshold=.01, border=6)
+    assert orbital.evaluations == 1
+    assert isinstance(second.data, np.memmap)
+    assert np.array_equal(second.data, first.data.astype(np.float32))
+
+
+def test_key_distinguishes_resolution_threshold_and_orbital(run_directory):
+    orbital = FakeOrbital(run_directory)
+    orbital_cube_data(orbital, resolution=.3, threshold=.01, border=6)
+    orbital_cube_data(orbital, resolution=.2, threshold=.01, border=6)
+    orbital_cube_data(orbital, resolution=.3, threshold=.02, border=6)
+    assert orbital.evaluations == 3
+    other = FakeOrbital(run_directory, ID='2.1')
+    orbital_cube_data(other, resolution=.3, threshold=.01, border=6)
+    assert other.evaluations == 1
+
+
+def test_key_distinguishes_molecule_instances(tmp_path):
+    # a second geometry, as in an optimisation, whose orbitals have the same IDs but opposite signs
+    project_path = tmp_path / 'TestProject.molpro'
+    shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+    xml_filename = project_path / 'run' / '1.molpro' / '1.xml'
+    tree = etree.parse(str(xml_filename))
+    molecule = tree.getroot().find('.//{http://www.molpro.net/schema/molpro-output}molecule')
+    second = copy.deepcopy(molecule)
+    for orbital in second.iter('{*}orbital'):
+        orbital.text = ' '.join(str(-float(c)) for c in orbital.text.split())
+    molecule.addnext(second)
+    tree.write(str(xml_filename))
+    project = pymolpro.Project(str(project_path))
+    first, last = (next(orbital for orbital in project.orbitals(instance=instance) if orbital.ID == '2.1')
+                   for instance in (0, 1))
+    first_cube = orbital_cube_data(first, resolution=.5, threshold=.01, border=3)
+    last_cube = orbital_cube_data(last, resolution=.5, threshold=.01, border=3)
+    assert not isinstance(last_cube.data, np.memmap)
+    assert np.allclose(last_cube.data, -np.asarray(first_cube.data), atol=1e-6)
+
+
+def test_changed_xml_invalidates_cache(run_directory):
+    orbital = FakeOrbital(run_directory)
+    orbital_cube_data(orbital, resolution=.3, threshold=.01, border=6)
+    stale = OrbitalCubeDiskCache.for_orbital(orbital).directory
+    with open(os.path.join(run_directory, '1.xml'), 'w') as f:
+        f.write('<molpro>changed</molpro>')
+    orbital_cube_data(orbital, resolution=.3, threshold=.01, border=6)
+    assert orbital.evaluations == 2
+    assert not os.path.exists(stale)
+    assert len(os.listdir(os.path.join(run_directory, CACHE_DIRECTORY))) == 1
+
+
+def test_no_cache_without_run_directory():
+    orbital = FakeOrbital(None)
+    orbital_cube_data(orbital, resolution=.3, threshold=.01, border=6)
+    orbital_cube_data(orbital, resolution=.3, threshold=.01, border=6)
+    assert orbital.evaluations == 2
+
+
+def test_disk_cache_evicts_least_recently_used_files(run_directory, monkeypatch):
+    orbitals = [FakeOrbital(run_directory, ID) for ID in ('1.1', '2.1', '3.1')]
+    cache = OrbitalCubeDiskCache.for_orbital(orbitals[0])
+    keys = [(None, orbital.ID, .3, .01, 6.0, 'pymolpro') for orbital in orbitals]
+    for when, (key, orbital) in enumerate(zip(keys[:2], orbitals)):
+        orbital_cube_data(orbital, resolution=.3, threshold=.01, border=6)
+        os.utime(cache.filename(key), ns=(when * 10 ** 9, when * 10 ** 9))
+    size = os.path.getsize(cache.filename(keys[0]))
+    monkeypatch.setattr(OrbitalCubeDiskCache, 'budget', int(2.5 * size))
+    # reading the first back makes the second the least recently used
+    assert cache.get(keys[0]) is not None
+    orbital_cube_data(orbitals[2], resolution=.3, threshold=.01, border=6)
+    assert [os.path.exists(cache.filename(key)) for key in keys] == [True, False, True]
+    # a grid bigger than the budget is kept until the next one arrives
+    OrbitalCubeDiskCache.set_budget(size // 2)
+    orbital_cube_data(orbitals[1], resolution=.3, threshold=.01, border=6)
+    assert [os.path.exists(cache.filename(key)) for key in keys] == [False, True, False]
+
+
+def test_disk_cache_opened_once_by_concurrent_workers(run_directory):
+    barrier = threading.Barrier(8)
+
+    def open_cache():
+        barrier.wait()
+        return OrbitalCubeDiskCache.for_orbital(FakeOrbital(run_directory))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        caches = list(executor.map(lambda _: open_cache(), range(8)))
+    assert all(cache is caches[0] for cache in caches)
+    assert caches[0].xml_path == os.path.join(run_directory, '1.xml')
+
+
+def test_lru_evicts_least_recently_used_within_budget():
+    cache = CubeCache(250)
+    cache.put('a', 'A', 100)
+    cache.put('b', 'B', 100)
+    assert cache.get('a') == 'A'
+    cache.put('c', 'C', 100)
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    assert cache.nbytes == 200
+    assert cache.evictions == 1 and cache.evicted_bytes == 100
+    assert cache.get('b') is None
+    assert cache.statistics['hits'] == 1 and cache.statistics['misses'] == 1
+
+
+def test_lru_keeps_newest_entry_even_over_budget():
+    cache = CubeCache(50)
+    cache.put('a', 'A', 10)
+    cache.put('big', 'BIG', 100)
+    assert len(cache) == 1 and cache.get('big') == 'BIG'
+    assert cache.evicted_bytes == 10
+
+
+def test_lru_replacing_entry_updates_size():
+    cache = CubeCache(1000)
+    cache.put('a', 'A', 100)
+    cache.put('a', 'A2', 300)
+    assert len(cache) == 1 and cache.nbytes == 300 and cache.get('a') == 'A2'
+
+
+def test_lru_accept_rejection_counts_as_miss():
+    cache = CubeCache(1000)
+    cache.put('a', (0.01, 'grid'), 100)
+    assert cache.get('a', accept=lambda cached: cached[0] <= 0.001) is None
+    assert cache.get('a', accept=lambda cached: cached[0] <= 0.02) == (0.01, 'grid')
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_lru_set_budget_evicts_at_once():
+    cache = CubeCache(1000)
+    cache.put('a', 'A', 400)
+    cache.put('b', 'B', 400)
+    cache.set_budget(500)
+    assert 'a' not in cache and 'b' in cache and cache.statistics['budget'] == 500
+
+
+class Grid:
+    def __init__(self, key, threshold):
+        self.key = key
+        self.threshold = threshold
+        self.data = np.zeros(10)
+
+
+def test_prefetch_fills_cache():
+    cache = CubeCache(1 << 20)
+    prefetcher = CubePrefetcher(cache, Grid)
+    prefetcher.schedule([('a', .01), ('b', .01)])
+    prefetcher.wait('a', .01)
+    prefetcher.wait('b', .01)
+    assert cache.peek('a')[0] == .01 and cache.peek('a')[1].key == 'a'
+    assert cache.peek('b')[1].key == 'b'
+    assert cache.hits == 0 and cache.misses == 0
+
+
+def test_prefetch_skips_already_cached():
+    cache = CubeCache(1 << 20)
+    cache.put('a', (.01, Grid('a', .01)), 80)
+    evaluated = []
+    prefetcher = CubePrefetcher(cache, lambda key, threshold: evaluated.append(key) or Grid(key, threshold))
+    prefetcher.schedule([('a', .02)])
+    assert prefetcher.pending == []
+    prefetcher.schedule([('a', .001)])  # cached grid was trimmed too tightly for this contour
+    prefetcher.wait('a', .001)
+    assert evaluated == ['a']
+
+
+def test_reschedule_cancels_queued_work():
+    release = threading.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    evaluated = []
+
+    def evaluate(key, threshold):
+        release.wait()
+        evaluated.append(key)
+        return Grid(key, threshold)
+
+    cache = CubeCache(1 << 20)
+    prefetcher = CubePrefetcher(cache, evaluate, executor=executor)
+    prefetcher.schedule([('a', .01), ('b', .01), ('c', .01)])
+    prefetcher.schedule([('c', .01), ('d', .01)])  # 'a' is already running; 'b' is still queued
+    assert set(prefetcher.pending) == {'a', 'c', 'd'}
+    release.set()
+    executor.shutdown(wait=True)
+    assert sorted(evaluated) == ['a', 'c', 'd']
+    assert 'b' not in cache and 'a' in cache
+
+
+def test_cancel_drops_queued_work():
+    release = threading.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    cache = CubeCache(1 << 20)
+    prefetcher = CubePrefetcher(cache, lambda key, threshold: release.wait() and Grid(key, threshold),
+                                executor=executor)
+    prefetcher.schedule([('a', .01), ('b', .01)])
+    prefetcher.cancel()
+    release.set()
+    executor.shutdown(wait=True)
+    assert prefetcher.pending == []
+    assert 'b' not in cache
+
+
+def test_unknown_backend_rejected(run_directory):
+    with pytest.raises(ValueError):
+        orbital_cube_data(FakeOrbital(run_directory), resolution=.3, threshold=.01, border=6, backend='fortran')
+
+
+def test_density_cached_on_disk(tmp_path):
+    project_path = tmp_path / 'TestProject.molpro'
+    shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+    orbitals = pymolpro.Project(str(project_path)).orbitals(instance=-1)
+    first = density_cube_data(total_density(orbitals), resolution=.5, threshold=.01, border=3)
+    second = density_cube_data(total_density(orbitals), resolution=.5, threshold=.01, border=3)
+    assert isinstance(second.data, np.memmap)
+    assert np.allclose(second.data, first.data, rtol=1e-6)
+    halved = Density('half', [(orbitals, [1.0] * len(orbitals))])
+    assert density_key(halved) != density_key(total_density(orbitals))
+    assert not isinstance(density_cube_data(halved, resolution=.5, threshold=.01, border=3).data, np.memmap)
+
+
+def test_shared_cache_entries_live_while_referenced():
+    shared = SharedCubeCache(1000)
+    first, second = shared.view(lambda key: key[0]), shared.view(lambda key: key[0])
+    first.put(('a', 'first view'), 'A', 100)
+    assert second.get(('a', 'second view')) == 'A'
+    assert shared.references('a') == 2
+    first.close()
+    assert second.peek(('a',)) == 'A' and shared.references('a') == 1
+    second.close()
+    assert 'a' not in shared and shared.nbytes == 0
+
+
+def test_shared_cache_budget_is_global():
+    shared = SharedCubeCache(250)
+    first, second = shared.view(lambda key: key), shared.view(lambda key: key)
+    first.put('a', 'A', 100)
+    second.put('b', 'B', 100)
+    first.put('c', 'C', 100)
+    assert 'a' not in shared and shared.nbytes == 200
+    assert shared.references('a') == 0
+    first.close()
+    assert 'b' in shared and 'c' not in shared
+
+
+def test_content_digest_identifies_same_orbitals_in_copies_of_a_run(tmp_path):
+    projects = []
+    for name in ('first', 'second'):
+        project_path = tmp_path / name / 'TestProject.molpro'
+        shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+        projects.append(pymolpro.Project(str(project_path)).orbitals(instance=-1, minocc=0.0))
+    first, second = projects
+    assert [content_digest(orbital) for orbital in first] == [content_digest(orbital) for orbital in second]
+    assert len(set(content_digest(orbital) for orbital in first)) == len(first)
+    assert content_digest(total_density(first)) == content_digest(total_density(second))
+    assert content_digest(total_density(first)) != content_digest(Density('other', [(first, [1.0] * len(first))]))
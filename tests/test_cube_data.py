@@ -0,0 +1,174 @@
+import io
+
+import numpy as np
+import pytest
+
+from iMolpro.cube_data import CubeData, read_values
+
+
+def write_cube(path, data, orbitals=True, values_per_line=6):
+    nx, ny, nz = data.shape
+    with open(path, 'w') as f:
+        f.write('title\ncomment\n')
+        f.write(f'{-2 if orbitals else 2} -1.0 -2.0 -3.0 1\n')
+        f.write(f'{nx} 0.2 0.0 0.0\n{ny} 0.0 0.3 0.0\n{nz} 0.0 0.0 0.4\n')
+        f.write('8 8.0 0.0 0.0 0.0\n1 1.0 0.0 0.0 1.8\n')
+        if orbitals:
+            f.write('1 7\n')
+        for i in range(nx):
+            for j in range(ny):
+                for k0 in range(0, nz, values_per_line):
+                    f.write(''.join(f' {v:.5E}' for v in data[i, j, k0:k0 + values_per_line]) + '\n')
+
+
+def reference_values(filename, dimensions, header_lines):
+    r"""The original line-by-line parser, kept as the reference that read_values() must reproduce."""
+    data = np.ndarray(shape=dimensions, dtype=np.float64)
+    with open(filename, 'r') as f:
+        for _ in range(header_lines):
+            f.readline()
+        for i in range(dimensions[0]):
+            for j in range(dimensions[1]):
+                k0 = 0
+                while True:
+                    line = f.readline().strip().split()
+                    for k, value in enumerate(line):
+                        data[i, j, k + k0] = float(line[k])
+                    k0 += len(line)
+                    if k0 >= dimensions[2]:
+                        break
+    return data
+
+
+@pytest.mark.parametrize('orbitals', [True, False])
+@pytest.mark.parametrize('shape', [(3, 4, 5), (2, 3, 13), (1, 1, 6)])
+def test_load_matches_line_by_line_parser(tmp_path, shape, orbitals):
+    filename = str(tmp_path / 'test.cube')
+    write_cube(filename, np.random.default_rng(1).standard_normal(shape), orbitals=orbitals)
+    cube = CubeData(filename)
+    assert cube.dimensions == list(shape)
+    assert cube.data.shape == shape
+    assert cube.data.dtype == np.float64
+    assert np.array_equal(cube.data, reference_values(filename, shape, 8 + (1 if orbitals else 0)))
+    assert len(cube.atoms) == 2
+    assert cube.orbitals == orbitals
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 7, 12, 13, 100, 1 << 20])
+def test_read_values_chunk_boundaries(chunk_bytes):
+    values = np.random.default_rng(2).standard_normal(50)
+    text = '\n'.join(''.join(f' {v:.5E}' for v in values[k:k + 6]) for k in range(0, len(values), 6)) + '\n'
+    result = read_values(io.StringIO(text), len(values), chunk_bytes=chunk_bytes)
+    assert np.array_equal(result, np.array([float(f'{v:.5E}') for v in values]))
+
+
+def test_read_values_ignores_trailing_content():
+    assert np.array_equal(read_values(io.StringIO(' 1.0 2.0\n 3.0 4.0\n'), 3), [1.0, 2.0, 3.0])
+
+
+def test_read_values_truncated_raises():
+    with pytest.raises(ValueError):
+        read_values(io.StringIO(' 1.0 2.0\n'), 3)
+
+
+def write_stacked_cube(path, data, identifiers=None):
+    r"""A cube file holding data.shape[0] orbitals (if `identifiers` is given) or values at each point."""
+    n, nx, ny, nz = data.shape
+    with open(path, 'w') as f:
+        f.write('title\ncomment\n')
+        f.write(f'{-1 if identifiers else 1} -1.0 -2.0 -3.0 {1 if identifiers else n}\n')
+        f.write(f'{nx} 0.2 0.0 0.0\n{ny} 0.0 0.3 0.0\n{nz} 0.0 0.0 0.4\n')
+        f.write('8 8.0 0.0 0.0 0.0\n')
+        if identifiers:
+            # ten identifiers to a line, as Gaussian writes them
+            line = [len(identifiers)] + identifiers
+            f.write('\n'.join(' '.join(str(i) for i in line[k:k + 10]) for k in range(0, len(line), 10)) + '\n')
+        points = np.moveaxis(data, 0, -1)
+        for i in range(nx):
+            for j in range(ny):
+                row = points[i, j].ravel()
+                for k0 in range(0, len(row), 6):
+                    f.write(''.join(f' {v:.5E}' for v in row[k0:k0 + 6]) + '\n')
+
+
+@pytest.mark.parametrize('identifiers', [None, [3, 4, 7], list(range(1, 13))])
+def test_load_stacked(tmp_path, identifiers):
+    n = len(identifiers) if identifiers else 2
+    data = np.round(np.random.default_rng(3).standard_normal((n, 3, 4, 5)), 4)
+    filename = str(tmp_path / 'stacked.cube')
+    write_stacked_cube(filename, data, identifiers)
+    cube = CubeData(filename)
+    assert cube.nvalues == n
+    assert cube.data.shape == (n, 3, 4, 5) and cube.data.flags.c_contiguous
+    assert np.allclose(cube.data, data, rtol=1e-5)
+    if identifiers:
+        assert cube.orbital_identifiers == identifiers
+    second = cube.select(1)
+    assert second.nvalues == 1 and np.array_equal(second.data, cube.data[1])
+    assert second.dimensions == cube.dimensions
+    if identifiers:
+        assert second.orbital_identifiers == [identifiers[1]]
+
+
+@pytest.mark.parametrize('identifiers', [None, [3, 4, 7]])
+def test_stacked_text_round_trip(tmp_path, identifiers):
+    filename = str(tmp_path / 'stacked.cube')
+    write_stacked_cube(filename, np.random.default_rng(4).standard_normal((3, 2, 3, 4)), identifiers)
+    cube = CubeData(filename)
+    copy = str(tmp_path / 'copy.cube')
+    with open(copy, 'w') as f:
+        f.write(str(cube))
+    assert np.array_equal(CubeData(copy).data, cube.data)
+
+
+def test_single_value_select_is_identity(tmp_path):
+    filename = str(tmp_path / 'test.cube')
+    write_cube(filename, np.zeros((2, 2, 2)))
+    cube = CubeData(filename)
+    assert cube.nvalues == 1 and cube.select(0) is cube
+    with pytest.raises(IndexError):
+        cube.select(1)
+
+
+@pytest.mark.parametrize('orbitals', [True, False])
+def test_write_round_trip(tmp_path, orbitals):
+    filename = str(tmp_path / 'test.cube')
+    write_cube(filename, np.random.default_rng(5).standard_normal((3, 4, 13)), orbitals=orbitals)
+    cube = CubeData(filename)
+    copy = str(tmp_path / 'copy.cube')
+    cube.write(copy)
+    loaded = CubeData(copy)
+    assert np.array_equal(loaded.data, cube.data)
+    assert loaded.orbitals == orbitals
+    assert loaded.atoms == cube.atoms and loaded.dimensions == cube.dimensions
+    assert np.array_equal(loaded.cells, cube.cells) and loaded.origin == cube.origin
+    # six values to a line, each (x, y) row of 13 starting a new line
+    lines = open(copy).read().splitlines()[8 + (1 if orbitals else 0):]
+    assert [len(line.split()) for line in lines[:3]] == [6, 6, 1]
+    assert len(lines) == 3 * 4 * 3
+
+
+@pytest.mark.parametrize('chunk_values', [1, 5, 13, 40, 1 << 20])
+def test_write_chunks_give_same_text(tmp_path, chunk_values):
+    filename = str(tmp_path / 'stacked.cube')
+    write_stacked_cube(filename, np.random.default_rng(6).standard_normal((2, 3, 4, 5)), [1, 2])
+    cube = CubeData(filename)
+    stream = io.StringIO()
+    cube.write(stream, chunk_values=chunk_values)
+    assert stream.getvalue() == str(cube) == open(filename).read()
+
+
+def test_write_round_trip_of_molpro_orbital_ids(tmp_path):
+    data = np.random.default_rng(7).standard_normal((3, 2, 3, 4))
+    atoms = [{'atomic_number': 1, 'charge': 1.0, 'xyz': (0.0, 0.0, 0.0)}]
+    cube = CubeData({'title': ['orbitals', ''], 'natoms': 1, 'atoms': atoms, 'origin': (0.0, 0.0, 0.0),
+                     'cells': np.diag([0.2, 0.3, 0.4]), 'dimensions': [2, 3, 4], 'orbitals': True,
+                     'orbital_identifiers': ['1.1', '2.3', '12.1'], 'data': data})
+    filename = str(tmp_path / 'orbitals.cube')
+    cube.write(filename)
+    loaded = CubeData(filename)
+    assert loaded.orbital_identifiers == [11, 23, 121]
+    assert np.allclose(loaded.data, data, rtol=1e-5)
+    cube.orbital_identifiers = ['HOMO']
+    with pytest.raises(ValueError):
+        cube.write(str(tmp_path / 'unnamed.cube'))
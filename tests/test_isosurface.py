@@ -0,0 +1,218 @@
+import concurrent.futures
+import threading
+
+import numpy as np
+from pymolpro.cube_data import CubeData
+
+from iMolpro.cube_cache import CubeCache
+import pytest
+from vtkmodules.vtkFiltersCore import vtkContourFilter, vtkFlyingEdges3D
+
+from iMolpro.isosurface import IsosurfaceBuilder, Isosurface, contour, contour_filter, level_of_detail, prepare_grid, \
+    ISOSURFACE_ENGINES, use_smp_threads
+from iMolpro.vtk_molecule_widget import CubeActor, create_vtk_image_data
+
+
+def gaussian_cube(n=24):
+    axis = np.linspace(-3, 3, n)
+    x, y, z = np.meshgrid(axis, axis, axis, indexing='ij')
+    return CubeData({
+        'title': ['gaussian', ''],
+        'natoms': 0,
+        'atoms': [],
+        'origin': (-3.0, -3.0, -3.0),
+        'cells': np.diag([6 / (n - 1)] * 3),
+        'dimensions': [n, n, n],
+        'orbitals': True,
+        'orbital_identifiers': ['1.1'],
+        'data': np.exp(-(x * x + y * y + z * z)) * np.sign(x + 1e-9),
+    })
+
+
+def blocked_executor():
+    r"""A single-worker executor kept busy until the returned event is set, so that everything submitted queues."""
+    release = threading.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    executor.submit(release.wait)
+    return executor, release
+
+
+@pytest.mark.parametrize('engine', ISOSURFACE_ENGINES)
+def test_contour_gives_both_signs(engine):
+    if engine == 'flying_edges_smp':
+        use_smp_threads(2)
+    surface = contour(prepare_grid(create_vtk_image_data(gaussian_cube())), 0.1, engine=engine)
+    assert surface.GetNumberOfPolys() > 0
+    assert surface.GetPointData().GetNormals() is not None
+    scalars = [surface.GetPointData().GetScalars().GetValue(i) for i in range(surface.GetNumberOfPoints())]
+    assert np.allclose(sorted(set(np.round(scalars, 6))), [-0.1, 0.1])
+
+
+def test_engines_agree():
+    grid = prepare_grid(create_vtk_image_data(gaussian_cube()))
+    bounds = [contour(grid, 0.1, engine=engine).GetBounds() for engine in ISOSURFACE_ENGINES]
+    assert np.allclose(bounds, bounds[0], atol=1e-4)
+
+
+def test_flying_edges_only_for_image_data():
+    cube = gaussian_cube()
+    assert isinstance(contour_filter(create_vtk_image_data(cube), 'flying_edges'), vtkFlyingEdges3D)
+    cube.cells = np.array([[0.25, 0.0, 0.0], [0.05, 0.25, 0.0], [0.0, 0.0, 0.25]])
+    assert type(contour_filter(create_vtk_image_data(cube), 'flying_edges')) is vtkContourFilter
+    with pytest.raises(ValueError):
+        contour_filter(create_vtk_image_data(cube), 'marching_tetrahedra')
+
+
+@pytest.mark.parametrize('smoothing', [0, 10])
+def test_level_of_detail(smoothing):
+    surface = contour(prepare_grid(create_vtk_image_data(gaussian_cube(40))), 0.1)
+    triangles = surface.GetNumberOfPolys() // 4
+    reduced = level_of_detail(surface, triangles, smoothing)
+    assert 0.5 * triangles < reduced.GetNumberOfPolys() < 1.5 * triangles
+    assert reduced.GetPointData().GetNormals() is not None
+    scalars = [reduced.GetPointData().GetScalars().GetValue(i) for i in range(reduced.GetNumberOfPoints())]
+    assert np.allclose(sorted(set(np.round(scalars, 6))), [-0.1, 0.1])
+    assert np.allclose(reduced.GetBounds(), surface.GetBounds(), atol=0.2)
+    assert level_of_detail(surface, surface.GetNumberOfPolys()) is surface
+    assert level_of_detail(surface, 0) is surface
+
+
+def test_builder_coalesces_to_latest_request():
+    grid = prepare_grid(create_vtk_image_data(gaussian_cube()))
+    executor, release = blocked_executor()
+    ready = []
+    cache = CubeCache(1 << 30)
+    builder = IsosurfaceBuilder(cache, executor=executor, on_ready=ready.append)
+    try:
+        for value in (.1, .2, .3):
+            builder.schedule(grid, 7, [value])
+        assert builder.pending == [(7, .3)]
+    finally:
+        release.set()
+        executor.shutdown(wait=True)
+    assert ready == [(7, .3)]
+    assert (7, .1) not in cache and cache.peek((7, .3)).surface.GetNumberOfPoints() > 0
+
+
+def test_builder_works_through_nearby_values_in_order_and_skips_cached():
+    grid = prepare_grid(create_vtk_image_data(gaussian_cube()))
+    executor, release = blocked_executor()
+    ready = []
+    cache = CubeCache(1 << 30)
+    cache.put((7, .2), Isosurface(contour(grid, .2)), 1)
+    builder = IsosurfaceBuilder(cache, executor=executor, on_ready=ready.append)
+    try:
+        builder.schedule(grid, 7, [.1, .2, .05])
+    finally:
+        release.set()
+        executor.shutdown(wait=True)
+    assert ready == [(7, .1), (7, .05)]
+
+
+def test_builder_carries_the_engine_of_each_request(monkeypatch):
+    grid = prepare_grid(create_vtk_image_data(gaussian_cube()))
+    executor, release = blocked_executor()
+    engines = []
+    monkeypatch.setattr('iMolpro.isosurface.contour', lambda grid, value, engine: engines.append(engine) or
+                        contour(grid, value))
+    builder = IsosurfaceBuilder(CubeCache(1 << 30), executor=executor)
+    try:
+        builder.schedule(grid, 7, [.1], engine='flying_edges')
+        builder.schedule(grid, 7, [.1, .2])
+    finally:
+        release.set()
+        executor.shutdown(wait=True)
+    assert engines == ['flying_edges', 'contour']
+
+
+def test_cube_actor_caches_surfaces():
+    actor = CubeActor(gaussian_cube(), contour_value=.1)
+    first = actor.GetMapper().GetInput()
+    actor.request_contour_value(.2)
+    assert actor.GetMapper().GetInput() is not first
+    actor.request_contour_value(.1)
+    assert actor.GetMapper().GetInput() is first
+    assert actor.isosurfaces.hits == 1
+    # a byte count, read from the settings on this thread, not a callable for the contouring worker to call
+    assert isinstance(actor.isosurfaces.budget, int)
+
+
+def test_cube_actor_interactive_level_of_detail(monkeypatch):
+    monkeypatch.setattr(CubeActor, 'isosurface_detail', staticmethod(lambda: (1000, 0)))
+    actor = CubeActor(gaussian_cube(40), contour_value=.1)
+    full = actor.GetMapper().GetInput()
+    actor.set_interacting(True)
+    lighter = actor.GetMapper().GetInput()
+    assert lighter is not full and lighter is actor.isosurface.interactive
+    assert lighter.GetNumberOfPolys() < 1500 < full.GetNumberOfPolys()
+    actor.set_interacting(False)
+    assert actor.GetMapper().GetInput() is full
+    actor.set_interacting(True)
+    assert actor.GetMapper().GetInput() is lighter  # made once, when first wanted
+
+
+def test_cube_actor_does_not_reduce_surfaces_before_drawing_them(monkeypatch):
+    import iMolpro.isosurface
+    threads = []
+    monkeypatch.setattr(CubeActor, 'isosurface_detail', staticmethod(lambda: (1000, 0)))
+    monkeypatch.setattr(iMolpro.isosurface, 'level_of_detail', lambda surface, triangles, smoothing=0:
+                        threads.append(threading.current_thread()) or level_of_detail(surface, triangles, smoothing))
+    actor = CubeActor(gaussian_cube(40), contour_value=.1)
+    actor.cube(gaussian_cube(40))
+    assert threads == []
+    actor.set_interacting(True)
+    assert threads == [threading.current_thread()]
+
+    threads.clear()
+    ready = threading.Event()
+    actor = CubeActor(gaussian_cube(40), contour_value=.1, on_isosurface_ready=lambda key: None)
+    actor.isosurface_builder.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    actor.cube(gaussian_cube(40))
+    actor.isosurface_builder.executor.submit(ready.set)
+    assert ready.wait(10)
+    assert threads and threading.current_thread() not in threads
+    actor.set_interacting(True)
+    assert threads and threading.current_thread() not in threads
+
+
+def test_cube_actor_background_contouring():
+    ready = []
+    done = threading.Event()
+    actor = CubeActor(gaussian_cube(), contour_value=.1,
+                      on_isosurface_ready=lambda key: ready.append(key) or done.set())
+    shown = actor.GetMapper().GetInput()
+    actor.request_contour_value(.3)
+    assert done.wait(10)
+    assert actor.contour_value == .3
+    assert actor.GetMapper().GetInput() is shown  # until the owner hands it over on the GUI thread
+    assert actor.show_isosurface(ready[0])
+    assert actor.GetMapper().GetInput() is not shown
+    actor.cube(gaussian_cube(16))
+    assert not actor.show_isosurface(ready[0])  # a surface of the grid since replaced
+
+
+class ThreadRecordingSettings:
+    r"""The settings, noting each thread that reads them."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.threads = set()
+
+    def __getitem__(self, key):
+        self.threads.add(threading.current_thread())
+        return self.settings[key]
+
+    def __getattr__(self, name):
+        return getattr(self.settings, name)
+
+
+def test_cube_actor_reads_settings_only_on_its_own_thread(monkeypatch):
+    import iMolpro.vtk_molecule_widget
+    settings = ThreadRecordingSettings(iMolpro.vtk_molecule_widget.settings)
+    monkeypatch.setattr(iMolpro.vtk_molecule_widget, 'settings', settings)
+    done = threading.Event()
+    actor = CubeActor(gaussian_cube(), contour_value=.1, on_isosurface_ready=lambda key: done.set())
+    actor.request_contour_value(.3, nearby=[.25])
+    assert done.wait(10)
+    actor.isosurface_builder.cancel()
+    assert settings.threads == {threading.current_thread()}
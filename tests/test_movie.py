@@ -0,0 +1,122 @@
+import ctypes.util
+import pathlib
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+
+from iMolpro import movie, offscreen
+from iMolpro.movie import APNGWriter, export_vibration_movie, movie_writer, GIFWriter, ImageSequenceWriter
+from iMolpro.offscreen import offscreen_window_class
+from iMolpro.vtk_molecule_widget import xyz_to_atoms
+
+MALONALDEHYDE = str(pathlib.Path(__file__).resolve().parent.parent / 'malonaldehyde.molpro' / 'malonaldehyde.xyz')
+
+can_render = pytest.mark.skipif(
+    not (ctypes.util.find_library('EGL') or ctypes.util.find_library('OSMesa') or offscreen._has_display()),
+    reason='no OpenGL to render with')
+
+
+def test_apng_writer(tmp_path):
+    rng = np.random.default_rng(1)
+    frames = [rng.integers(0, 256, (5, 7, 4), dtype=np.uint8) for _ in range(3)]
+    writer = APNGWriter(str(tmp_path / 'noise.png'), len(frames), fps=10)
+    for frame in frames:
+        writer.write(frame)
+    writer.close()
+    image = Image.open(tmp_path / 'noise.png')
+    assert image.n_frames == 3 and image.info['loop'] == 0 and image.info['duration'] == 100
+    for frame, decoded in zip(frames, ImageSequence.Iterator(image)):
+        assert np.array_equal(np.asarray(decoded.convert('RGBA')), frame)
+    writer = APNGWriter(str(tmp_path / 'short.png'), 2, fps=10)
+    writer.write(frames[0])
+    with pytest.raises(ValueError):
+        writer.write(frames[0][:, :, :3])
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+def test_gif_writer(tmp_path):
+    rng = np.random.default_rng(3)
+    frames = [rng.integers(0, 256, (5, 7, 4), dtype=np.uint8) for _ in range(3)]
+    writer = GIFWriter(str(tmp_path / 'noise.gif'), len(frames), fps=10)
+    for frame in frames:
+        writer.write(frame)
+    writer.close()
+    image = Image.open(tmp_path / 'noise.gif')
+    assert image.n_frames == 3 and image.info['loop'] == 0 and image.info['duration'] == 100
+    for frame, decoded in zip(frames, ImageSequence.Iterator(image)):
+        decoded = np.asarray(decoded.convert('RGBA'))
+        opaque = frame[..., 3] >= 128
+        assert np.array_equal(decoded[..., 3] == 255, opaque)
+        assert np.array_equal(decoded[opaque, :3], frame[opaque, :3])  # no more than 255 colours in each frame
+    writer = GIFWriter(str(tmp_path / 'short.gif'), 2, fps=10)
+    writer.write(frames[0])
+    with pytest.raises(ValueError):
+        writer.write(frames[0][:, :, :3])
+    writer.close()
+
+
+@pytest.mark.parametrize('writer_class', [APNGWriter, GIFWriter])
+def test_animation_writers_hold_no_frames(tmp_path, writer_class):
+    frame = np.random.default_rng(4).integers(0, 256, (16, 16, 3), dtype=np.uint8)
+    writer = writer_class(str(tmp_path / 'movie'), 40, fps=10)
+    sizes = []
+    for _ in range(40):
+        writer.write(frame)
+        sizes.append(writer.file.tell())
+    # each frame goes to the file as it is written, and nothing of it stays behind, whatever the length of the clip
+    assert all(later > earlier for earlier, later in zip(sizes, sizes[1:]))
+    assert not any(isinstance(value, (list, np.ndarray, Image.Image)) for value in vars(writer).values())
+    writer.close()
+
+
+def test_movie_writer(tmp_path):
+    assert isinstance(movie_writer(str(tmp_path / 'a.gif'), 2, 10), GIFWriter)
+    assert isinstance(movie_writer(str(tmp_path / 'a_{:03d}.tiff'), 2, 10), ImageSequenceWriter)
+    with pytest.raises(ValueError):
+        movie_writer(str(tmp_path / 'a.mp4'), 2, 10)
+
+
+@can_render
+def test_export_vibration_movie(tmp_path, monkeypatch):
+    monkeypatch.setenv(offscreen.WINDOW_CLASS_VARIABLE, offscreen_window_class() or '')
+    atoms = xyz_to_atoms(MALONALDEHYDE)
+    mode = {'vector': np.random.default_rng(2).normal(size=3 * len(atoms)).tolist(), 'wavenumber': 1000.0}
+    # the frames go through a queue that never holds more than FRAME_QUEUE_LENGTH of them
+    lengths = []
+    put = movie.queue.Queue.put
+    monkeypatch.setattr(movie.queue.Queue, 'put', lambda self, item: (lengths.append(self.qsize()), put(self, item)))
+    filename = export_vibration_movie(atoms, mode, str(tmp_path / 'mode.png'), frames=8, width=64, height=48,
+                                      transparent=True)
+    assert max(lengths) <= movie.FRAME_QUEUE_LENGTH
+    assert not any(thread.name == 'vibration movie encoder' for thread in threading.enumerate())
+    frames = [np.asarray(frame.convert('RGBA')) for frame in ImageSequence.Iterator(Image.open(filename))]
+    assert len(frames) == 8 and frames[0].shape == (48, 64, 4)
+    assert not frames[0][0, :, 3].any() and not np.array_equal(frames[0], frames[2])
+    # the first frame is at equilibrium, as is the only frame of a one-frame movie
+    export_vibration_movie(atoms, mode, str(tmp_path / 'single_{}.png'), frames=1, width=64, height=48,
+                           transparent=True)
+    assert np.array_equal(frames[0], np.asarray(Image.open(tmp_path / 'single_0.png')))
+    gif = Image.open(export_vibration_movie(atoms, mode, str(tmp_path / 'mode.gif'), frames=4, width=64, height=48))
+    assert gif.n_frames == 4 and gif.size == (64, 48)
+    export_vibration_movie(atoms, mode, str(tmp_path / 'mode_{:02d}.tiff'), frames=3, width=32, height=32,
+                           magnification=2)
+    assert Image.open(tmp_path / 'mode_02.tiff').size == (64, 64)
+
+
+
+def test_export_vibration_movie_leaves_no_file_without_a_scene(tmp_path, monkeypatch):
+    def no_opengl(*args, **kwargs):
+        raise RuntimeError('no OpenGL')
+
+    monkeypatch.setattr(movie, 'OffscreenScene', no_opengl)
+    atoms = xyz_to_atoms(MALONALDEHYDE)
+    mode = {'vector': [0.0] * (3 * len(atoms)), 'wavenumber': 1000.0}
+    for filename in ('mode.png', 'mode.gif', 'mode_{:03d}.png'):
+        with pytest.raises(RuntimeError):
+            export_vibration_movie(atoms, mode, str(tmp_path / filename), frames=2, width=16, height=16)
+    assert list(tmp_path.iterdir()) == []
+    with pytest.raises(ValueError):
+        export_vibration_movie(atoms, mode, str(tmp_path / 'mode.mp4'), frames=2)
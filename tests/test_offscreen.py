@@ -0,0 +1,133 @@
+import ctypes.util
+import pathlib
+import shutil
+
+import numpy as np
+import pymolpro
+import pytest
+from PIL import Image
+
+from iMolpro import offscreen
+from iMolpro.offscreen import plan, render, render_all, offscreen_window_class, OffscreenScene, RenderJob
+
+MALONALDEHYDE = str(pathlib.Path(__file__).resolve().parent.parent / 'malonaldehyde.molpro' / 'malonaldehyde.xyz')
+
+can_render = pytest.mark.skipif(
+    not (ctypes.util.find_library('EGL') or ctypes.util.find_library('OSMesa') or offscreen._has_display()),
+    reason='no OpenGL to render with')
+
+
+@pytest.fixture
+def project(tmp_path):
+    project_path = tmp_path / 'TestProject.molpro'
+    shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+    return str(project_path)
+
+
+@pytest.fixture
+def window_environment(monkeypatch):
+    r"""offscreen_window_class() as if without a display, with `libraries` the libraries installed."""
+    monkeypatch.delenv('DISPLAY', raising=False)
+    monkeypatch.delenv('WAYLAND_DISPLAY', raising=False)
+    monkeypatch.delenv(offscreen.WINDOW_CLASS_VARIABLE, raising=False)
+    monkeypatch.setattr(offscreen.sys, 'platform', 'linux')
+
+    def environment(*libraries):
+        monkeypatch.setattr(offscreen.ctypes.util, 'find_library',
+                            lambda name: f'lib{name}.so' if name in libraries else None)
+        offscreen_window_class.cache_clear()
+
+    yield environment
+    offscreen_window_class.cache_clear()
+
+
+def test_offscreen_window_class(window_environment, monkeypatch):
+    window_environment('EGL', 'OSMesa')
+    assert offscreen_window_class() == 'vtkEGLRenderWindow'
+    assert offscreen_window_class(software=True) == 'vtkOSOpenGLRenderWindow'
+    window_environment('OSMesa')
+    assert offscreen_window_class() == 'vtkOSOpenGLRenderWindow'
+    window_environment()
+    with pytest.raises(RuntimeError):
+        offscreen_window_class()
+    monkeypatch.setenv(offscreen.WINDOW_CLASS_VARIABLE, 'vtkXOpenGLRenderWindow')
+    assert offscreen_window_class() == 'vtkXOpenGLRenderWindow'
+
+
+def test_plan(project, tmp_path):
+    jobs = plan([project, MALONALDEHYDE], str(tmp_path), contour_values=[.05, .1], width=300, height=200)
+    structure = jobs.pop()
+    assert structure.orbital is None and structure.filenames == (str(tmp_path / 'malonaldehyde.png'),)
+    homo = max(pymolpro.Project(project).orbitals(), key=lambda orbital: orbital.energy)
+    assert [job.orbital for job in jobs] == [homo.ID]
+    assert jobs[0].filenames == tuple(str(tmp_path / f'TestProject_{homo.ID}_{value}.png') for value in ('0.05', '0.1'))
+    assert jobs[0].contour_values == (.05, .1) and (jobs[0].width, jobs[0].height) == (300, 200)
+    every = plan([project], str(tmp_path), selection='all')
+    assert len(every) == len(pymolpro.Project(project).orbitals())
+    assert [job.orbital for job in plan([project], str(tmp_path), orbital_ids=['1.1'])] == ['1.1']
+    assert plan([MALONALDEHYDE], str(tmp_path), extension='.tiff')[0].filenames == (
+        str(tmp_path / 'malonaldehyde.tiff'),)
+    assert {job.geometry for job in plan([project], str(tmp_path), geometry=0)} == {0}
+
+
+@can_render
+def test_render_structure_and_orbital(project, tmp_path, monkeypatch):
+    monkeypatch.setenv(offscreen.WINDOW_CLASS_VARIABLE, offscreen_window_class() or '')
+    structure, orbital = plan([MALONALDEHYDE, project], str(tmp_path), contour_values=[.05, .2], width=120,
+                              height=90, background=(0.0, 0.0, 0.0))
+    assert render(structure) == list(structure.filenames)
+    image = np.asarray(Image.open(structure.filenames[0]))
+    assert image.shape == (90, 120, 3)
+    assert not image[0].any() and image.any()  # black background, with the molecule in the middle
+    render(orbital)
+    large, small = (np.asarray(Image.open(filename)).any(axis=-1).sum() for filename in orbital.filenames)
+    assert large > small > 0
+
+
+@can_render
+def test_render_all_in_worker_processes(tmp_path, monkeypatch):
+    monkeypatch.setenv(offscreen.WINDOW_CLASS_VARIABLE, offscreen_window_class() or '')
+    jobs = [RenderJob(MALONALDEHYDE, (str(tmp_path / f'{i}.png'),), width=64, height=64) for i in range(2)]
+    jobs.append(RenderJob(str(tmp_path / 'missing.xyz'), (str(tmp_path / 'missing.png'),)))
+    results = dict(render_all(jobs, processes=2))
+    assert [results[job] for job in jobs[:2]] == [list(job.filenames) for job in jobs[:2]]
+    assert isinstance(results[jobs[2]], Exception)
+    assert Image.open(jobs[0].filenames[0]).size == (64, 64)
+
+
+@can_render
+def test_scene_shows_one_model_at_a_time(monkeypatch):
+    monkeypatch.setenv(offscreen.WINDOW_CLASS_VARIABLE, offscreen_window_class() or '')
+    from iMolpro.vtk_molecule_widget import MolecularModel, xyz_to_atoms
+    scene = OffscreenScene(50, 40)
+    scene.show(MolecularModel(xyz_to_atoms(MALONALDEHYDE)))
+    first = scene.image()
+    scene.show(MolecularModel(xyz_to_atoms(MALONALDEHYDE)[:3]))
+    assert scene.renderer.GetActors().GetNumberOfItems() < 9
+    assert first.shape == (40, 50, 3) and not np.array_equal(first, scene.image())
+    scene.close()
+
+
+@can_render
+def test_magnified_transparent_image(tmp_path, monkeypatch):
+    monkeypatch.setenv(offscreen.WINDOW_CLASS_VARIABLE, offscreen_window_class() or '')
+    from iMolpro.vtk_molecule_widget import MolecularModel, xyz_to_atoms, scene_renderer
+    view = scene_renderer()
+    view.AddActor(MolecularModel(xyz_to_atoms(MALONALDEHYDE)).GetItemAsObject(0))
+    view.ResetCamera()
+    view.GetActiveCamera().Azimuth(30)
+    scene = OffscreenScene(60, 40, background=(0.0, 0.0, 0.0))
+    scene.show_view(view)
+    small = scene.image()
+    large = scene.image(magnification=3, transparent=True)
+    assert small.shape == (40, 60, 3) and large.shape == (120, 180, 4)
+    assert not large[0, :, 3].any() and (large[large[..., 3] > 0, 3] == 255).any()
+    # the tiles join up into the image that's drawn at the window's size
+    binned = large[..., :3].reshape(40, 3, 60, 3, 3).mean(axis=(1, 3))
+    assert np.abs(binned - small).mean() < 10
+    scene.write_image(str(tmp_path / 'molecule.tiff'), magnification=2, transparent=True)
+    image = Image.open(tmp_path / 'molecule.tiff')
+    assert image.mode == 'RGBA' and image.size == (120, 80)
+    with pytest.raises(ValueError):
+        scene.write_image(str(tmp_path / 'molecule.jpg'))
+    scene.close()
@@ -0,0 +1,191 @@
+import pathlib
+import shutil
+
+import numpy as np
+import pymolpro
+import pytest
+from lxml import etree
+from pymolpro.grid import evaluateBasis
+
+from iMolpro.cube_data import CubeData as StackedCubeData, cube_orbital_index
+from iMolpro.orbital_grid import BasisSet, cube_data, molecule_node, orbitals_cube_data, energy_window, total_density, \
+    spin_density, difference_density
+
+# Two centres carrying shells up to g (cartesian) or d (spherical), with general contractions.
+MOLECULE = """<molecule xmlns="http://www.molpro.net/schema/molpro-output" xmlns:cml="http://www.xml-cml.org/schema"
+    xmlns:xlink="http://www.w3.org/1999/xlink" id="M1">
+ <cml:molecule><cml:atomArray>
+  <cml:atom id="a1" elementType="O" x3="0.1" y3="-0.2" z3="0.3"/>
+  <cml:atom id="a2" elementType="H" x3="-0.5" y3="0.7" z3="-0.4"/>
+ </cml:atomArray></cml:molecule>
+ <basisSet id="ORBITAL" angular="{angular}" type="gaussian">
+  <basisGroup id="1" minL="0" maxL="0" primitives="3" contractions="2">
+   <basisExponents>5.0 1.2 0.3</basisExponents>
+   <basisContraction>0.3 0.6 0.2</basisContraction>
+   <basisContraction>0.0 -0.4 1.0</basisContraction>
+  </basisGroup>
+  <basisGroup id="2" minL="1" maxL="1" primitives="2" contractions="1">
+   <basisExponents>2.0 0.4</basisExponents>
+   <basisContraction>0.5 0.7</basisContraction>
+  </basisGroup>
+  <basisGroup id="3" minL="2" maxL="2" primitives="1" contractions="1">
+   <basisExponents>0.8</basisExponents>
+   <basisContraction>1.0</basisContraction>
+  </basisGroup>
+  {higher}
+  <association xlink:type="extended">
+   <bases xlink:type="locator" xlink:label="bases"
+     xlink:href="#xpointer(//molecule[@id='M1']//basisGroup[@id='1' or @id='2' or @id='3'{higher_ids}])"/>
+   <atoms xlink:label="atoms" xlink:href="#xpointer(//molecule[@id='M1']//atom[@id='a1'])"/>
+  </association>
+  <association xlink:type="extended">
+   <bases xlink:type="locator" xlink:label="bases"
+     xlink:href="#xpointer(//molecule[@id='M1']//basisGroup[@id='1' or @id='2'])"/>
+   <atoms xlink:label="atoms" xlink:href="#xpointer(//molecule[@id='M1']//atom[@id='a2'])"/>
+  </association>
+ </basisSet>
+ <orbitals angular="{angular}"/>
+</molecule>"""
+
+HIGHER = """<basisGroup id="4" minL="3" maxL="3" primitives="1" contractions="1">
+   <basisExponents>0.6</basisExponents><basisContraction>1.0</basisContraction></basisGroup>
+  <basisGroup id="5" minL="4" maxL="4" primitives="1" contractions="1">
+   <basisExponents>0.5</basisExponents><basisContraction>1.0</basisContraction></basisGroup>"""
+
+
+def molecule(angular):
+    cartesian = angular == 'cartesian'
+    return etree.fromstring(MOLECULE.format(angular=angular, higher=HIGHER if cartesian else '',
+                                            higher_ids=" or @id='4' or @id='5'" if cartesian else ''))
+
+
+def grid_points(origin, resolution, dimensions):
+    axes = [origin[i] + resolution * np.arange(dimensions[i]) for i in range(3)]
+    return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+ORIGIN, RESOLUTION, DIMENSIONS = np.array([-2.0, -1.5, -2.5]), 0.35, (9, 11, 13)
+
+
+def basis_functions(basis):
+    # each basis function on its own, through the orbital interface, in blocks that don't divide the grid
+    values = basis.evaluate_grid(np.eye(basis.size), ORIGIN, RESOLUTION, DIMENSIONS, block=4, threshold=0)
+    assert values.shape == (basis.size,) + DIMENSIONS
+    return values.reshape(basis.size, -1)
+
+
+def test_basis_functions_match_pymolpro():
+    node = molecule('cartesian')
+    reference = evaluateBasis(node, grid_points(ORIGIN, RESOLUTION, DIMENSIONS))
+    basis = BasisSet.from_molecule(node)
+    assert basis.size == len(reference)
+    assert np.allclose(basis_functions(basis), reference, rtol=1e-12, atol=1e-14)
+
+
+def test_spherical_basis_functions():
+    # pymolpro.grid.evaluateBasis() fails for spherical basis sets, so transform its cartesian d functions
+    cartesian = evaluateBasis(molecule('cartesian'), grid_points(ORIGIN, RESOLUTION, DIMENSIONS))
+    transformation = np.array([[-0.5, -0.5, 1, 0, 0, 0], [1, -1, 0, 0, 0, 0], [0, 0, 0, 0, 1, 0],
+                               [0, 0, 0, 1, 0, 0], [0, 0, 0, 0, 0, 1]])
+    reference = np.concatenate([cartesian[:5], transformation @ cartesian[5:11], cartesian[36:]])
+    basis = BasisSet.from_molecule(molecule('spherical'))
+    assert basis.size == len(reference)
+    assert np.allclose(basis_functions(basis), reference, rtol=1e-12, atol=1e-14)
+
+
+def test_screening_changes_values_negligibly():
+    basis = BasisSet.from_molecule(molecule('cartesian'))
+    coefficients = np.random.default_rng(1).standard_normal(basis.size)
+    origin, resolution, dimensions = np.array([-12.0, -12.0, -12.0]), 0.5, (49, 49, 49)
+    screened = basis.evaluate_grid(coefficients, origin, resolution, dimensions, block=8)
+    unscreened = basis.evaluate_grid(coefficients, origin, resolution, dimensions, block=8, threshold=0)
+    assert screened.shape == dimensions
+    assert np.max(np.abs(screened - unscreened)) < 1e-10
+
+
+def test_zero_coefficients_skip_shells():
+    basis = BasisSet.from_molecule(molecule('spherical'))
+    values = basis.evaluate_grid(np.zeros(basis.size), [0, 0, 0], 0.5, (3, 4, 5))
+    assert values.shape == (3, 4, 5) and not values.any()
+
+
+@pytest.fixture
+def orbitals(tmp_path):
+    project_path = tmp_path / 'TestProject.molpro'
+    shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+    return pymolpro.Project(str(project_path)).orbitals(instance=-1)
+
+
+def test_orbital_cube_matches_pymolpro_evaluation(orbitals):
+    orbital = orbitals[-1]
+    cube = cube_data(orbital, resolution=0.4, border=3, threshold=1e-3)
+    assert cube.orbitals and cube.orbital_identifiers == [orbital.ID]
+    assert list(cube.data.shape) == cube.dimensions
+    reference = orbital.evaluate(grid_points(cube.origin, 0.4, cube.dimensions), values=True)
+    assert np.allclose(cube.data.reshape(-1), reference, atol=1e-12)
+    untrimmed = cube_data(orbital, resolution=0.4, border=3)
+    assert all(n <= m for n, m in zip(cube.dimensions, untrimmed.dimensions))
+
+
+def test_molecule_node_holds_basis_set(orbitals):
+    assert all(BasisSet.from_molecule(molecule_node(orbital)).size == len(orbital.coefficients)
+               for orbital in orbitals)
+
+
+def test_stacked_orbitals_match_single_orbitals(tmp_path):
+    project_path = tmp_path / 'TestProject.molpro'
+    shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+    orbitals = pymolpro.Project(str(project_path)).orbitals(instance=-1, minocc=0.0)
+    window = energy_window(orbitals, highest=2.0)
+    assert 2 < len(window) < len(orbitals)
+    stacked = orbitals_cube_data(window, resolution=0.5, border=3)
+    assert stacked.nvalues == len(window)
+    assert stacked.orbital_identifiers == [orbital.ID for orbital in window]
+    for i, orbital in enumerate(window):
+        single = cube_data(orbital, resolution=0.5, border=3)
+        assert np.allclose(stacked.data[i], single.data, rtol=1e-12, atol=1e-14)
+    trimmed = orbitals_cube_data(window, resolution=0.5, border=3, threshold=1e-2)
+    assert all(n <= m for n, m in zip(trimmed.dimensions, stacked.dimensions))
+
+
+def test_stacked_orbitals_write_and_read_back(tmp_path):
+    project_path = tmp_path / 'TestProject.molpro'
+    shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+    orbitals = pymolpro.Project(str(project_path)).orbitals(instance=-1, minocc=0.0)[:3]
+    stacked = orbitals_cube_data(orbitals, resolution=0.5, border=3)
+    filename = str(tmp_path / 'orbitals.cube')
+    stacked.write(filename)
+    loaded = StackedCubeData(filename)
+    assert loaded.orbital_identifiers == [cube_orbital_index(orbital.ID) for orbital in orbitals]
+    assert loaded.dimensions == stacked.dimensions
+    assert np.allclose(loaded.data, stacked.data, rtol=1e-5, atol=1e-12)
+
+
+def test_density_is_weighted_sum_of_squares():
+    basis = BasisSet.from_molecule(molecule('spherical'))
+    coefficients = np.random.default_rng(2).standard_normal((basis.size, 3))
+    weights = [2.0, 1.0, -0.5]
+    orbitals = basis.evaluate_grid(coefficients, ORIGIN, RESOLUTION, DIMENSIONS, block=4)
+    density = basis.evaluate_density(coefficients, weights, ORIGIN, RESOLUTION, DIMENSIONS, block=4)
+    assert density.shape == DIMENSIONS
+    assert np.allclose(density, np.einsum('o,oijk->ijk', weights, orbitals ** 2), rtol=1e-12, atol=1e-14)
+
+
+def test_total_spin_and_difference_densities(tmp_path):
+    project_path = tmp_path / 'TestProject.molpro'
+    shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+    orbitals = pymolpro.Project(str(project_path)).orbitals(instance=-1)
+    stacked = orbitals_cube_data(orbitals, resolution=0.5, border=3)
+    total = total_density(orbitals).cube_data(resolution=0.5, border=3)
+    assert not total.orbitals and total.dimensions == stacked.dimensions
+    occupations = [orbital.occupation for orbital in orbitals]
+    assert np.allclose(total.data, np.einsum('o,oijk->ijk', occupations, stacked.data ** 2), rtol=1e-12)
+    assert total.data.min() >= 0 and total.data.max() > 0.1
+    assert not difference_density(orbitals, orbitals).cube_data(resolution=0.5, border=3).data.any()
+    trimmed = total_density(orbitals).cube_data(resolution=0.5, border=3, threshold=1e-2)
+    assert all(n <= m for n, m in zip(trimmed.dimensions, total.dimensions))
+    with pytest.raises(ValueError):
+        spin_density(orbitals)  # closed shell: no singly occupied orbitals
+    orbitals[-1].occupation = 1.0
+    spin = spin_density(orbitals).cube_data(resolution=0.5, border=3)
+    assert np.allclose(spin.data, stacked.data[-1] ** 2, rtol=1e-12)
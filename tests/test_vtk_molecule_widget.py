@@ -0,0 +1,557 @@
+import copy
+import gc
+import pathlib
+import shutil
+import types
+
+import numpy as np
+import pymolpro
+import pytest
+from lxml import etree
+from pymolpro.cube_data import CubeData
+from PySide6.QtWidgets import QWidget
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from vtkmodules.vtkCommonCore import vtkFloatArray
+from vtkmodules.vtkCommonDataModel import vtkStructuredGrid
+from vtkmodules.vtkCommonTransforms import vtkTransform
+
+import iMolpro.orbital_grid
+import iMolpro.vtk_molecule_widget
+from iMolpro.cube_cache import CubePrefetcher, shared_cube_cache
+from iMolpro.vtk_molecule_widget import MoleculeDisplay, create_vtk_image_data, GeometryActorCollection, NucleiActor, \
+    NucleiGlyphActor, BondActorCollection, BondGlyphActor, VibrationAnimation, FramePacer, NucleusLabelsActor, \
+    template_mesh, bond_matrices, set_bond_transform, scene_renderer, add_to_renderer, orbital_sets, spin_partner, \
+    MoleculeWidget
+
+
+def make_cube(dimensions, seed=1):
+    return CubeData({
+        'title': ['test', ''],
+        'natoms': 0,
+        'atoms': [],
+        'origin': (-1.0, -2.0, -3.0),
+        'cells': np.diag([0.2, 0.3, 0.4]),
+        'dimensions': list(dimensions),
+        'orbitals': True,
+        'orbital_identifiers': ['1.1'],
+        'data': np.random.default_rng(seed).standard_normal(dimensions),
+    })
+
+
+def reference_scalars(cube_data):
+    r"""The per-voxel loop create_vtk_image_data() used before handing VTK the NumPy buffer directly."""
+    scalars = vtkFloatArray()
+    data = np.asfortranarray(cube_data.data)
+    scalars.SetNumberOfValues(cube_data.data.size)
+    i = 0
+    for iz in range(cube_data.dimensions[2]):
+        for iy in range(cube_data.dimensions[1]):
+            for ix in range(cube_data.dimensions[0]):
+                scalars.SetValue(i, data[ix, iy, iz])
+                i += 1
+    return scalars
+
+
+def test_voxel_ordering_matches_reference_loop():
+    cube_data = make_cube((3, 4, 5))
+    image_data = create_vtk_image_data(cube_data)
+    scalars = image_data.GetPointData().GetScalars()
+    reference = reference_scalars(cube_data)
+    assert scalars.GetNumberOfValues() == reference.GetNumberOfValues()
+    for i in range(reference.GetNumberOfValues()):
+        assert scalars.GetValue(i) == reference.GetValue(i)
+    assert image_data.GetDimensions() == (3, 4, 5)
+    assert scalars.GetName() == 'test'
+
+
+def test_point_lookup_matches_grid_indices():
+    cube_data = make_cube((4, 3, 2))
+    image_data = create_vtk_image_data(cube_data)
+    scalars = image_data.GetPointData().GetScalars()
+    for index in [(0, 0, 0), (3, 0, 0), (0, 2, 0), (0, 0, 1), (2, 1, 1), (3, 2, 1)]:
+        point_id = image_data.ComputePointId(index)
+        assert scalars.GetValue(point_id) == np.float32(cube_data.data[index])
+
+
+def test_scalars_outlive_source_array():
+    cube_data = make_cube((5, 5, 5))
+    expected = np.asfortranarray(cube_data.data, dtype=np.float32).ravel(order='F').copy()
+    image_data = create_vtk_image_data(cube_data)
+    del cube_data
+    gc.collect()
+    scalars = image_data.GetPointData().GetScalars()
+    assert [scalars.GetValue(i) for i in range(scalars.GetNumberOfValues())] == list(expected)
+
+
+def test_non_orthogonal_cells_give_point_positions():
+    cube_data = make_cube((3, 4, 5))
+    cube_data.cells = np.array([[0.2, 0.0, 0.0], [0.1, 0.3, 0.0], [0.05, -0.1, 0.4]])
+    grid = create_vtk_image_data(cube_data)
+    assert isinstance(grid, vtkStructuredGrid)
+    dimensions = [0, 0, 0]
+    grid.GetDimensions(dimensions)
+    assert dimensions == [3, 4, 5]
+    scalars = grid.GetPointData().GetScalars()
+    reference = reference_scalars(cube_data)
+    for index in [(0, 0, 0), (2, 0, 0), (0, 3, 0), (0, 0, 4), (1, 2, 3), (2, 3, 4)]:
+        point_id = index[0] + 3 * (index[1] + 4 * index[2])
+        expected = np.asarray(cube_data.origin) + np.asarray(index) @ cube_data.cells
+        assert np.allclose(grid.GetPoint(point_id), expected)
+        assert scalars.GetValue(point_id) == reference.GetValue(point_id)
+
+
+def test_non_orthogonal_points_outlive_source_array():
+    cube_data = make_cube((2, 2, 2))
+    cube_data.cells = np.array([[0.2, 0.1, 0.0], [0.0, 0.3, 0.0], [0.0, 0.0, 0.4]])
+    grid = create_vtk_image_data(cube_data)
+    gc.collect()
+    assert np.allclose(grid.GetPoint(7), np.asarray(cube_data.origin) + np.ones(3) @ cube_data.cells)
+
+
+WATER = [{'atomic_number': 8, 'xyz': (0.0, 0.0, 0.2)},
+         {'atomic_number': 1, 'xyz': (0.0, 1.4, -0.9)},
+         {'atomic_number': 1, 'xyz': (0.0, -1.4, -0.9)}]
+
+
+def test_instanced_nuclei_are_one_actor_with_per_point_radius_and_colour():
+    per_element = GeometryActorCollection(WATER, nuclei_rendering='per_element')
+    instanced = GeometryActorCollection(WATER, nuclei_rendering='instanced')
+    nuclei = [actor for actor in instanced if isinstance(actor, NucleiGlyphActor)]
+    assert len(nuclei) == 1 and not any(isinstance(actor, NucleiActor) for actor in instanced)
+    assert len([actor for actor in per_element if isinstance(actor, NucleiActor)]) == 2
+    points = nuclei[0].GetMapper().GetInput()
+    assert np.allclose(vtk_to_numpy(points.GetPoints().GetData()), [atom['xyz'] for atom in WATER])
+    radii = vtk_to_numpy(points.GetPointData().GetArray('radius'))
+    assert radii[0] > radii[1] == radii[2]
+    colours = vtk_to_numpy(points.GetPointData().GetArray('colour'))
+    assert colours.shape == (3, 3) and colours.dtype == np.uint8 and tuple(colours[1]) == (255, 255, 255)
+    with pytest.raises(ValueError):
+        GeometryActorCollection(WATER, nuclei_rendering='impostors')
+
+
+def test_instanced_nuclei_move_in_place():
+    actor = NucleiGlyphActor(WATER)
+    points = actor.points
+    moved = [dict(atom, xyz=tuple(c + 0.1 for c in atom['xyz'])) for atom in WATER]
+    actor.update_data(moved)
+    assert actor.points is points
+    assert np.allclose(vtk_to_numpy(points.GetData()), [atom['xyz'] for atom in moved])
+    actor.update_data(WATER[:2])
+    assert actor.points.GetNumberOfPoints() == 2
+
+
+# a bond to each hydrogen, none between them
+METHANE_FRAGMENT = [{'atomic_number': 6, 'xyz': (0.0, 0.0, 0.0)},
+                    {'atomic_number': 1, 'xyz': (2.0, 0.2, 0.0)},
+                    {'atomic_number': 1, 'xyz': (-0.3, 0.1, 2.0)}]
+
+
+def test_instanced_bonds_match_per_bond_actors():
+    per_bond = BondActorCollection(METHANE_FRAGMENT, bond_radius=.15, bond_rendering='per_bond')
+    instanced = BondActorCollection(METHANE_FRAGMENT, bond_radius=.15, bond_rendering='instanced')
+    assert len(list(per_bond)) == 2 and len(list(instanced)) == 1
+    assert [bond[:2] for bond in instanced.bonds] == [bond[:2] for bond in per_bond.bonds]
+    moved = [dict(atom, xyz=tuple(c + 0.1 * k for k, c in enumerate(atom['xyz']))) for atom in METHANE_FRAGMENT]
+    per_bond.update(moved)
+    instanced.update(moved)
+    glyphs = instanced.bond_glyphs
+    midpoints = vtk_to_numpy(glyphs.points.GetData())
+    directions = vtk_to_numpy(glyphs.directions)
+    scales = vtk_to_numpy(glyphs.scales)
+    for k, (i, j, actor) in enumerate(per_bond.bonds):
+        # the ends of the unit cylinder, placed by the per-bond actor's transform
+        start, end = (np.array(actor.GetUserTransform().TransformPoint(point)) for point in ((0, -.5, 0), (0, .5, 0)))
+        assert np.allclose(midpoints[k], 0.5 * (start + end))
+        assert np.allclose(directions[k], end - start)
+        assert np.allclose(scales[k], [np.linalg.norm(end - start), .15, .15])
+
+
+def test_instanced_bonds_without_bonds():
+    bonds = BondActorCollection(METHANE_FRAGMENT[:1], bond_rendering='instanced')
+    bonds.update(METHANE_FRAGMENT[:1])
+    assert bonds.bonds == []
+
+
+def test_bond_matrices_match_bond_transforms():
+    rng = np.random.default_rng(4)
+    start, end = rng.standard_normal((2, 20, 3))
+    for matrix, start_, end_ in zip(bond_matrices(start, end, radius=.3), start, end):
+        transform = vtkTransform()
+        set_bond_transform(transform, start_, end_, radius=.3)
+        reference = np.array([transform.GetMatrix().GetElement(i, j) for i in range(4) for j in range(4)])
+        assert np.allclose(matrix.ravel(), reference)
+
+
+# the asymmetric stretch, with the oxygen barely moving
+WATER_STRETCH = [0.0, 0.0, 0.05, 0.0, 0.6, -0.4, 0.0, 0.6, 0.4]
+
+
+def test_vibration_frames_are_written_into_the_shared_points():
+    animation = VibrationAnimation(WATER, WATER_STRETCH, peak_displacement=0.4)
+    positions = animation.frame(np.pi / 6)
+    assert positions is animation.positions
+    assert np.shares_memory(positions, vtk_to_numpy(animation.points.GetData()))
+    peak = 0.4 / np.linalg.norm([0.0, 0.6, -0.4])
+    expected = np.array([atom['xyz'] for atom in WATER]) + 0.5 * peak * np.reshape(WATER_STRETCH, (3, 3))
+    assert np.allclose(positions, expected)
+    assert [atom['atomic_number'] for atom in animation.atoms()] == [8, 1, 1]
+    assert np.allclose([atom['xyz'] for atom in animation.atoms()], expected)
+    still = VibrationAnimation(WATER, [0.0] * 9, peak_displacement=0.4)
+    assert np.allclose(still.frame(1.0), still.equilibrium)
+
+
+def drawn(geometry):
+    return [actor for actor in geometry if actor.GetVisibility()]
+
+
+@pytest.mark.parametrize('animating', [False, True])
+@pytest.mark.parametrize('rendering', ['per_element', 'instanced'])
+def test_geometry_follows_vibration_frames_like_atom_lists(rendering, animating):
+    molecule = WATER + [dict(atom, xyz=(atom['xyz'][0] + 5.0,) + atom['xyz'][1:]) for atom in WATER]
+    animation = VibrationAnimation(molecule, WATER_STRETCH * 2, peak_displacement=0.4)
+    framed = GeometryActorCollection(molecule, nuclei_rendering=rendering)
+    framed.set_animating(animating)
+    framed.share_points(animation.points)
+    framed.update_positions(animation.frame(1.0))
+    listed = GeometryActorCollection(molecule, nuclei_rendering=rendering)
+    listed.set_animating(animating)
+    listed.update(animation.atoms())
+    assert len(drawn(framed)) == len(drawn(listed)) > 0
+    for framed_actor, listed_actor in zip(drawn(framed), drawn(listed)):
+        assert type(framed_actor) is type(listed_actor)
+        if isinstance(framed_actor, NucleiGlyphActor):
+            assert framed_actor.points is animation.points
+        if isinstance(framed_actor, (NucleiActor, NucleiGlyphActor, BondGlyphActor)):
+            assert np.allclose(vtk_to_numpy(framed_actor.points.GetData()), vtk_to_numpy(listed_actor.points.GetData()))
+        else:
+            assert np.allclose(*([actor.GetUserTransform().GetMatrix().GetElement(i, j)
+                                  for i in range(4) for j in range(4)] for actor in (framed_actor, listed_actor)))
+
+
+def run_frames(pacer, render_time, frames, start=0.0):
+    for _ in range(frames):
+        pacer.frame(start, render_time(pacer))
+        start += max(pacer.interval, render_time(pacer))
+    return start
+
+
+def test_frame_pacer_counts_late_and_dropped_frames():
+    pacer = FramePacer(interval=33, resolution=24, adaptive=False)
+    for start, render_time in ((0, 5), (33, 5), (66, 70), (136, 5), (169, 5)):
+        assert not pacer.frame(start, render_time)
+    assert (pacer.frames, pacer.late, pacer.dropped) == (5, 1, 1)
+    pacer.resume()
+    pacer.frame(1000, 5)
+    assert pacer.dropped == 1
+
+
+def test_frame_pacer_cuts_resolution_then_frame_rate_and_recovers():
+    pacer = FramePacer(interval=33, resolution=24, minimum_resolution=8, maximum_interval=100)
+    # drawing cost grows with the sphere resolution, but never fits in 33 ms
+    slow = lambda pacer: 40 + pacer.resolution
+    start = run_frames(pacer, slow, 30)
+    assert pacer.interval == 33 and pacer.resolution < 24
+    start = run_frames(pacer, slow, 200, start)
+    assert pacer.resolution == 8 and 33 < pacer.interval <= 100
+    assert pacer.render_time < FramePacer.OVERRUN * pacer.interval
+    assert pacer.late > 0
+    run_frames(pacer, lambda pacer: 1, 200, start)
+    assert (pacer.interval, pacer.resolution) == (33, 24)
+    assert set(pacer.statistics) >= {'frames', 'late', 'dropped'}
+
+
+def test_nucleus_labels_move_without_rebuilding():
+    labels = NucleusLabelsActor(WATER)
+    mapper, points = labels.GetMapper(), labels.points
+    moved = [dict(atom, xyz=tuple(c + 0.1 for c in atom['xyz'])) for atom in WATER]
+    labels.update(moved)
+    assert labels.GetMapper() is mapper and labels.points is points
+    assert np.allclose(vtk_to_numpy(labels.polydata.GetPoints().GetData()), [atom['xyz'] for atom in moved])
+    animation = VibrationAnimation(WATER, WATER_STRETCH, peak_displacement=0.4)
+    labels.share_points(animation.points)
+    labels.update_positions(animation.frame(1.0))
+    assert labels.polydata.GetPoints() is animation.points
+    labels.update(WATER[:2])
+    assert labels.GetMapper() is not mapper and labels.points.GetNumberOfPoints() == 2
+    assert labels.polydata.GetPointData().GetAbstractArray('labels').GetValue(1) == 'H2'
+
+
+def test_hidden_nucleus_labels_are_moved_when_shown():
+    interactor = types.SimpleNamespace(Render=lambda: None)
+    window = types.SimpleNamespace(GetInteractor=lambda: interactor)
+    widget = types.SimpleNamespace(model=types.SimpleNamespace(geometry=GeometryActorCollection(WATER)),
+                                   nucleus_labels=NucleusLabelsActor(WATER), _hidden_label_atoms=None,
+                                   _nucleus_labels_stale=False,
+                                   scene=types.SimpleNamespace(GetRenderWindow=lambda: window))
+
+    def label_positions():
+        return vtk_to_numpy(widget.nucleus_labels.polydata.GetPoints().GetData()).copy()
+
+    MoleculeWidget.show_nucleus_labels(widget, False)
+    moved = [dict(atom, xyz=tuple(c + 0.1 for c in atom['xyz'])) for atom in WATER]
+    MoleculeWidget.update_geometry(widget, moved)
+    animation = VibrationAnimation(moved, WATER_STRETCH, peak_displacement=0.4)
+    animation.frame(1.0)
+    MoleculeWidget.update_positions(widget, animation)
+    assert np.allclose(label_positions(), [atom['xyz'] for atom in WATER])
+    MoleculeWidget.show_nucleus_labels(widget, True)
+    assert np.allclose(label_positions(), animation.positions)
+    animation.frame(-1.0)
+    MoleculeWidget.update_positions(widget, animation)
+    assert np.allclose(label_positions(), animation.positions)
+
+
+def test_scene_renderer_takes_labels_and_models():
+    renderer = scene_renderer()
+    labels = NucleusLabelsActor(WATER)
+    add_to_renderer(renderer, labels)
+    add_to_renderer(renderer, GeometryActorCollection(WATER))
+    props = renderer.GetViewProps()
+    assert renderer.HasViewProp(labels) and props.GetNumberOfItems() > 1
+
+
+def test_template_meshes_are_shared_between_actors():
+    sphere = template_mesh('sphere', NucleiActor.STATIC_SPHERE_RESOLUTION)
+    assert template_mesh('sphere', NucleiActor.STATIC_SPHERE_RESOLUTION) is sphere
+    assert np.allclose(np.linalg.norm(vtk_to_numpy(sphere.GetPoints().GetData()), axis=1), 1.0)
+    first, second = (GeometryActorCollection(METHANE_FRAGMENT, nuclei_rendering='per_element') for _ in range(2))
+    glyphs = [actor.glyph for collection in (first, second) for actor in collection if isinstance(actor, NucleiActor)]
+    assert all(glyph.GetSource() is sphere for glyph in glyphs)
+    first.set_sphere_resolution(24)
+    assert all(glyph.GetSource() is template_mesh('sphere', 24) for glyph in glyphs[:2])
+    assert all(glyph.GetSource() is sphere for glyph in glyphs[2:])
+    bonds = list(first.bond_actor_collection)
+    assert bonds and all(actor.GetMapper().GetInput() is template_mesh('cylinder', 30) for actor in bonds)
+    along_x = vtk_to_numpy(template_mesh('cylinder_along_x', 30).GetPoints().GetData())
+    assert np.allclose(np.abs(along_x[:, 0]).max(), 0.5) and np.allclose(np.abs(along_x[:, 1:]).max(), 1.0)
+    with pytest.raises(ValueError):
+        template_mesh('cone', 30)
+
+
+class UnreadableSettings:
+    def __getitem__(self, key):
+        raise AssertionError(f'settings[{key!r}] read by a prefetch worker')
+
+
+def test_prefetched_grids_carry_their_backend_in_the_key(monkeypatch):
+    # the key is made on the GUI thread; what the workers do with it mustn't read the settings
+    monkeypatch.setattr(iMolpro.vtk_molecule_widget, 'settings', {'orbital_grid_backend': 'screened'})
+    assert MoleculeDisplay._cube_key('orbital', .3) == ('orbital', .3, 'screened')
+    monkeypatch.setattr(iMolpro.vtk_molecule_widget, 'settings', UnreadableSettings())
+    backends = []
+    monkeypatch.setattr(iMolpro.vtk_molecule_widget, 'orbital_cube_data',
+                        lambda orbital, backend, **options: backends.append(backend))
+    monkeypatch.setattr(iMolpro.vtk_molecule_widget, 'content_digest', lambda orbital: 'digest')
+    MoleculeDisplay._evaluate_cube(('orbital', .3, 'screened'), .01)
+    assert backends == ['screened']
+    display = type('Display', (), {'_content_digests': {}})()
+    assert MoleculeDisplay._content_key(display, ('orbital', .3, 'screened')) == ('digest', .3, 'screened')
+
+
+class MemorySettings(dict):
+    def add_default(self, key, value):
+        self.setdefault(key, value)
+
+
+class RecordingMoleculeWidget:
+    r"""Stands in for a MoleculeDisplay's MoleculeWidget, keeping the grids it is given to draw."""
+
+    def __init__(self, contour_value):
+        self.model = types.SimpleNamespace(contour_value=contour_value)
+        self.grids = []
+
+    def refresh_contour(self, cube_data):
+        self.grids.append(cube_data)
+
+    def refresh_model(self, cube_data):
+        self.grids.append(cube_data)
+
+
+class RecordingControlPanel:
+    def __init__(self):
+        self.setups = 0
+
+    def setup(self, metadata={}):
+        self.setups += 1
+
+    def refresh(self):
+        pass
+
+
+@pytest.fixture
+def grid_display(qtbot, monkeypatch, tmp_path):
+    r"""
+    Make MoleculeDisplays of the orbitals of a copy of pymolpro's TestProject, as MoleculeDisplay.__init__() does
+    but without its VTK widgets, which need OpenGL to draw with, and with settings kept in memory.
+    """
+    monkeypatch.setattr(iMolpro.vtk_molecule_widget, 'settings', MemorySettings(
+        progressive_orbital_rendering=1, orbital_grid_backend='pymolpro', orbital_prefetch_neighbours=0,
+        cube_cache_megabytes=1024, cube_disk_cache_megabytes=1024))
+    project_path = tmp_path / 'TestProject.molpro'
+    shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+    orbitals = pymolpro.Project(str(project_path)).orbitals()
+    shared = shared_cube_cache(int(1e9))
+    shared.clear()
+
+    def make(contour_value=.1, reference_sets=None):
+        display = MoleculeDisplay.__new__(MoleculeDisplay)
+        QWidget.__init__(display)
+        qtbot.addWidget(display)
+        display.cubes = shared.view(display._content_key)
+        display._content_digests = {}
+        display.prefetcher = CubePrefetcher(display.cubes, display._evaluate_cube, on_ready=display.cube_ready.emit)
+        display._prefetch_cancelled = False
+        display.cube_ready.connect(display._on_cube_ready)
+        display.orbitals, display.densities, display.orbital, display.resolution = orbitals, [], orbitals[-1], .3
+        display.metadata, display.reference_sets, display.right_panel = {}, reference_sets, RecordingControlPanel()
+        display.molecule_widget = RecordingMoleculeWidget(contour_value)
+        display.molecule_widget.grids.append(display.get_progressive_cube(contour_value))
+        display.prefetch_orbitals(frontier=True)
+        return display
+
+    yield make
+    shared.clear()
+
+
+def test_orbital_is_drawn_coarse_then_refined(grid_display, qtbot):
+    display = grid_display()
+    grids = display.molecule_widget.grids
+    assert display._coarse_cube_shown
+    # the coarse grid comes from the fast backend, whichever is configured for the real one
+    assert display.cubes.peek(display._cube_key(display.orbital, display.resolution * 4, 'screened')) is not None
+    qtbot.waitUntil(lambda: len(grids) == 2, timeout=20000)
+    assert not display._coarse_cube_shown
+    assert np.prod(grids[1].dimensions) > np.prod(grids[0].dimensions)
+    assert grids[1] is display.cubes.peek(display._cube_key(display.orbital, display.resolution))[1]
+
+
+def test_orbital_is_drawn_coarse_by_pymolpro_if_the_fast_backend_cannot(grid_display, qtbot, monkeypatch):
+    # p shells made unsupported, as shells of high angular momentum are
+    monkeypatch.setattr(iMolpro.orbital_grid, '_CARTESIAN_COMPONENTS', iMolpro.orbital_grid._CARTESIAN_COMPONENTS[:1])
+    iMolpro.orbital_grid.basis_set.cache_clear()
+    display = grid_display()
+    coarse = display.resolution * display.PROGRESSIVE_COARSENING
+    assert display._coarse_cube_shown and len(display.molecule_widget.grids) == 1
+    assert display.cubes.peek(display._cube_key(display.orbital, coarse, 'pymolpro')) is not None
+    assert display.cubes.peek(display._cube_key(display.orbital, coarse, 'screened')) is None
+    qtbot.waitUntil(lambda: not display._coarse_cube_shown, timeout=20000)
+
+
+def test_orbital_on_disk_is_not_drawn_coarse(grid_display, qtbot):
+    display = grid_display()
+    qtbot.waitUntil(lambda: not display._coarse_cube_shown, timeout=20000)
+    refined = display.molecule_widget.grids[-1]
+    display.release_cubes()
+    shared_cube_cache(int(1e9)).clear()
+    display = grid_display()
+    assert not display._coarse_cube_shown
+    assert np.allclose(display.molecule_widget.grids[0].data, refined.data, rtol=1e-6, atol=0)
+
+
+def test_refined_grid_trimmed_for_a_higher_contour_is_not_swapped_in(grid_display, qtbot, monkeypatch):
+    ready = []
+    refine = MoleculeDisplay._on_cube_ready
+    monkeypatch.setattr(MoleculeDisplay, '_on_cube_ready', lambda self, key: ready.append(key))
+    display = grid_display()
+    key = display._cube_key(display.orbital, display.resolution)
+    qtbot.waitUntil(lambda: key in ready, timeout=20000)
+    # the contour is lowered, below what the grid was trimmed for, while the grid is being evaluated
+    display.molecule_widget.model.contour_value /= 4
+    refine(display, key)
+    assert display._coarse_cube_shown and len(display.molecule_widget.grids) == 1
+    qtbot.waitUntil(lambda: display.cubes.peek(key)[0] <= display.molecule_widget.model.contour_value * .1,
+                    timeout=20000)
+    refine(display, key)
+    assert not display._coarse_cube_shown and len(display.molecule_widget.grids) == 2
+
+
+def test_default_modes_animate_through_instanced_stand_ins(monkeypatch):
+    monkeypatch.setattr(iMolpro.vtk_molecule_widget, 'settings', MemorySettings())
+    molecule = WATER + [dict(atom, xyz=(atom['xyz'][0] + 5.0,) + atom['xyz'][1:]) for atom in WATER]
+    animation = VibrationAnimation(molecule, WATER_STRETCH * 2, peak_displacement=0.4)
+    geometry = GeometryActorCollection(molecule)
+    assert geometry.bond_actor_collection.bond_rendering == 'per_bond'
+    assert all(isinstance(actor, NucleiActor) for actor in geometry.nuclei)
+    assert not geometry.nuclei_stand_in.GetVisibility() and not geometry.bond_stand_in.GetVisibility()
+    geometry.set_animating(True)
+    geometry.share_points(animation.points)
+    assert [id(actor) for actor in drawn(geometry)] == [id(geometry.nuclei_stand_in), id(geometry.bond_stand_in)]
+    # a frame moves the two stand-ins, and nothing that loops over elements or bonds
+    with monkeypatch.context() as frame:
+        for actors in (NucleiActor, BondActorCollection):
+            frame.setattr(actors, 'update_positions', lambda *args: pytest.fail('moved per element or per bond'))
+        geometry.update_positions(animation.frame(1.0))
+    assert np.allclose(vtk_to_numpy(geometry.nuclei_stand_in.points.GetData()), animation.positions)
+    assert np.allclose(vtk_to_numpy(geometry.bond_stand_in.points.GetData()),
+                       vtk_to_numpy(BondGlyphActor(animation.atoms(), geometry.bond_actor_collection.pairs.tolist(),
+                                                   radius=.1).points.GetData()))
+    # when animation stops, the per-element and per-bond actors are shown again where the atoms last were
+    geometry.set_animating(False)
+    listed = GeometryActorCollection(molecule)
+    listed.update(animation.atoms())
+    assert [id(actor) for actor in drawn(geometry)] == [id(actor) for actor in geometry.nuclei] + [
+        id(actor) for actor in geometry.bond_actor_collection]
+    for actor, listed_actor in zip(drawn(geometry), drawn(listed)):
+        if isinstance(actor, NucleiActor):
+            assert np.allclose(vtk_to_numpy(actor.points.GetData()), vtk_to_numpy(listed_actor.points.GetData()))
+        else:
+            assert np.allclose(*([bond.GetUserTransform().GetMatrix().GetElement(i, j)
+                                  for i in range(4) for j in range(4)] for bond in (actor, listed_actor)))
+
+
+def test_orbital_sets_are_labelled_as_the_output_tabs_label_them(grid_display):
+    orbitals = grid_display().orbitals
+    project = types.SimpleNamespace(orbitals=lambda index: [orbitals, orbitals, orbitals][index])
+    assert list(orbital_sets(project)) == ['RHF/CANONICAL orbitals', 'RHF/CANONICAL orbitals: 2',
+                                           'RHF/CANONICAL orbitals: 3']
+    assert orbital_sets(types.SimpleNamespace(orbitals=lambda index: [][index])) == {}
+
+
+def test_spin_partner_is_the_nearest_set_of_the_other_spin_and_same_method(tmp_path):
+    project_path = tmp_path / 'TestProject.molpro'
+    shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', project_path)
+    xml_filename = project_path / 'run' / '1.molpro' / '1.xml'
+    tree = etree.parse(str(xml_filename))
+    orbital_set = tree.getroot().find('.//{http://www.molpro.net/schema/molpro-output}orbitals')
+    # UKS alpha, UHF alpha, UKS beta: the set before the last has the other spin but not the same method
+    for method, spin in (('UKS', 'beta'), ('UHF', 'alpha'), ('UKS', 'alpha')):
+        copied = copy.deepcopy(orbital_set)
+        copied.set('method', method)
+        copied.set('spin', spin)
+        orbital_set.addnext(copied)
+    orbital_set.getparent().remove(orbital_set)
+    tree.write(str(xml_filename))
+    project = pymolpro.Project(str(project_path))
+    sets = [project.orbitals(orbital_instance=index) for index in range(3)]
+
+    def where(orbitals):
+        orbital_set = orbitals[0].node.getparent()
+        return orbital_set.get('method'), orbital_set.get('spin'), orbital_set.getparent().index(orbital_set)
+
+    assert where(spin_partner(project, sets[2])) == where(sets[0])
+    assert where(spin_partner(project, sets[0])) == where(sets[2])
+    assert spin_partner(project, sets[1]) is None
+
+
+def test_difference_density_from_a_chosen_run(grid_display, qtbot, monkeypatch, tmp_path):
+    other = tmp_path / 'other' / 'Other.molpro'
+    shutil.copytree(pathlib.Path(pymolpro.__file__).parent / 'TestProject.molpro', other.parent / 'TestProject.molpro')
+    (other.parent / 'TestProject.molpro').rename(other)
+    for suffix in ('xml', 'out', 'inp'):
+        for filename in other.glob(f'**/TestProject.{suffix}'):
+            filename.rename(filename.with_name('Other.' + suffix))
+    display = grid_display(reference_sets=lambda: {'RHF/CANONICAL orbitals: 2': display.orbitals[:1]})
+    answers = iter([('Another run...', True), ('RHF/CANONICAL orbitals', True)])
+    monkeypatch.setattr(iMolpro.vtk_molecule_widget.QInputDialog, 'getItem', lambda *args: next(answers))
+    monkeypatch.setattr(iMolpro.vtk_molecule_widget.QFileDialog, 'getExistingDirectory', lambda *args: str(other))
+    display.choose_difference_reference()
+    assert display.orbital.ID == 'Density - Other: RHF/CANONICAL orbitals' and display.orbital is display.densities[-1]
+    assert display.right_panel.setups == 1
+    reference = display.orbital.terms[1][0]
+    assert [orbital.ID for orbital in reference] == [orbital.ID for orbital in display.orbitals]
+    assert pathlib.Path(reference[0].directory).resolve() != pathlib.Path(display.orbitals[0].directory).resolve()
+    # a set of this run, as offered by reference_sets
+    answers = iter([('RHF/CANONICAL orbitals: 2', True)])
+    display.choose_difference_reference()
+    assert display.orbital.ID == 'Density - RHF/CANONICAL orbitals: 2'
+    assert display.densities[-2].ID == 'Density - Other: RHF/CANONICAL orbitals'